@@ -1,12 +1,16 @@
+import abc
 import asyncio
 import logging
-from typing import Optional
-from aiogram import Bot, Dispatcher, F
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Mapping, NamedTuple, Optional
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton,
     CallbackQuery, BotCommand, LabeledPrice, PreCheckoutQuery,
-    BufferedInputFile, BusinessConnection, BusinessMessagesDeleted, FSInputFile
+    BufferedInputFile, BusinessConnection, BusinessMessagesDeleted, FSInputFile,
+    TelegramObject, Update
 )
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -15,10 +19,24 @@ import json
 import os
 from datetime import datetime, timedelta
 import base64
+import hashlib
 import subprocess
 import re
 import html
 import random
+import sqlite3
+import threading
+import functools
+import bisect
+from array import array
+import time
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from collections import OrderedDict, deque
+import statistics
+from contextlib import asynccontextmanager, contextmanager
 from urllib.parse import quote
 
 try:
@@ -50,6 +68,23 @@ IMAGE_MONTHLY_LIMIT_PRO = int(os.getenv("IMAGE_MONTHLY_LIMIT_PRO", "300"))
 FREE_TRIAL_LIMIT = int(os.getenv("FREE_TRIAL_LIMIT", "5"))
 DEFAULT_MODEL = "deepseek-chat"
 MAX_MESSAGE_LENGTH = 4000
+# Автоматы (circuit breaker) для image-моделей: сколько неудач подряд открывают цепь
+# и на сколько секунд модель выключается (для исчерпанных кредитов/лимитов — дольше)
+IMAGE_CIRCUIT_FAILURES = max(1, int(os.getenv("IMAGE_CIRCUIT_FAILURES", "3")))
+IMAGE_CIRCUIT_COOLDOWN = max(10, int(os.getenv("IMAGE_CIRCUIT_COOLDOWN", "300")))
+IMAGE_CIRCUIT_QUOTA_COOLDOWN = max(60, int(os.getenv("IMAGE_CIRCUIT_QUOTA_COOLDOWN", "3600")))
+# Общий бюджет времени (сек) на одну генерацию изображения со всеми fallback-ами и повторами
+IMAGE_DEADLINE_SECONDS = max(20, int(os.getenv("IMAGE_DEADLINE_SECONDS", "150")))
+# Гонка кандидатов при генерации изображений: задержка перед запуском следующего кандидата,
+# сколько моделей запускать параллельно (1 = по очереди) и лимиты одновременных запросов к провайдерам
+IMAGE_RACE_STAGGER = max(0.0, float(os.getenv("IMAGE_RACE_STAGGER", "1.5")))
+IMAGE_RACE_MODELS = max(1, int(os.getenv("IMAGE_RACE_MODELS", "1")))
+IMAGE_PROVIDER_CONCURRENCY = {
+    "onlysq": max(1, int(os.getenv("ONLYSQ_IMAGE_CONCURRENCY", "4"))),
+    "pollinations": max(1, int(os.getenv("POLLINATIONS_CONCURRENCY", "6"))),
+}
+# Потоковые ответы: как часто (сек) редактировать сообщение с растущим текстом
+STREAM_EDIT_INTERVAL = max(0.5, float(os.getenv("STREAM_EDIT_INTERVAL", "1.2")))
 SYSTEM_GIF_URL = os.getenv("SYSTEM_GIF_URL", "").strip()
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_SYSTEM_GIF_URLS = []
@@ -211,6 +246,53 @@ STATS_FILE = os.path.join(DATA_DIR, "stats.json")
 BLACKLIST_FILE = os.path.join(DATA_DIR, "blacklist.json")
 PENDING_INVOICES_FILE = os.path.join(DATA_DIR, "pending_invoices.json")
 BUSINESS_CONNECTIONS_FILE = os.path.join(DATA_DIR, "business_connections.json")
+DB_FILE = os.path.join(DATA_DIR, "bot.db")
+# Write-back кэш записей пользователей: размер LRU и окно долговечности (сек) между сбросами на диск
+USER_CACHE_SIZE = max(100, int(os.getenv("USER_CACHE_SIZE", "5000")))
+USER_FLUSH_INTERVAL = max(0.5, float(os.getenv("USER_FLUSH_INTERVAL", "5")))
+# История чатов: сколько сообщений хранить и как часто обрезать журнал до этого лимита
+HISTORY_MAX_MESSAGES = 50
+HISTORY_COMPACT_INTERVAL = max(5, int(os.getenv("HISTORY_COMPACT_INTERVAL", "60")))
+# Сжатие истории: когда несжатых сообщений набирается HISTORY_SUMMARY_TRIGGER, старые из них
+# (кроме последних HISTORY_SUMMARY_KEEP) в фоне сворачиваются дешевой моделью в одно резюме
+HISTORY_SUMMARY_TRIGGER = max(6, int(os.getenv("HISTORY_SUMMARY_TRIGGER", "24")))
+HISTORY_SUMMARY_KEEP = max(2, min(HISTORY_SUMMARY_TRIGGER - 2, int(os.getenv("HISTORY_SUMMARY_KEEP", "10"))))
+# Сжатие JSON-персон при загрузке: бюджет токенов сжатой версии (0 — не сжимать, слать полную)
+PERSONA_CONDENSE_TOKENS = max(0, int(os.getenv("PERSONA_CONDENSE_TOKENS", "600")))
+# Окно контекста для AI: бюджет токенов на весь промпт (системные сообщения + история + вопрос)
+# для каждой модели DeepSeek; история добирается от новых сообщений к старым, пока влезает.
+# Бюджет не превышается никогда. HISTORY_TOKEN_FLOOR — сколько истории (примерно прежнее окно
+# в 20 сообщений) стараемся сохранить: если системная часть его не оставляет, резюме старой части
+# диалога не отправляется, а история получает остаток бюджета
+CONTEXT_TOKEN_BUDGETS = {
+    "deepseek-chat": max(1000, int(os.getenv("DEEPSEEK_CHAT_CONTEXT_TOKENS", "12000"))),
+    "deepseek-reasoner": max(1000, int(os.getenv("DEEPSEEK_REASONER_CONTEXT_TOKENS", "12000"))),
+}
+HISTORY_TOKEN_FLOOR = max(0, int(os.getenv("HISTORY_TOKEN_FLOOR", "4000")))
+# Счетчики статистики копятся в памяти и сбрасываются в базу раз в STATS_FLUSH_INTERVAL секунд
+STATS_FLUSH_INTERVAL = max(1, float(os.getenv("STATS_FLUSH_INTERVAL", "10")))
+# Пул потоков для дискового ввода-вывода (чтобы не блокировать event loop)
+IO_WORKERS = max(1, int(os.getenv("IO_WORKERS", "4")))
+# Мониторинг задержки event loop: период замера и порог предупреждения
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARN_MS = max(10, int(os.getenv("LOOP_LAG_WARN_MS", "200")))
+# Распознавание голоса: размер пула распознавания, предел очереди (сверх него — отказ)
+# и таймаут (сек) на декодирование и на распознавание
+STT_WORKERS = max(1, int(os.getenv("STT_WORKERS", "4")))
+STT_MAX_QUEUE = max(1, int(os.getenv("STT_MAX_QUEUE", "20")))
+STT_TIMEOUT = max(5, int(os.getenv("STT_TIMEOUT", "30")))
+# Движок распознавания: google (веб-API через SpeechRecognition) или vosk (локально, модель из VOSK_MODEL_PATH)
+STT_BACKEND = os.getenv("STT_BACKEND", "google").strip().lower()
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", "").strip()
+# Длинные голосовые режутся по паузам на куски около STT_SEGMENT_SECONDS (не длиннее
+# STT_SEGMENT_MAX_SECONDS), которые распознаются параллельно и склеиваются по порядку
+STT_SEGMENT_SECONDS = max(5, int(os.getenv("STT_SEGMENT_SECONDS", "15")))
+STT_SEGMENT_MAX_SECONDS = max(STT_SEGMENT_SECONDS, int(os.getenv("STT_SEGMENT_MAX_SECONDS", "30")))
+# Кэш готовых изображений (по нормализованному промпту и модели): срок жизни (сек)
+# и предельный объем файлов на диске (МБ); IMAGE_CACHE_MAX_MB=0 выключает кэш
+IMAGE_CACHE_DIR = os.path.join(DATA_DIR, "image_cache")
+IMAGE_CACHE_TTL = max(60, int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600))))
+IMAGE_CACHE_MAX_MB = max(0, int(os.getenv("IMAGE_CACHE_MAX_MB", "256")))
 
 # Создаем директории
 os.makedirs(USERS_DIR, exist_ok=True)
@@ -542,13 +624,16 @@ def _image_retry_prompt_no_animals(prompt_text: str, attempt: int) -> str:
     return f"{base}. {suffix}"
 
 
-async def image_contains_animal(image_bytes: bytes) -> Optional[bool]:
+async def image_contains_animal(image_bytes: bytes, deadline: Optional["Deadline"] = None) -> Optional[bool]:
     """
     Проверить через vision API, есть ли на изображении животное.
     Возвращает True/False или None, если проверка недоступна.
     """
     if not API_BEARER_TOKEN or not image_bytes:
         return None
+    if deadline is not None and deadline.remaining() < Deadline.MIN_ATTEMPT_SECONDS:
+        # Бюджет почти исчерпан: лучше отдать картинку без проверки, чем ничего.
+        return None
     try:
         img_b64 = base64.b64encode(image_bytes).decode("utf-8")
         messages = [
@@ -569,34 +654,334 @@ async def image_contains_animal(image_bytes: bytes) -> Optional[bool]:
         ]
         payload = {"model": "gemini-3-flash", "request": {"messages": messages}}
         headers = {"Authorization": f"Bearer {API_BEARER_TOKEN}", "Content-Type": "application/json"}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_URL, json=payload, headers=headers, timeout=40) as response:
-                if response.status != 200:
-                    return None
-                data = await response.json()
-                raw = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                try:
-                    parsed = json.loads(raw)
-                    val = parsed.get("contains_animal")
-                    if isinstance(val, bool):
-                        return val
-                except Exception:
-                    raw_l = str(raw).lower()
-                    if '"contains_animal": true' in raw_l:
-                        return True
-                    if '"contains_animal": false' in raw_l:
-                        return False
+        session = get_http_session("onlysq")
+        timeout = deadline.timeout(40) if deadline is not None else 40
+        async with session.post(API_URL, json=payload, headers=headers, timeout=timeout) as response:
+            if response.status != 200:
+                return None
+            data = await response.json()
+            raw = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+            try:
+                parsed = json.loads(raw)
+                val = parsed.get("contains_animal")
+                if isinstance(val, bool):
+                    return val
+            except Exception:
+                raw_l = str(raw).lower()
+                if '"contains_animal": true' in raw_l:
+                    return True
+                if '"contains_animal": false' in raw_l:
+                    return False
         return None
     except Exception as e:
         logging.warning(f"Image validation skipped: {e}")
         return None
 
 
-async def generate_image_with_guard(user_id: int, prompt: str, model: str, max_attempts: int = 3) -> tuple:
+# ==================== БЮДЖЕТ ВРЕМЕНИ ЗАПРОСА ====================
+class Deadline:
+    """
+    Бюджет времени на один пользовательский запрос. Передается через всю цепочку вызовов:
+    таймауты HTTP сжимаются до остатка, а повторы, которые не успеют, не начинаются.
+    """
+
+    # Меньше этого остатка новую попытку не начинаем: она почти наверняка не успеет.
+    MIN_ATTEMPT_SECONDS = 5.0
+
+    def __init__(self, seconds: float, metric: Optional[str] = None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.metric = metric
+        self.exceeded = False
+        self.last_timeout = 0.0  # таймаут, выданный последнему вызову
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float) -> float:
+        """Таймаут для очередного вызова: не больше cap и не больше остатка бюджета"""
+        self.last_timeout = max(0.1, min(cap, self.remaining()))
+        return self.last_timeout
+
+    def describe_timeout(self) -> str:
+        """Сколько ждали последний вызов и каков весь бюджет — для сообщений об ошибке"""
+        return f"{self.last_timeout:.0f} сек из бюджета {self.seconds:.0f} сек"
+
+    def can_attempt(self, min_seconds: float = MIN_ATTEMPT_SECONDS) -> bool:
+        """Хватит ли времени на еще одну попытку; если нет — фиксируем превышение"""
+        if self.remaining() >= min_seconds:
+            return True
+        self.mark_exceeded()
+        return False
+
+    def mark_exceeded(self):
+        """Засчитать превышение бюджета (метрика — один раз на запрос)"""
+        if not self.exceeded:
+            self.exceeded = True
+            if self.metric:
+                increment_stat(self.metric)
+
+
+IMAGE_DEADLINE_MESSAGE = "✖️ Генерация заняла слишком много времени. Попробуйте еще раз чуть позже."
+
+
+def new_image_deadline() -> Deadline:
+    """Бюджет времени на одну генерацию изображения"""
+    return Deadline(IMAGE_DEADLINE_SECONDS, metric="image_deadline_exceeded")
+
+
+# ==================== ГОНКА КАНДИДАТОВ ====================
+async def race_first_success(factories: list, stagger: float, max_parallel: int,
+                             is_success: Callable[[Any], bool] = lambda result: bool(result[0])):
+    """
+    Запустить кандидатов (фабрики корутин) наперегонки: следующий стартует через stagger секунд
+    или сразу после неудачи предыдущего, одновременно работает не больше max_parallel.
+    Возвращает первый успешный результат (остальные отменяются) или результат последней неудачи.
+    """
+    queue = list(factories)
+    pending = set()
+    last_result = None
+
+    def _launch():
+        pending.add(asyncio.ensure_future(queue.pop(0)()))
+
+    try:
+        _launch()
+        while pending:
+            can_launch = bool(queue) and len(pending) < max_parallel
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=stagger if can_launch else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                _launch()
+                continue
+            for task in done:
+                pending.discard(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    result = (False, f"✖️ Ошибка: {e}")
+                if is_success(result):
+                    return result
+                last_result = result
+            # Освободившиеся места сразу занимаем следующими кандидатами.
+            while queue and len(pending) < max_parallel:
+                _launch()
+        return last_result
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+_image_provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _image_provider_semaphore(provider: str) -> asyncio.Semaphore:
+    semaphore = _image_provider_semaphores.get(provider)
+    if semaphore is None:
+        semaphore = _image_provider_semaphores[provider] = asyncio.Semaphore(IMAGE_PROVIDER_CONCURRENCY[provider])
+    return semaphore
+
+
+def image_provider_busy(provider: str) -> bool:
+    """Все слоты провайдера заняты (запасному запросу гонки ждать слот не стоит)"""
+    return _image_provider_semaphore(provider).locked()
+
+
+@asynccontextmanager
+async def image_provider_slot(provider: str, deadline: "Deadline"):
+    """Слот на запрос к провайдеру изображений (не больше IMAGE_PROVIDER_CONCURRENCY одновременно)"""
+    semaphore = _image_provider_semaphore(provider)
+    await asyncio.wait_for(semaphore.acquire(), timeout=deadline.remaining())
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+# ==================== ЗДОРОВЬЕ IMAGE-МОДЕЛЕЙ ====================
+class ModelHealth:
+    """
+    Скользящая статистика одной image-модели (успехи и задержки последних вызовов)
+    и автомат: closed -> open после серии неудач -> half_open (одна пробная попытка) после паузы.
+    Проба, завершившаяся без исхода (отмена, исчерпанный бюджет), возвращается через release_probe().
+    """
+
+    WINDOW = 20
+
+    def __init__(self):
+        self.results = deque(maxlen=self.WINDOW)
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.open_until = 0.0
+        self.last_error = ""
+        self.probe_in_flight = False
+
+    def available(self, now: float) -> bool:
+        """Можно ли планировать модель (не расходует пробную попытку)"""
+        if self.state == "open":
+            return now >= self.open_until
+        return True
+
+    def allow(self, now: float) -> bool:
+        """Разрешить вызов; в half_open пропускаем только одну пробу за раз"""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and now >= self.open_until:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def release_probe(self):
+        """Проба не дала исхода: пропустить следующую, цепь остается в half_open"""
+        if self.state == "half_open":
+            self.probe_in_flight = False
+
+    def record_success(self, latency: float):
+        self.probe_in_flight = False
+        self.results.append(True)
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.state = "closed"
+
+    def record_failure(self, latency: float, error: str = "", quota: bool = False):
+        self.probe_in_flight = False
+        self.results.append(False)
+        self.consecutive_failures += 1
+        self.last_error = error
+        if quota or self.state == "half_open" or self.consecutive_failures >= IMAGE_CIRCUIT_FAILURES:
+            cooldown = IMAGE_CIRCUIT_QUOTA_COOLDOWN if quota else IMAGE_CIRCUIT_COOLDOWN
+            self.state = "open"
+            self.open_until = time.monotonic() + cooldown
+
+    @property
+    def success_rate(self) -> Optional[float]:
+        if not self.results:
+            return None
+        return sum(self.results) / len(self.results)
+
+    @property
+    def p50_latency(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        return statistics.median(self.latencies)
+
+    @property
+    def p90_latency(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+
+_image_model_health: Dict[str, ModelHealth] = {}
+
+
+def get_model_health(model: str) -> ModelHealth:
+    """Запись здоровья для image-модели (создается при первом обращении)"""
+    health = _image_model_health.get(model)
+    if health is None:
+        health = _image_model_health[model] = ModelHealth()
+    return health
+
+
+def is_quota_error(text: str) -> bool:
+    """Ошибка исчерпанных кредитов/лимита расходов — ждать повтора нет смысла долго"""
+    lower = str(text).lower()
+    return "credits" in lower or "spending limit" in lower
+
+
+def record_image_result(model: str, started: float, ok: bool, error: str = "", status: Optional[int] = None):
+    """
+    Записать исход одного вызова image-модели (started — time.monotonic() до запроса,
+    status — HTTP-статус ответа, если он был).
+    """
+    latency = time.monotonic() - started
+    health = get_model_health(model)
+    if ok:
+        health.record_success(latency)
+    else:
+        was_open = health.state == "open"
+        health.record_failure(latency, error, quota=is_quota_error(error) or status == 401)
+        if health.state == "open" and not was_open:
+            logging.warning(f"🔌 Image-модель {model} отключена до восстановления: {error[:200]}")
+
+
+# Сколько успешных вызовов нужно, чтобы доверять наблюдаемой задержке модели
+IMAGE_RACE_MIN_SAMPLES = 5
+
+
+def race_stagger(model: str) -> float:
+    """
+    Через сколько секунд запускать запасного кандидата, если model еще не ответила:
+    по p90 ее наблюдаемой задержки (запасной стартует только у медленного хвоста ~10%
+    запросов), но не раньше IMAGE_RACE_STAGGER. Пока данных мало — IMAGE_RACE_STAGGER.
+    """
+    health = get_model_health(model)
+    if len(health.latencies) < IMAGE_RACE_MIN_SAMPLES:
+        return IMAGE_RACE_STAGGER
+    return max(IMAGE_RACE_STAGGER, health.p90_latency)
+
+
+def plan_image_models(first_model: str, candidates: list) -> list:
+    """
+    План перебора моделей: модели с открытой цепью пропускаются, выбранная пользователем
+    модель идет первой, остальные — по возрастанию наблюдаемой медианной задержки.
+    """
+    now = time.monotonic()
+    ordered = [first_model] + [m for m in candidates if m != first_model]
+    available = [m for m in ordered if get_model_health(m).available(now)]
+    if not available:
+        # Все цепи открыты: пробуем ту, что откроется раньше всех.
+        return [min(ordered, key=lambda m: get_model_health(m).open_until)]
+
+    head = available[:1] if available[0] == first_model else []
+    rest = available[len(head):]
+    rest.sort(key=lambda m: (
+        get_model_health(m).p50_latency is None,
+        get_model_health(m).p50_latency or 0.0,
+    ))
+    return head + rest
+
+
+def format_image_health() -> str:
+    """Краткая сводка по здоровью image-моделей для админки"""
+    lines = []
+    for model, health in sorted(_image_model_health.items()):
+        rate = health.success_rate
+        p50 = health.p50_latency
+        state = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}[health.state]
+        lines.append(
+            f"  {state} {model}: "
+            f"{'—' if rate is None else f'{rate * 100:.0f}%'} успехов, "
+            f"p50 {'—' if p50 is None else f'{p50:.1f}с'}, "
+            f"запасной через {race_stagger(model):.1f}с"
+        )
+    return "\n".join(lines)
+
+
+async def generate_image_with_guard(user_id: int, prompt: str, model: str, max_attempts: int = 3,
+                                    deadline: Optional[Deadline] = None,
+                                    on_produced: Optional[Callable[[str], Any]] = None) -> tuple:
     """
     Генерация с авто-проверкой:
     если пользователь не просил животных, но на картинке есть животное, делаем автоповтор.
+    Все модели и повторы укладываются в общий бюджет deadline (по умолчанию IMAGE_DEADLINE_SECONDS).
+    on_produced получает модель, которая на самом деле нарисовала возвращенную картинку.
     """
+    if deadline is None:
+        deadline = new_image_deadline()
     animal_allowed = prompt_requests_animals(prompt)
     last_error = "✖️ Не удалось сгенерировать изображение."
 
@@ -609,15 +994,28 @@ async def generate_image_with_guard(user_id: int, prompt: str, model: str, max_a
     else:
         preferred_order = ["flux", "flux-2-dev", "grok-2-image", "phoenix-1.0", "lucid-origin", "pollinations-flux-free"]
 
-    model_plan = [model]
-    for m in preferred_order:
-        if m in IMAGE_MODELS and m in enabled_models and m not in model_plan:
-            model_plan.append(m)
+    model_plan = plan_image_models(
+        model,
+        [m for m in preferred_order if m in IMAGE_MODELS and m in enabled_models]
+    )
 
-    for model_idx, current_model in enumerate(model_plan):
+    async def _run_model(current_model: str) -> tuple:
+        # (успех, результат, модель-автор): generate_image сама может уйти на запасную модель.
+        last_error = "✖️ Не удалось сгенерировать изображение."
         current_prompt = prompt
+        produced_by = current_model
+
+        def _note_producer(name: str):
+            nonlocal produced_by
+            produced_by = name
+
         for attempt in range(1, max_attempts + 1):
-            success, result = await generate_image(user_id, current_prompt, current_model)
+            if deadline.exceeded or not deadline.can_attempt():
+                logging.warning(f"Image deadline exceeded for user {user_id} (model={current_model})")
+                return False, IMAGE_DEADLINE_MESSAGE, current_model
+            success, result = await generate_image(
+                user_id, current_prompt, current_model, deadline=deadline, on_produced=_note_producer
+            )
             if not success:
                 last_error = result
                 # Если модель явно недоступна/лимитирована — сразу пробуем следующую модель.
@@ -628,27 +1026,264 @@ async def generate_image_with_guard(user_id: int, prompt: str, model: str, max_a
 
             # Если результат не bytes (например URL), пропускаем валидацию.
             if not isinstance(result, (bytes, bytearray)):
-                return True, result
+                return True, result, produced_by
 
             if animal_allowed:
-                return True, result
+                return True, result, produced_by
 
-            contains_animal = await image_contains_animal(bytes(result))
+            contains_animal = await image_contains_animal(bytes(result), deadline=deadline)
             if contains_animal is False:
-                return True, result
+                return True, result, produced_by
             if contains_animal is None:
                 # Валидация недоступна — не блокируем пользователя.
-                return True, result
+                return True, result, produced_by
 
             # contains_animal == True -> усиливаем негатив и пробуем еще.
             current_prompt = _image_retry_prompt_no_animals(prompt, attempt)
             last_error = "✖️ Модель упорно добавляет лишние объекты. Попробуйте уточнить запрос."
 
-        # Переход на следующую модель после серии неудач.
-        if model_idx < len(model_plan) - 1:
-            logging.warning(f"Switching image model fallback: {current_model} -> {model_plan[model_idx + 1]}")
+        logging.warning(f"Image model fallback: {current_model} не справилась, переходим к следующей")
+        return False, last_error, current_model
+
+    # При IMAGE_RACE_MODELS > 1 первые модели плана стартуют наперегонки, иначе — строго по очереди.
+    result = await race_first_success(
+        [functools.partial(_run_model, m) for m in model_plan],
+        stagger=race_stagger(model_plan[0]),
+        max_parallel=IMAGE_RACE_MODELS,
+    )
+    if not result:
+        return False, last_error
+    if result[0] and on_produced is not None:
+        on_produced(result[2])
+    return result[0], result[1]
+
+
+# ==================== КЭШ ИЗОБРАЖЕНИЙ ====================
+# Готовые картинки адресуются хэшем (нормализованный промпт + модель + политика seed).
+# Байты лежат в IMAGE_CACHE_DIR, метаданные и Telegram file_id — в таблице image_cache.
+# Одинаковые запросы, пришедшие одновременно, ждут одну общую генерацию (singleflight).
+# Запись кладется под ключ модели, которая на самом деле нарисовала картинку (а не запрошенной).
+# Повтор того же промпта тем же пользователем — просьба о новом варианте: кэш пропускается.
+IMAGE_SEED_POLICY = "random"
+IMAGE_SERVED_MEMORY = 10000
+_image_inflight: Dict[str, asyncio.Task] = {}
+# (user_id, ключ) картинок, уже выданных пользователю (LRU, только в памяти)
+_image_served: "OrderedDict[tuple, float]" = OrderedDict()
+
+
+def image_cache_enabled() -> bool:
+    return IMAGE_CACHE_MAX_MB > 0
+
+
+def image_cache_key(prompt: str, model: str) -> str:
+    """Ключ кэша: sha256 от нормализованного промпта, модели и политики seed"""
+    normalized = re.sub(r"\s+", " ", build_image_prompt(prompt)).strip().lower()
+    raw = f"{IMAGE_SEED_POLICY}\x00{model}\x00{normalized}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _image_cache_path(key: str) -> str:
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], f"{key}.jpg")
+
+
+def _remove_image_cache_file(key: str):
+    try:
+        os.remove(_image_cache_path(key))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"⚠️ Не удалось удалить файл кэша {key}: {e}")
+
+
+def _drop_image_cache_entries(keys: list):
+    for key in keys:
+        _remove_image_cache_file(key)
+        db_execute("DELETE FROM image_cache WHERE key = ?", (key,))
+
+
+def _read_image_cache(key: str):
+    """Достать запись из кэша: file_id (если уже отправляли) или байты; None — промах"""
+    rows = db_query("SELECT file_id, created_at FROM image_cache WHERE key = ?", (key,))
+    if not rows:
+        return None
+    file_id, created_at = rows[0]
+    now = time.time()
+    if now - created_at > IMAGE_CACHE_TTL:
+        _drop_image_cache_entries([key])
+        return None
+    db_execute("UPDATE image_cache SET last_used = ? WHERE key = ?", (now, key))
+    if file_id:
+        return file_id
+    try:
+        with open(_image_cache_path(key), "rb") as f:
+            return f.read()
+    except OSError:
+        _drop_image_cache_entries([key])
+        return None
+
+
+def _write_image_cache(key: str, model: str, data: bytes):
+    path = _image_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    now = time.time()
+    db_execute(
+        "INSERT INTO image_cache (key, model, size, file_id, created_at, last_used) "
+        "VALUES (?, ?, ?, NULL, ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET model = excluded.model, size = excluded.size, "
+        "file_id = NULL, created_at = excluded.created_at, last_used = excluded.last_used",
+        (key, model, len(data), now, now)
+    )
+    evict_image_cache()
+
+
+def evict_image_cache():
+    """
+    Удалить просроченные записи и ужать кэш до IMAGE_CACHE_MAX_MB (LRU по last_used).
+    Записи с известным file_id теряют только байты на диске: повторная отправка идет по file_id.
+    """
+    expired = db_query(
+        "SELECT key FROM image_cache WHERE created_at < ?",
+        (time.time() - IMAGE_CACHE_TTL,)
+    )
+    _drop_image_cache_entries([row[0] for row in expired])
+
+    limit = IMAGE_CACHE_MAX_MB * 1024 * 1024
+    total = db_query("SELECT COALESCE(SUM(size), 0) FROM image_cache")[0][0]
+    if total <= limit:
+        return
+    for key, size, file_id in db_query(
+        "SELECT key, size, file_id FROM image_cache WHERE size > 0 ORDER BY last_used ASC"
+    ):
+        if total <= limit:
+            break
+        if file_id:
+            _remove_image_cache_file(key)
+            db_execute("UPDATE image_cache SET size = 0 WHERE key = ?", (key,))
+        else:
+            _drop_image_cache_entries([key])
+        total -= size
+
+
+async def _generate_and_cache_image(user_id: int, prompt: str, model: str) -> tuple:
+    """Сгенерировать и положить в кэш под ключ модели-автора. Возвращает (success, result, cache_key)."""
+    produced_by = model
+
+    def _note_producer(name: str):
+        nonlocal produced_by
+        produced_by = name
+
+    success, result = await generate_image_with_guard(user_id, prompt, model, on_produced=_note_producer)
+    if not success or not isinstance(result, (bytes, bytearray)):
+        return success, result, None
+    key = image_cache_key(prompt, produced_by)
+    try:
+        await run_io(_write_image_cache, key, produced_by, bytes(result))
+    except Exception as e:
+        logging.warning(f"⚠️ Не удалось сохранить изображение в кэш: {e}")
+        return success, result, None
+    return success, result, key
+
+
+def _remember_image_served(user_id: int, key: Optional[str]):
+    if not key:
+        return
+    _image_served[(user_id, key)] = time.time()
+    _image_served.move_to_end((user_id, key))
+    while len(_image_served) > IMAGE_SERVED_MEMORY:
+        _image_served.popitem(last=False)
+
 
-    return False, last_error
+async def generate_image_cached(user_id: int, prompt: str, model: str, fresh: bool = False) -> tuple:
+    """
+    generate_image_with_guard через кэш. Возвращает (success, result, cache_key):
+    result — bytes или file_id; cache_key передается в remember_image_file_id после отправки.
+    fresh=True (или повтор уже выданного этому пользователю промпта) — новая генерация мимо кэша.
+    """
+    if not image_cache_enabled():
+        success, result = await generate_image_with_guard(user_id, prompt, model)
+        return success, result, None
+
+    key = image_cache_key(prompt, model)
+    if (user_id, key) in _image_served:
+        fresh = True
+        increment_stat("image_cache_retries")
+    if not fresh:
+        cached = await run_io(_read_image_cache, key)
+        if cached is not None:
+            increment_stat("image_cache_hits")
+            _remember_image_served(user_id, key)
+            return True, cached, key
+
+    task = _image_inflight.get(key)
+    if task is None:
+        increment_stat("image_cache_misses")
+        task = asyncio.create_task(_generate_and_cache_image(user_id, prompt, model))
+        _image_inflight[key] = task
+        task.add_done_callback(lambda _t: _image_inflight.pop(key, None))
+    else:
+        increment_stat("image_cache_coalesced")
+    # shield: отмена одного ожидающего не должна обрывать общую генерацию для остальных
+    success, result, stored_key = await asyncio.shield(task)
+    if success:
+        # Повтор запрошенного промпта — тоже повтор, даже если картинку нарисовала запасная модель.
+        _remember_image_served(user_id, key)
+        _remember_image_served(user_id, stored_key)
+    return success, result, stored_key
+
+
+def remember_image_file_id(cache_key: Optional[str], sent_message) -> None:
+    """Запомнить file_id отправленного фото, чтобы следующие попадания не загружали байты заново"""
+    if not cache_key or sent_message is None or not getattr(sent_message, "photo", None):
+        return
+    submit_io(
+        db_execute,
+        "UPDATE image_cache SET file_id = ? WHERE key = ? AND file_id IS NULL",
+        (sent_message.photo[-1].file_id, cache_key)
+    )
+
+
+def _forget_image_file_id(key: str) -> Optional[bytes]:
+    """Сбросить отвергнутый file_id; вернуть байты с диска или удалить запись, если их уже нет"""
+    db_execute("UPDATE image_cache SET file_id = NULL WHERE key = ?", (key,))
+    try:
+        with open(_image_cache_path(key), "rb") as f:
+            return f.read()
+    except OSError:
+        _drop_image_cache_entries([key])
+        return None
+
+
+async def send_generated_image(send: Callable[[Any], Awaitable], result, cache_key: Optional[str],
+                               user_id: int, prompt: str, model: str):
+    """
+    Отправить результат generate_image_cached: send(photo) — функция отправки.
+    Если Telegram отверг file_id из кэша (см. is_stale_file_id_error), file_id забывается и картинка
+    отправляется байтами с диска, а если их уже вытеснили — генерируется заново.
+    """
+    if isinstance(result, (bytes, bytearray)):
+        sent = await send(BufferedInputFile(bytes(result), filename="generated_image.jpg"))
+        remember_image_file_id(cache_key, sent)
+        return sent
+    try:
+        return await send(result)
+    except TelegramBadRequest as e:
+        if not cache_key or not is_stale_file_id_error(e):
+            raise
+        logging.warning(f"file_id из кэша изображений не принят, отправляем заново: {e}")
+    data = await run_io(_forget_image_file_id, cache_key)
+    if data is None:
+        success, data, cache_key = await generate_image_cached(user_id, prompt, model, fresh=True)
+        if not success:
+            raise RuntimeError(data)
+        if not isinstance(data, (bytes, bytearray)):
+            return await send(data)
+    sent = await send(BufferedInputFile(bytes(data), filename="generated_image.jpg"))
+    remember_image_file_id(cache_key, sent)
+    return sent
 
 
 def pick_image_model(user_id: int) -> Optional[str]:
@@ -711,6 +1346,111 @@ def validate_json_structure(value, depth: int = 0, max_depth: int = 8, max_items
             validate_json_structure(item, depth + 1, max_depth, max_items)
 
 
+# ==================== РЕЕСТР МЕДИА (file_id) ====================
+# После первой отправки локального файла или GIF по URL запоминаем file_id, который вернул Telegram,
+# и дальше шлем его вместо повторной загрузки. Локальные файлы привязаны к sha256 содержимого:
+# если файл заменили, отпечаток меняется и запись сама становится недействительной.
+_media_registry: Dict[str, tuple] = {}
+_media_fingerprints: Dict[str, tuple] = {}
+
+
+def init_media_registry():
+    """Загрузить реестр file_id в память (один раз при старте)"""
+    global _media_registry
+    _media_registry = {
+        source: (fingerprint, file_id)
+        for source, fingerprint, file_id in db_query("SELECT source, fingerprint, file_id FROM media_cache")
+    }
+
+
+def media_fingerprint(path: str) -> Optional[str]:
+    """sha256 файла; пересчитывается только при смене mtime/размера"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stat_key = (st.st_mtime_ns, st.st_size)
+    cached = _media_fingerprints.get(path)
+    if cached and cached[0] == stat_key:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()
+    _media_fingerprints[path] = (stat_key, fingerprint)
+    return fingerprint
+
+
+def get_media_file_id(source: str, fingerprint: str = "") -> Optional[str]:
+    entry = _media_registry.get(source)
+    if entry and entry[0] == fingerprint:
+        return entry[1]
+    return None
+
+
+def _sent_media_file_id(sent_message) -> Optional[str]:
+    """file_id из отправленного сообщения (GIF Telegram может вернуть как animation или document)"""
+    if sent_message is None:
+        return None
+    if getattr(sent_message, "animation", None):
+        return sent_message.animation.file_id
+    if getattr(sent_message, "photo", None):
+        return sent_message.photo[-1].file_id
+    if getattr(sent_message, "video", None):
+        return sent_message.video.file_id
+    if getattr(sent_message, "document", None):
+        return sent_message.document.file_id
+    return None
+
+
+def remember_media_file_id(source: str, fingerprint: str, sent_message):
+    file_id = _sent_media_file_id(sent_message)
+    if not file_id or _media_registry.get(source) == (fingerprint, file_id):
+        return
+    _media_registry[source] = (fingerprint, file_id)
+    submit_io(
+        db_execute,
+        "INSERT INTO media_cache (source, fingerprint, file_id, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(source) DO UPDATE SET fingerprint = excluded.fingerprint, "
+        "file_id = excluded.file_id, updated_at = excluded.updated_at",
+        (source, fingerprint, file_id, time.time())
+    )
+
+
+def forget_media_file_id(source: str):
+    if _media_registry.pop(source, None) is not None:
+        submit_io(db_execute, "DELETE FROM media_cache WHERE source = ?", (source,))
+
+
+def is_stale_file_id_error(error: Exception) -> bool:
+    """Telegram отверг сохраненный file_id (а не упал по другой причине — флуд, сеть, блокировка)"""
+    if not isinstance(error, TelegramBadRequest):
+        return False
+    lower = str(error).lower()
+    return "file identifier" in lower or "file_id" in lower or "file reference" in lower
+
+
+async def send_registered_media(send: Callable[..., Awaitable], source: str, upload, fingerprint: str = ""):
+    """
+    Отправить медиа через реестр: send(media) — функция отправки, upload — что грузить при промахе
+    (FSInputFile или URL). Если Telegram отверг сохраненный file_id, один раз повторяем с загрузкой;
+    остальные ошибки пробрасываются как есть.
+    """
+    file_id = get_media_file_id(source, fingerprint)
+    if file_id:
+        try:
+            return await send(file_id)
+        except TelegramBadRequest as e:
+            if not is_stale_file_id_error(e):
+                raise
+            logging.warning(f"file_id для {source} не принят, загружаем заново: {e}")
+            forget_media_file_id(source)
+    sent = await send(upload)
+    remember_media_file_id(source, fingerprint, sent)
+    return sent
+
+
 async def send_system_message(chat_id: int, text: str, reply_markup=None, parse_mode: str = "HTML"):
     """Отправить системное сообщение с GIF/анимацией в caption, если задана."""
     text = normalize_system_text(text)
@@ -723,8 +1463,7 @@ async def send_system_message(chat_id: int, text: str, reply_markup=None, parse_
 
     # Берем пул из config, если задан
     try:
-        config = load_config()
-        cfg_urls = config.get("system_gif_urls")
+        cfg_urls = _thaw(get_config().data.get("system_gif_urls"))
         if isinstance(cfg_urls, list):
             gif_pool = [str(u).strip() for u in cfg_urls if str(u).strip()]
     except Exception:
@@ -736,12 +1475,16 @@ async def send_system_message(chat_id: int, text: str, reply_markup=None, parse_
     if gif_pool:
         chosen_gif = random.choice(gif_pool)
         try:
-            await bot.send_animation(
-                chat_id=chat_id,
-                animation=chosen_gif,
-                caption=text,
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
+            await send_registered_media(
+                lambda media: bot.send_animation(
+                    chat_id=chat_id,
+                    animation=media,
+                    caption=text,
+                    reply_markup=reply_markup,
+                    parse_mode=parse_mode
+                ),
+                source=chosen_gif,
+                upload=chosen_gif,
             )
             return
         except Exception as e:
@@ -762,23 +1505,28 @@ async def send_section_media_message(chat_id: int, text: str, reply_markup, sect
     if not media_path or not os.path.exists(media_path):
         return False
     try:
-        media_file = FSInputFile(media_path)
+        fingerprint = await run_io(media_fingerprint, media_path)
+        if fingerprint is None:
+            return False
         if media_path.lower().endswith(".gif"):
-            await bot.send_animation(
-                chat_id=chat_id,
-                animation=media_file,
-                caption=text,
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
-            )
+            def send(media):
+                return bot.send_animation(
+                    chat_id=chat_id,
+                    animation=media,
+                    caption=text,
+                    reply_markup=reply_markup,
+                    parse_mode=parse_mode
+                )
         else:
-            await bot.send_photo(
-                chat_id=chat_id,
-                photo=media_file,
-                caption=text,
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
-            )
+            def send(media):
+                return bot.send_photo(
+                    chat_id=chat_id,
+                    photo=media,
+                    caption=text,
+                    reply_markup=reply_markup,
+                    parse_mode=parse_mode
+                )
+        await send_registered_media(send, source=media_path, upload=FSInputFile(media_path), fingerprint=fingerprint)
         return True
     except Exception as e:
         logging.warning(f"Не удалось отправить media для секции {section}: {e}")
@@ -1045,11 +1793,18 @@ def get_message(key: str, default: str = None, **kwargs) -> str:
 
 
 # ==================== РАБОТА С КОНФИГОМ ====================
-def load_config():
-    """Загрузить конфигурацию"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+# Конфиг читается из памяти: неизменяемый снимок заменяется целиком при save_config,
+# а внешняя правка config.json подхватывается по mtime (stat() не чаще раза в секунду).
+CONFIG_RECHECK_INTERVAL = 1.0
+
+
+class ConfigSnapshot(NamedTuple):
+    """Неизменяемый снимок config.json"""
+    data: Mapping[str, Any]
+    mtime: Optional[float]
+
+
+def _default_config() -> dict:
     return {
         "subscription_price": 100,  # Цена в звездах
         "subscription_price_usd": 5,  # Цена в USD для CryptoBot
@@ -1058,22 +1813,87 @@ def load_config():
     }
 
 
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, Mapping):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+def _config_mtime() -> Optional[float]:
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def _read_config_snapshot() -> ConfigSnapshot:
+    mtime = _config_mtime()
+    if mtime is None:
+        return ConfigSnapshot(_freeze(_default_config()), None)
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        return ConfigSnapshot(_freeze(json.load(f)), mtime)
+
+
+_config_snapshot: Optional[ConfigSnapshot] = None
+_config_checked_at = 0.0
+_config_lock = threading.Lock()
+
+
+def get_config() -> ConfigSnapshot:
+    """Текущий снимок конфигурации (без чтения файла, если он не менялся)"""
+    global _config_snapshot, _config_checked_at
+    now = time.monotonic()
+    snapshot = _config_snapshot
+    if snapshot is not None and now - _config_checked_at < CONFIG_RECHECK_INTERVAL:
+        return snapshot
+    with _config_lock:
+        _config_checked_at = now
+        if _config_snapshot is None or _config_mtime() != _config_snapshot.mtime:
+            try:
+                _config_snapshot = _read_config_snapshot()
+            except (OSError, ValueError) as e:
+                # Битый файл посреди ручной правки: оставляем прежний снимок.
+                if _config_snapshot is None:
+                    raise
+                logging.error(f"Не удалось перечитать конфиг: {e}")
+        return _config_snapshot
+
+
+def load_config():
+    """Загрузить конфигурацию (изменяемая копия для последующего save_config)"""
+    return _thaw(get_config().data)
+
+
 def save_config(config):
     """Сохранить конфигурацию"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=2)
+    global _config_snapshot, _config_checked_at
+    with _config_lock:
+        tmp_path = CONFIG_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, CONFIG_FILE)
+        _config_snapshot = ConfigSnapshot(_freeze(config), _config_mtime())
+        _config_checked_at = time.monotonic()
 
 
 def get_subscription_price():
     """Получить цену подписки в звездах"""
-    config = load_config()
-    return config.get("subscription_price", 100)
+    return get_config().data.get("subscription_price", 100)
 
 
 def get_subscription_price_usd():
     """Получить цену подписки в USD"""
-    config = load_config()
-    return config.get("subscription_price_usd", 5)
+    return get_config().data.get("subscription_price_usd", 5)
 
 
 def set_subscription_price(price: int):
@@ -1104,8 +1924,7 @@ DEFAULT_ENABLED_MODELS = [
 
 def get_enabled_models() -> list:
     """Получить список включенных моделей"""
-    config = load_config()
-    raw_models = config.get("enabled_models", DEFAULT_ENABLED_MODELS)
+    raw_models = _thaw(get_config().data.get("enabled_models", DEFAULT_ENABLED_MODELS))
     if not isinstance(raw_models, list):
         raw_models = DEFAULT_ENABLED_MODELS.copy()
 
@@ -1154,90 +1973,777 @@ def is_model_enabled(model: str) -> bool:
     return model in get_enabled_models()
 
 
-# ==================== РАБОТА СО СТАТИСТИКОЙ ====================
-def load_stats():
-    """Загрузить статистику"""
-    if os.path.exists(STATS_FILE):
-        with open(STATS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {
-        "total_users": 0,
-        "total_starts": 0,
-        "total_messages": 0,
-        "total_payments": 0,
-        "total_revenue": 0,
-        "total_revenue_usd": 0.0,
-        "paywall_shown": 0,
-        "subscription_clicked": 0,
-    }
+# ==================== ХРАНИЛИЩЕ (SQLite) ====================
+# Все горячие данные (пользователи, история, статистика, blacklist, инвойсы) живут в одной
+# SQLite-базе в режиме WAL: точечные UPSERT вместо перезаписи целых JSON-файлов.
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    username_lc TEXT,
+    subscription_end_ts REAL,
+    first_use_ts REAL
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT,
+    tokens INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (user_id, id);
+CREATE TABLE IF NOT EXISTS business_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    connection_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT,
+    tokens INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_business_history_chat ON business_history (connection_id, chat_id, id);
+CREATE TABLE IF NOT EXISTS history_summaries (
+    scope TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    covered_id INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value NUMERIC NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS blacklist (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS pending_invoices (
+    invoice_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS image_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    file_id TEXT,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_image_cache_lru ON image_cache (last_used);
+CREATE TABLE IF NOT EXISTS media_cache (
+    source TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL DEFAULT '',
+    file_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_db_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.RLock()
+
+
+def get_db() -> sqlite3.Connection:
+    """Получить общее соединение с SQLite (создается один раз на процесс)."""
+    global _db_conn
+    if _db_conn is None:
+        with _db_lock:
+            if _db_conn is None:
+                conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA busy_timeout=5000")
+                conn.executescript(_DB_SCHEMA)
+                _upgrade_users_table(conn)
+                _upgrade_history_tables(conn)
+                _db_conn = conn
+    return _db_conn
+
+
+# Вторичные индексы по записи пользователя: колонки заполняются из JSON при каждой записи.
+_USER_INDEX_COLUMNS = {
+    "username_lc": "TEXT",
+    "subscription_end_ts": "REAL",
+    "first_use_ts": "REAL",
+}
 
 
-def save_stats(stats):
-    """Сохранить статистику"""
-    with open(STATS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(stats, f, ensure_ascii=False, indent=2)
+def _iso_to_ts(value) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (ValueError, TypeError):
+        return None
 
 
-def increment_stat(key: str, value=1):
-    """Увеличить значение статистики (value: int или float)"""
-    stats = load_stats()
-    stats[key] = stats.get(key, 0) + value
-    save_stats(stats)
+def _user_index_values(data: dict) -> tuple:
+    """(username_lc, subscription_end_ts, first_use_ts) для записи пользователя"""
+    username = data.get("username")
+    return (
+        str(username).lower() if username else None,
+        _iso_to_ts(data.get("subscription_end")),
+        _iso_to_ts(data.get("first_use_time")),
+    )
 
-# ==================== РАБОТА С БИЗНЕС-ПОДКЛЮЧЕНИЯМИ ====================
-def load_business_connections():
-    """Загрузить бизнес-подключения из файла"""
-    if os.path.exists(BUSINESS_CONNECTIONS_FILE):
-        try:
-            with open(BUSINESS_CONNECTIONS_FILE, 'r', encoding='utf-8') as f:
-                connections = json.load(f)
-                logging.info(f"✅ Загружено {len(connections)} бизнес-подключений")
-                return connections
-        except Exception as e:
-            logging.error(f"❌ Ошибка загрузки подключений: {e}")
-            return {}
-    return {}
 
+def _upgrade_users_table(conn: sqlite3.Connection):
+    # Базы, созданные до появления индексных колонок: добавляем их и заполняем из JSON.
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    missing = [name for name in _USER_INDEX_COLUMNS if name not in existing]
+    for name in missing:
+        conn.execute(f"ALTER TABLE users ADD COLUMN {name} {_USER_INDEX_COLUMNS[name]}")
+    if missing:
+        rows = []
+        for user_id, raw in conn.execute("SELECT user_id, data FROM users").fetchall():
+            try:
+                rows.append((*_user_index_values(json.loads(raw)), user_id))
+            except ValueError:
+                continue
+        conn.execute("BEGIN")
+        conn.executemany(
+            "UPDATE users SET username_lc = ?, subscription_end_ts = ?, first_use_ts = ? WHERE user_id = ?",
+            rows
+        )
+        conn.execute("COMMIT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username_lc)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users (subscription_end_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_first_use ON users (first_use_ts)")
 
-def save_business_connections(connections):
-    """Сохранить бизнес-подключения в файл"""
-    try:
-        with open(BUSINESS_CONNECTIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(connections, f, ensure_ascii=False, indent=2)
-        logging.info(f"💾 Сохранено {len(connections)} бизнес-подключений")
-    except Exception as e:
-        logging.error(f"❌ Ошибка сохранения подключений: {e}")
 
+def _upgrade_history_tables(conn: sqlite3.Connection):
+    # Оценка токенов хранится вместе с сообщением; у старых строк колонка пустая
+    # и считается при чтении (такие строки и так уйдут при уплотнении истории).
+    for table in ("chat_history", "business_history"):
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if "tokens" not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN tokens INTEGER")
 
-def add_business_connection(connection_id: str, user_id: int):
-    """Добавить бизнес-подключение"""
-    business_connections[connection_id] = user_id
-    save_business_connections(business_connections)
 
-# ==================== РАБОТА С ПОЛЬЗОВАТЕЛЯМИ ====================
-def get_user_dir(user_id: int) -> str:
-    """Получить директорию пользователя"""
-    user_dir = os.path.join(USERS_DIR, str(user_id))
-    os.makedirs(user_dir, exist_ok=True)
-    return user_dir
+def db_query(sql: str, params: tuple = ()) -> list:
+    """Выполнить запрос и вернуть все строки."""
+    with _db_lock:
+        return get_db().execute(sql, params).fetchall()
 
 
-def get_user_data_path(user_id: int) -> str:
-    """Получить путь к данным пользователя"""
-    return os.path.join(get_user_dir(user_id), "user_data.json")
+def db_execute(sql: str, params: tuple = ()):
+    """Выполнить одиночную команду (autocommit)."""
+    with _db_lock:
+        get_db().execute(sql, params)
 
 
-def get_user_history_path(user_id: int) -> str:
-    """Получить путь к истории чата пользователя"""
-    return os.path.join(get_user_dir(user_id), "chat_history.json")
+@contextmanager
+def db_transaction():
+    """Транзакция из нескольких команд: все или ничего."""
+    with _db_lock:
+        conn = get_db()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
 
-def load_user_data(user_id: int) -> dict:
-    """Загрузить данные пользователя"""
-    path = get_user_data_path(user_id)
-    if os.path.exists(path):
+def close_db():
+    """Закрыть соединение с базой (при остановке бота)."""
+    global _db_conn
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+
+def get_meta(key: str) -> Optional[str]:
+    rows = db_query("SELECT value FROM meta WHERE key = ?", (key,))
+    return rows[0][0] if rows else None
+
+
+def set_meta(key: str, value: str):
+    db_execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+
+
+def _read_legacy_json(path: str, default):
+    """Прочитать старый JSON-файл; битые файлы пропускаем, а не роняем миграцию."""
+    if not os.path.exists(path):
+        return default
+    try:
         with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
+    except Exception as e:
+        logging.warning(f"Миграция: не удалось прочитать {path}: {e}")
+        return default
+
+
+def _history_rows(history) -> list:
+    if not isinstance(history, list):
+        return []
+    return [
+        (str(m.get("role", "")), str(m.get("content", "")), m.get("timestamp"))
+        for m in history[-50:]
+        if isinstance(m, dict) and m.get("role")
+    ]
+
+
+def migrate_json_storage() -> dict:
+    """
+    Одноразовый перенос старого дерева JSON-файлов в SQLite.
+    Исходные файлы не удаляются — их можно убрать вручную после проверки.
+    """
+    counts = {"users": 0, "chat_history": 0, "business_history": 0, "blacklist": 0, "pending_invoices": 0}
+
+    if os.path.isdir(USERS_DIR):
+        for user_dir in os.listdir(USERS_DIR):
+            try:
+                user_id = int(user_dir)
+            except ValueError:
+                continue
+            base = os.path.join(USERS_DIR, user_dir)
+            user_data = _read_legacy_json(os.path.join(base, "user_data.json"), None)
+            history_rows = _history_rows(_read_legacy_json(os.path.join(base, "chat_history.json"), []))
+            with db_transaction() as conn:
+                if isinstance(user_data, dict):
+                    user_data["user_id"] = user_id
+                    conn.execute(
+                        "INSERT OR REPLACE INTO users "
+                        "(user_id, data, username_lc, subscription_end_ts, first_use_ts) VALUES (?, ?, ?, ?, ?)",
+                        _user_row(user_id, user_data)
+                    )
+                    counts["users"] += 1
+                if history_rows:
+                    conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+                    conn.executemany(
+                        "INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                        [(user_id, *row) for row in history_rows]
+                    )
+                    counts["chat_history"] += len(history_rows)
+
+    business_dir = os.path.join(DATA_DIR, "business_chats")
+    if os.path.isdir(business_dir):
+        for name in os.listdir(business_dir):
+            if not name.endswith(".json"):
+                continue
+            connection_id, _, chat_part = name[:-len(".json")].rpartition("_")
+            try:
+                chat_id = int(chat_part)
+            except ValueError:
+                continue
+            history_rows = _history_rows(_read_legacy_json(os.path.join(business_dir, name), []))
+            if not connection_id or not history_rows:
+                continue
+            with db_transaction() as conn:
+                conn.execute(
+                    "DELETE FROM business_history WHERE connection_id = ? AND chat_id = ?",
+                    (connection_id, chat_id)
+                )
+                conn.executemany(
+                    "INSERT INTO business_history (connection_id, chat_id, role, content, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(connection_id, chat_id, *row) for row in history_rows]
+                )
+            counts["business_history"] += len(history_rows)
+
+    stats = _read_legacy_json(STATS_FILE, {})
+    blacklist = _read_legacy_json(BLACKLIST_FILE, [])
+    invoices = _read_legacy_json(PENDING_INVOICES_FILE, {})
+    with db_transaction() as conn:
+        if isinstance(stats, dict):
+            conn.executemany(
+                "INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+                [(str(k), v) for k, v in stats.items() if isinstance(v, (int, float))]
+            )
+        if isinstance(blacklist, list):
+            conn.executemany(
+                "INSERT OR IGNORE INTO blacklist (user_id) VALUES (?)",
+                [(int(uid),) for uid in blacklist if str(uid).lstrip("-").isdigit()]
+            )
+            counts["blacklist"] = len(blacklist)
+        if isinstance(invoices, dict):
+            conn.executemany(
+                "INSERT OR REPLACE INTO pending_invoices (invoice_id, user_id, created_at) VALUES (?, ?, ?)",
+                [
+                    (str(inv_id), int(inv["user_id"]), inv.get("created_at"))
+                    for inv_id, inv in invoices.items()
+                    if isinstance(inv, dict) and "user_id" in inv
+                ]
+            )
+            counts["pending_invoices"] = len(invoices)
+
+    set_meta("json_migrated_at", datetime.now().isoformat())
+    return counts
+
+
+def ensure_storage_migrated():
+    """Запустить миграцию JSON -> SQLite, если она еще не выполнялась."""
+    if get_meta("json_migrated_at"):
+        return
+    counts = migrate_json_storage()
+    logging.info(f"📦 Миграция JSON -> SQLite завершена: {counts}")
+
+
+# ==================== ФОНОВЫЙ ВВОД-ВЫВОД ====================
+# Блокирующие обращения к диску выполняются в отдельном ограниченном пуле потоков,
+# а хендлеры только ждут результат через await run_io(...).
+_io_executor: Optional[ThreadPoolExecutor] = None
+
+loop_lag_stats = {
+    "last_ms": 0.0,
+    "avg_ms": 0.0,
+    "max_ms": 0.0,
+    "slow_ticks": 0,
+}
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    """Получить пул потоков для ввода-вывода (создается при первом обращении)."""
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="bot-io")
+    return _io_executor
+
+
+async def run_io(func, *args, **kwargs):
+    """Выполнить блокирующую функцию в пуле ввода-вывода и дождаться результата."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_io_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _log_io_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Ошибка фоновой записи: {future.exception()}")
+
+
+def submit_io(func, *args, **kwargs):
+    """Отправить запись в пул ввода-вывода, не дожидаясь ее завершения."""
+    get_io_executor().submit(func, *args, **kwargs).add_done_callback(_log_io_error)
+
+
+def shutdown_io_executor():
+    """Дождаться фоновых записей и остановить пул (при остановке бота)."""
+    global _io_executor
+    if _io_executor is not None:
+        _io_executor.shutdown(wait=True)
+        _io_executor = None
+
+
+async def loop_lag_monitor():
+    """Замер задержки event loop: насколько позже срабатывает sleep(LOOP_LAG_INTERVAL)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag_ms = max(0.0, (loop.time() - started - LOOP_LAG_INTERVAL) * 1000)
+        loop_lag_stats["last_ms"] = lag_ms
+        loop_lag_stats["avg_ms"] = loop_lag_stats["avg_ms"] * 0.9 + lag_ms * 0.1
+        loop_lag_stats["max_ms"] = max(loop_lag_stats["max_ms"], lag_ms)
+        if lag_ms >= LOOP_LAG_WARN_MS:
+            loop_lag_stats["slow_ticks"] += 1
+            logging.warning(f"🐢 Event loop заблокирован на {lag_ms:.0f} мс")
+
+
+# ==================== РАБОТА СО СТАТИСТИКОЙ ====================
+DEFAULT_STATS = {
+    "total_users": 0,
+    "total_starts": 0,
+    "total_messages": 0,
+    "total_payments": 0,
+    "total_revenue": 0,
+    "total_revenue_usd": 0.0,
+    "paywall_shown": 0,
+    "subscription_clicked": 0,
+}
+
+
+class StatSeries:
+    """Скользящие ряды одного счетчика: 60 минутных и 48 часовых корзин (кольцевые буферы)."""
+
+    MINUTES = 60
+    HOURS = 48
+
+    def __init__(self):
+        self.minutes = array("d", bytes(8 * self.MINUTES))
+        self.hours = array("d", bytes(8 * self.HOURS))
+        now = int(time.time())
+        self.minute = now // 60
+        self.hour = now // 3600
+
+    @staticmethod
+    def _advance(ring: array, current: int, target: int) -> int:
+        # Обнуляем корзины, которые пропустили с прошлого обращения.
+        for bucket in range(current + 1, min(target, current + len(ring)) + 1):
+            ring[bucket % len(ring)] = 0.0
+        return max(current, target)
+
+    def _roll(self, now: float):
+        self.minute = self._advance(self.minutes, self.minute, int(now) // 60)
+        self.hour = self._advance(self.hours, self.hour, int(now) // 3600)
+
+    def add(self, value, now: float):
+        self._roll(now)
+        self.minutes[self.minute % self.MINUTES] += value
+        self.hours[self.hour % self.HOURS] += value
+
+    def last_minutes(self, count: int, now: float) -> float:
+        """Сумма за последние count минут (включая текущую)"""
+        self._roll(now)
+        count = min(count, self.MINUTES)
+        return sum(self.minutes[(self.minute - i) % self.MINUTES] for i in range(count))
+
+    def last_hours(self, count: int, now: float) -> float:
+        """Сумма за последние count часов (включая текущий)"""
+        self._roll(now)
+        count = min(count, self.HOURS)
+        return sum(self.hours[(self.hour - i) % self.HOURS] for i in range(count))
+
+
+# Реестр счетчиков: прибавки копятся в _stat_deltas и сбрасываются в базу пачкой,
+# а ряды _stat_series живут только в памяти процесса (для скоростей и воронок в админке).
+_stat_deltas: Dict[str, float] = {}
+_stat_series: Dict[str, StatSeries] = {}
+_stats_lock = threading.Lock()
+# Держится на всем сбросе (снятие прибавок + запись) и на чтении в load_stats,
+# чтобы прибавка не попала в сумму дважды — из базы и из _stat_deltas.
+# increment_stat его не берет и на время записи в базу не блокируется.
+_stats_flush_lock = threading.Lock()
+
+
+def load_stats():
+    """Загрузить статистику"""
+    stats = DEFAULT_STATS.copy()
+    with _stats_flush_lock:
+        rows = db_query("SELECT key, value FROM stats")
+        with _stats_lock:
+            deltas = list(_stat_deltas.items())
+    stats.update({key: value for key, value in rows})
+    for key, value in deltas:
+        stats[key] = stats.get(key, 0) + value
+    return stats
+
+
+def save_stats(stats):
+    """Сохранить статистику"""
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+            list(stats.items())
+        )
+
+
+def increment_stat(key: str, value=1):
+    """Увеличить значение статистики (value: int или float)"""
+    now = time.time()
+    with _stats_lock:
+        _stat_deltas[key] = _stat_deltas.get(key, 0) + value
+        series = _stat_series.get(key)
+        if series is None:
+            series = _stat_series[key] = StatSeries()
+        series.add(value, now)
+
+
+def get_stat_window(key: str, minutes: int = 0, hours: int = 0) -> float:
+    """Сумма счетчика за последние minutes минут или hours часов (с момента запуска бота)"""
+    with _stats_lock:
+        series = _stat_series.get(key)
+        if series is None:
+            return 0
+        now = time.time()
+        return series.last_hours(hours, now) if hours else series.last_minutes(minutes, now)
+
+
+def flush_stats() -> int:
+    """Сбросить накопленные прибавки счетчиков в базу одной транзакцией"""
+    with _stats_flush_lock:
+        with _stats_lock:
+            deltas = list(_stat_deltas.items())
+            _stat_deltas.clear()
+        if not deltas:
+            return 0
+        try:
+            with db_transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO stats (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                    deltas
+                )
+        except Exception:
+            # Вернем прибавки обратно, чтобы не потерять их при следующем сбросе.
+            with _stats_lock:
+                for key, value in deltas:
+                    _stat_deltas[key] = _stat_deltas.get(key, 0) + value
+            raise
+    return len(deltas)
+
+
+async def stats_flush_loop():
+    """Фоновый сброс счетчиков статистики."""
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            await run_io(flush_stats)
+        except Exception as e:
+            logging.error(f"Ошибка сброса статистики: {e}")
+
+
+def flush_stats_on_shutdown():
+    """Последний сброс счетчиков при остановке: одна повторная попытка, затем только лог.
+
+    Ошибка здесь не должна мешать остальным шагам остановки (сброс кэша пользователей,
+    закрытие базы), поэтому исключение не пробрасывается.
+    """
+    for attempt in (1, 2):
+        try:
+            flush_stats()
+            return
+        except Exception:
+            logging.exception(f"Ошибка сброса статистики при остановке (попытка {attempt})")
+    with _stats_lock:
+        lost = dict(_stat_deltas)
+    if lost:
+        logging.error(f"Несохраненные прибавки статистики потеряны: {lost}")
+
+# ==================== РАБОТА С БИЗНЕС-ПОДКЛЮЧЕНИЯМИ ====================
+def load_business_connections():
+    """Загрузить бизнес-подключения из файла"""
+    if os.path.exists(BUSINESS_CONNECTIONS_FILE):
+        try:
+            with open(BUSINESS_CONNECTIONS_FILE, 'r', encoding='utf-8') as f:
+                connections = json.load(f)
+                logging.info(f"✅ Загружено {len(connections)} бизнес-подключений")
+                return connections
+        except Exception as e:
+            logging.error(f"❌ Ошибка загрузки подключений: {e}")
+            return {}
+    return {}
+
+
+def save_business_connections(connections):
+    """Сохранить бизнес-подключения в файл"""
+    try:
+        with open(BUSINESS_CONNECTIONS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(connections, f, ensure_ascii=False, indent=2)
+        logging.info(f"💾 Сохранено {len(connections)} бизнес-подключений")
+    except Exception as e:
+        logging.error(f"❌ Ошибка сохранения подключений: {e}")
+
+
+def add_business_connection(connection_id: str, user_id: int):
+    """Добавить бизнес-подключение"""
+    business_connections[connection_id] = user_id
+    save_business_connections(business_connections)
+
+# ==================== КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ (на один апдейт) ====================
+class UserContext:
+    """
+    Запись пользователя, загруженная один раз на апдейт.
+    Все хелперы (подписка, триал, стиль, модель) получают ее через load_user_data,
+    который внутри апдейта отдает ctx.data, а изменения записываются в базу
+    один раз — после завершения хендлера.
+    """
+
+    def __init__(self, user_id: int, data: dict):
+        self.user_id = user_id
+        self.data = data
+        self.dirty = False
+        self.closed = False
+
+    def close(self):
+        """Завершить апдейт: передать изменения (если были) в write-back кэш."""
+        self.closed = True
+        if self.dirty:
+            self.dirty = False
+            cache_user_data(self.user_id, self.data, dirty=True)
+
+
+_current_user_ctx: ContextVar[Optional[UserContext]] = ContextVar("current_user_ctx", default=None)
+
+
+def get_user_context(user_id: int) -> Optional[UserContext]:
+    """Вернуть активный контекст апдейта, если он относится к этому пользователю."""
+    ctx = _current_user_ctx.get()
+    if ctx is None or ctx.closed or ctx.user_id != user_id:
+        return None
+    return ctx
+
+
+def _resolve_update_user_id(data: Dict[str, Any]) -> Optional[int]:
+    """Чью запись грузить: для бизнес-чатов — владельца подключения, иначе — автора апдейта."""
+    event_context = data.get("event_context")
+    business_connection_id = getattr(event_context, "business_connection_id", None)
+    if business_connection_id:
+        return business_connections.get(business_connection_id)
+    user = data.get("event_from_user")
+    return user.id if user else None
+
+
+class UserContextLoaderMiddleware(BaseMiddleware):
+    """Outer-middleware: один UserContext на апдейт, одна запись после хендлера."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user_id = _resolve_update_user_id(data)
+        if user_id is None:
+            return await handler(event, data)
+
+        user_data = get_cached_user_data(user_id)
+        if user_data is None:
+            user_data = await load_user_data_async(user_id)
+        ctx = UserContext(user_id, user_data)
+        token = _current_user_ctx.set(ctx)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_user_ctx.reset(token)
+            try:
+                ctx.close()
+            except Exception as e:
+                logging.error(f"Не удалось сохранить данные пользователя {user_id}: {e}")
+
+
+dp.update.outer_middleware(UserContextLoaderMiddleware())
+
+
+# ==================== РАБОТА С ПОЛЬЗОВАТЕЛЯМИ ====================
+# Write-back кэш: чтения идут из памяти, записи только помечают запись «грязной»,
+# а на диск их сбрасывает фоновая задача раз в USER_FLUSH_INTERVAL и при остановке.
+_user_cache: "OrderedDict[int, dict]" = OrderedDict()
+_dirty_user_ids = set()
+# Записи новых пользователей, которых еще нет в базе (кэшированы, но не сохранены)
+_new_user_ids = set()
+_user_cache_lock = threading.RLock()
+# Загрузки из базы «в полете»: параллельные апдейты одного пользователя ждут одну загрузку
+_user_loads: Dict[int, asyncio.Future] = {}
+
+
+def cache_user_data(user_id: int, data: dict, dirty: bool = False):
+    """
+    Положить запись в LRU-кэш (только из потока event loop).
+    Грязные записи не вытесняются — их заберет ближайший сброс, после чего они
+    станут обычными кандидатами на вытеснение. Так сериализация остается в потоке loop.
+    """
+    with _user_cache_lock:
+        _user_cache[user_id] = data
+        _user_cache.move_to_end(user_id)
+        if dirty:
+            _dirty_user_ids.add(user_id)
+            _new_user_ids.discard(user_id)
+        excess = len(_user_cache) - USER_CACHE_SIZE
+        if excess <= 0:
+            return
+        victims = []
+        for old_id in _user_cache:
+            if old_id != user_id and old_id not in _dirty_user_ids:
+                victims.append(old_id)
+                if len(victims) >= excess:
+                    break
+        for old_id in victims:
+            del _user_cache[old_id]
+            _new_user_ids.discard(old_id)
+
+
+def _user_row(user_id: int, data: dict) -> tuple:
+    return (user_id, json.dumps(data, ensure_ascii=False), *_user_index_values(data))
+
+
+def _write_user_rows(rows: list):
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, data, username_lc, subscription_end_ts, first_use_ts) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, username_lc = excluded.username_lc, "
+            "subscription_end_ts = excluded.subscription_end_ts, first_use_ts = excluded.first_use_ts",
+            rows
+        )
+
+
+def _take_dirty_user_rows() -> list:
+    # Сериализация выполняется в потоке event loop: только он меняет записи в кэше.
+    with _user_cache_lock:
+        rows = [
+            _user_row(user_id, _user_cache[user_id])
+            for user_id in _dirty_user_ids
+            if user_id in _user_cache
+        ]
+        _dirty_user_ids.clear()
+    return rows
+
+
+def _requeue_dirty_user_rows(rows: list):
+    # Не теряем изменения: вернем записи в очередь на следующий сброс.
+    with _user_cache_lock:
+        _dirty_user_ids.update(row[0] for row in rows if row[0] in _user_cache)
+
+
+def flush_user_cache() -> int:
+    """Сбросить грязные записи на диск одной транзакцией. Возвращает число записей."""
+    rows = _take_dirty_user_rows()
+    if not rows:
+        return 0
+    try:
+        _write_user_rows(rows)
+    except Exception:
+        _requeue_dirty_user_rows(rows)
+        raise
+    return len(rows)
+
+
+async def flush_user_cache_async() -> int:
+    """То же, что flush_user_cache, но запись на диск идет в пуле ввода-вывода."""
+    rows = _take_dirty_user_rows()
+    if not rows:
+        return 0
+    try:
+        await run_io(_write_user_rows, rows)
+    except Exception:
+        _requeue_dirty_user_rows(rows)
+        raise
+    return len(rows)
+
+
+async def user_cache_flush_loop():
+    """Фоновый сброс write-back кэша пользователей."""
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        try:
+            await flush_user_cache_async()
+        except Exception as e:
+            logging.error(f"Ошибка сброса кэша пользователей: {e}")
+
+
+def get_cached_user_data(user_id: int) -> Optional[dict]:
+    """Запись пользователя из кэша без обращения к диску (None, если ее там нет)."""
+    with _user_cache_lock:
+        data = _user_cache.get(user_id)
+        if data is not None:
+            _user_cache.move_to_end(user_id)
+        return data
+
+
+def user_exists(user_id: int) -> bool:
+    """Есть ли сохраненная запись пользователя"""
+    with _user_cache_lock:
+        if user_id in _user_cache and user_id not in _new_user_ids:
+            return True
+    return bool(db_query("SELECT 1 FROM users WHERE user_id = ?", (user_id,)))
+
+
+def _read_user_record(user_id: int) -> Optional[dict]:
+    """Прочитать запись из базы без кэширования (можно вызывать из пула ввода-вывода)."""
+    rows = db_query("SELECT data FROM users WHERE user_id = ?", (user_id,))
+    return json.loads(rows[0][0]) if rows else None
+
+
+def _default_user_record(user_id: int) -> dict:
     return {
         "user_id": user_id,
         "model": DEFAULT_MODEL,
@@ -1248,126 +2754,400 @@ def load_user_data(user_id: int) -> dict:
     }
 
 
+def _cache_loaded_user(user_id: int, user_data: Optional[dict]) -> dict:
+    """Положить прочитанную запись в кэш; если за время чтения там уже появилась — вернуть ее."""
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached is not None:
+            _user_cache.move_to_end(user_id)
+            return cached
+        if user_data is None:
+            # Новый пользователь: кэшируем запись по умолчанию, чтобы параллельные
+            # апдейты меняли один и тот же dict, но user_exists по-прежнему смотрит в базу.
+            user_data = _default_user_record(user_id)
+            _new_user_ids.add(user_id)
+        cache_user_data(user_id, user_data)
+        return user_data
+
+
+def load_user_data(user_id: int) -> dict:
+    """Загрузить данные пользователя"""
+    ctx = get_user_context(user_id)
+    if ctx is not None:
+        return ctx.data
+    cached = get_cached_user_data(user_id)
+    if cached is not None:
+        return cached
+    return _cache_loaded_user(user_id, _read_user_record(user_id))
+
+
+async def load_user_data_async(user_id: int) -> dict:
+    """
+    Загрузить запись пользователя, не блокируя event loop.
+    Чтение из базы идет в пуле ввода-вывода, а параллельные загрузки одного
+    пользователя объединяются в одну: все апдейты получают один и тот же dict.
+    """
+    cached = get_cached_user_data(user_id)
+    if cached is not None:
+        return cached
+    future = _user_loads.get(user_id)
+    if future is None:
+        future = asyncio.ensure_future(run_io(_read_user_record, user_id))
+        _user_loads[user_id] = future
+        future.add_done_callback(
+            lambda done: _user_loads.pop(user_id, None) if _user_loads.get(user_id) is done else None
+        )
+    user_data = await asyncio.shield(future)
+    return _cache_loaded_user(user_id, user_data)
+
+
 def save_user_data(user_id: int, data: dict):
     """Сохранить данные пользователя"""
-    path = get_user_data_path(user_id)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    ctx = get_user_context(user_id)
+    if ctx is not None:
+        # Запись отложена до конца обработки апдейта (см. UserContextLoaderMiddleware).
+        ctx.data = data
+        ctx.dirty = True
+        return
+    cache_user_data(user_id, data, dirty=True)
+
+
+# История — журнал только на добавление: одно сообщение = один INSERT,
+# хвост читается через индекс (user_id, id) без чтения всей истории,
+# а лимит HISTORY_MAX_MESSAGES применяется фоновым уплотнением.
+_history_compaction_pending = set()
+_business_compaction_pending = set()
+_history_compaction_lock = threading.Lock()
+
+
+# Оценка токенов без токенизатора: латиница и цифры ~3 символа на токен, кириллица и прочее ~2.
+# Оценка намеренно с запасом — бюджет окна не должен превышаться.
+MESSAGE_TOKEN_OVERHEAD = 4
+IMAGE_TOKEN_ESTIMATE = 800
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 2) // 3 + (len(text) - ascii_chars + 1) // 2
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """Оценка токенов сообщения API вместе со служебными токенами роли"""
+    content = message.get("content")
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += estimate_tokens(part.get("text", ""))
+        return MESSAGE_TOKEN_OVERHEAD + tokens
+    return MESSAGE_TOKEN_OVERHEAD + estimate_tokens(content or "")
+
+
+def context_token_budget(model: str) -> int:
+    return CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGETS["deepseek-chat"])
+
+
+def history_token_budget(model: str, fixed_messages: list) -> int:
+    """Сколько токенов остается на историю после системных сообщений и текущего вопроса"""
+    fixed = sum(estimate_message_tokens(m) for m in fixed_messages)
+    return max(0, context_token_budget(model) - fixed)
+
+
+def add_summary_within_budget(model: str, messages: list, user_entry: dict,
+                              summary_entry: Optional[dict]) -> int:
+    """
+    Добавить резюме к системным сообщениям и вернуть бюджет на историю. Если с резюме
+    на историю остается меньше HISTORY_TOKEN_FLOOR (большая персона), резюме не добавляется:
+    свежие сообщения важнее пересказа старых, а выходить за бюджет нельзя.
+    """
+    token_budget = history_token_budget(model, messages + [user_entry])
+    if summary_entry:
+        with_summary = token_budget - estimate_message_tokens(summary_entry)
+        if with_summary >= HISTORY_TOKEN_FLOOR:
+            messages.append(summary_entry)
+            return with_summary
+    return token_budget
+
+
+def fit_history_to_budget(history: list, token_budget: Optional[int]) -> list:
+    """
+    Взять самые свежие сообщения, пока их сумма токенов влезает в бюджет.
+    """
+    if token_budget is None:
+        return history
+    used = 0
+    start = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        tokens = MESSAGE_TOKEN_OVERHEAD + history[index]["tokens"]
+        if used + tokens > token_budget:
+            break
+        used += tokens
+        start = index
+    return history[start:]
+
+
+def _history_rows_to_dicts(rows: list) -> list:
+    rows.reverse()
+    return [
+        {
+            "role": role,
+            "content": content,
+            "timestamp": ts,
+            "tokens": estimate_tokens(content) if tokens is None else tokens,
+        }
+        for role, content, ts, tokens in rows
+    ]
+
+
+def _tail_chat_history(user_id: int, limit: int, after_id: int = 0) -> list:
+    rows = db_query(
+        "SELECT role, content, timestamp, tokens FROM chat_history "
+        "WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+        (user_id, after_id, limit)
+    )
+    return _history_rows_to_dicts(rows)
 
 
 def load_chat_history(user_id: int) -> list:
     """Загрузить историю чата"""
-    path = get_user_history_path(user_id)
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    return _tail_chat_history(user_id, HISTORY_MAX_MESSAGES)
 
 
 def save_chat_history(user_id: int, history: list):
     """Сохранить историю чата"""
-    path = get_user_history_path(user_id)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+        conn.executemany(
+            "INSERT INTO chat_history (user_id, role, content, timestamp, tokens) VALUES (?, ?, ?, ?, ?)",
+            [
+                (user_id, m["role"], m["content"], m.get("timestamp"), estimate_tokens(m["content"]))
+                for m in history
+            ]
+        )
 
 
 def add_message_to_history(user_id: int, role: str, content: str):
     """Добавить сообщение в историю"""
-    history = load_chat_history(user_id)
-    history.append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
-    # Ограничиваем историю последними 50 сообщениями
-    if len(history) > 50:
-        history = history[-50:]
-    save_chat_history(user_id, history)
+    add_messages_to_history(user_id, [(role, content)])
+
+
+def add_messages_to_history(user_id: int, messages: list):
+    """Добавить несколько сообщений (role, content) в историю одной транзакцией"""
+    timestamp = datetime.now().isoformat()
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO chat_history (user_id, role, content, timestamp, tokens) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, role, content, timestamp, estimate_tokens(content)) for role, content in messages]
+        )
+    with _history_compaction_lock:
+        _history_compaction_pending.add(user_id)
 
 
 def clear_chat_history(user_id: int):
     """Очистить историю чата"""
     save_chat_history(user_id, [])
+    cancel_history_summary(("chat", user_id))
+    delete_history_summary(("chat", user_id))
 
 
-def get_history_for_api(user_id: int, limit: int = 20) -> list:
-    """Получить историю для API"""
-    history = load_chat_history(user_id)
-    messages = history[-limit:]
+def get_history_for_api(user_id: int, token_budget: Optional[int] = None,
+                        limit: int = HISTORY_MAX_MESSAGES, after_id: int = 0) -> list:
+    """
+    Получить историю для API: свежие сообщения в пределах token_budget (None — без ограничения).
+    after_id отсекает сообщения, уже свернутые в резюме.
+    """
+    messages = fit_history_to_budget(
+        _tail_chat_history(user_id, min(limit, HISTORY_MAX_MESSAGES), after_id),
+        token_budget
+    )
     return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
 
 # ==================== РАБОТА С ИСТОРИЕЙ БИЗНЕС-ЧАТОВ ====================
-def get_business_chat_history_path(business_connection_id: str, client_chat_id: int) -> str:
-    """Получить путь к истории бизнес-чата"""
-    business_dir = os.path.join(DATA_DIR, "business_chats")
-    os.makedirs(business_dir, exist_ok=True)
-    return os.path.join(business_dir, f"{business_connection_id}_{client_chat_id}.json")
+def _tail_business_history(business_connection_id: str, client_chat_id: int, limit: int,
+                           after_id: int = 0) -> list:
+    rows = db_query(
+        "SELECT role, content, timestamp, tokens FROM business_history "
+        "WHERE connection_id = ? AND chat_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+        (business_connection_id, client_chat_id, after_id, limit)
+    )
+    return _history_rows_to_dicts(rows)
 
 
 def load_business_chat_history(business_connection_id: str, client_chat_id: int) -> list:
     """Загрузить историю бизнес-чата"""
-    path = get_business_chat_history_path(business_connection_id, client_chat_id)
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    return _tail_business_history(business_connection_id, client_chat_id, HISTORY_MAX_MESSAGES)
 
 
 def save_business_chat_history(business_connection_id: str, client_chat_id: int, history: list):
     """Сохранить историю бизнес-чата"""
-    path = get_business_chat_history_path(business_connection_id, client_chat_id)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    with db_transaction() as conn:
+        conn.execute(
+            "DELETE FROM business_history WHERE connection_id = ? AND chat_id = ?",
+            (business_connection_id, client_chat_id)
+        )
+        conn.executemany(
+            "INSERT INTO business_history (connection_id, chat_id, role, content, timestamp, tokens) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    business_connection_id, client_chat_id, m["role"], m["content"], m.get("timestamp"),
+                    estimate_tokens(m["content"])
+                )
+                for m in history
+            ]
+        )
 
 
 def add_message_to_business_history(business_connection_id: str, client_chat_id: int, role: str, content: str):
     """Добавить сообщение в историю бизнес-чата"""
-    history = load_business_chat_history(business_connection_id, client_chat_id)
-    history.append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
-    # Ограничиваем историю последними 50 сообщениями
-    if len(history) > 50:
-        history = history[-50:]
-    save_business_chat_history(business_connection_id, client_chat_id, history)
+    add_messages_to_business_history(business_connection_id, client_chat_id, [(role, content)])
 
 
-def get_business_history_for_api(business_connection_id: str, client_chat_id: int, limit: int = 20) -> list:
-    """Получить историю бизнес-чата для API"""
-    history = load_business_chat_history(business_connection_id, client_chat_id)
-    messages = history[-limit:]
+def add_messages_to_business_history(business_connection_id: str, client_chat_id: int, messages: list):
+    """Добавить несколько сообщений (role, content) в историю бизнес-чата одной транзакцией"""
+    timestamp = datetime.now().isoformat()
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO business_history (connection_id, chat_id, role, content, timestamp, tokens) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (business_connection_id, client_chat_id, role, content, timestamp, estimate_tokens(content))
+                for role, content in messages
+            ]
+        )
+    with _history_compaction_lock:
+        _business_compaction_pending.add((business_connection_id, client_chat_id))
+
+
+def get_business_history_for_api(business_connection_id: str, client_chat_id: int,
+                                 token_budget: Optional[int] = None, limit: int = HISTORY_MAX_MESSAGES,
+                                 after_id: int = 0) -> list:
+    """Получить историю бизнес-чата для API в пределах token_budget (None — без ограничения)"""
+    messages = fit_history_to_budget(
+        _tail_business_history(
+            business_connection_id, client_chat_id, min(limit, HISTORY_MAX_MESSAGES), after_id
+        ),
+        token_budget
+    )
     return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
 
 
 def clear_business_chat_history(business_connection_id: str, client_chat_id: int):
     """Очистить историю бизнес-чата"""
     save_business_chat_history(business_connection_id, client_chat_id, [])
+    cancel_history_summary(("business", business_connection_id, client_chat_id))
+    delete_history_summary(("business", business_connection_id, client_chat_id))
 
-# ==================== ПОДПИСКА ====================
-def has_active_subscription(user_id: int) -> bool:
-    """Проверить активность подписки"""
-    # Админы имеют бесплатный доступ
-    if user_id in ADMIN_IDS:
-        return True
 
-    user_data = load_user_data(user_id)
-    sub_end = user_data.get("subscription_end")
+# Резюме старой части диалога. scope: ("chat", user_id) или ("business", connection_id, chat_id);
+# covered_id — id последнего сообщения, вошедшего в резюме (более ранние в API не отправляются).
+def _summary_scope_key(scope: tuple) -> str:
+    return ":".join(str(part) for part in scope)
 
-    if not sub_end:
-        return False
+
+def get_history_summary(scope: tuple) -> tuple:
+    """(резюме, covered_id); для диалога без резюме — ("", 0)"""
+    rows = db_query(
+        "SELECT summary, covered_id FROM history_summaries WHERE scope = ?",
+        (_summary_scope_key(scope),)
+    )
+    return (rows[0][0], rows[0][1]) if rows else ("", 0)
+
+
+def save_history_summary(scope: tuple, summary: str, covered_id: int):
+    """
+    Сохранить резюме, только если сообщение covered_id еще в истории: если диалог успели очистить,
+    пока резюме готовилось, оно описывало бы уже удаленную переписку.
+    """
+    if scope[0] == "chat":
+        exists_sql = "SELECT 1 FROM chat_history WHERE user_id = ? AND id = ?"
+        exists_args = (scope[1], covered_id)
+    else:
+        exists_sql = "SELECT 1 FROM business_history WHERE connection_id = ? AND chat_id = ? AND id = ?"
+        exists_args = (scope[1], scope[2], covered_id)
+    db_execute(
+        "INSERT INTO history_summaries (scope, summary, covered_id, updated_at) "
+        f"SELECT ?, ?, ?, ? WHERE EXISTS ({exists_sql}) "
+        "ON CONFLICT(scope) DO UPDATE SET summary = excluded.summary, "
+        "covered_id = excluded.covered_id, updated_at = excluded.updated_at",
+        (_summary_scope_key(scope), summary, covered_id, time.time(), *exists_args)
+    )
+
+
+def delete_history_summary(scope: tuple):
+    db_execute("DELETE FROM history_summaries WHERE scope = ?", (_summary_scope_key(scope),))
+
+
+def get_unsummarized_history(scope: tuple, after_id: int) -> list:
+    """Сообщения диалога после covered_id: [(id, role, content), ...] по возрастанию id"""
+    if scope[0] == "chat":
+        return db_query(
+            "SELECT id, role, content FROM chat_history WHERE user_id = ? AND id > ? ORDER BY id",
+            (scope[1], after_id)
+        )
+    return db_query(
+        "SELECT id, role, content FROM business_history "
+        "WHERE connection_id = ? AND chat_id = ? AND id > ? ORDER BY id",
+        (scope[1], scope[2], after_id)
+    )
+
+
+def compact_chat_histories() -> int:
+    """Обрезать журналы историй, в которые писали с прошлого раза, до HISTORY_MAX_MESSAGES."""
+    with _history_compaction_lock:
+        user_ids = list(_history_compaction_pending)
+        business_chats = list(_business_compaction_pending)
+        _history_compaction_pending.clear()
+        _business_compaction_pending.clear()
+    if not user_ids and not business_chats:
+        return 0
 
     try:
-        end_date = datetime.fromisoformat(sub_end)
-        return datetime.now() < end_date
-    except:
-        return False
+        _delete_history_overflow(user_ids, business_chats)
+    except Exception:
+        # Не теряем работу: вернем чаты в очередь на следующее уплотнение.
+        with _history_compaction_lock:
+            _history_compaction_pending.update(user_ids)
+            _business_compaction_pending.update(business_chats)
+        raise
+    return len(user_ids) + len(business_chats)
+
+
+def _delete_history_overflow(user_ids: list, business_chats: list):
+    with db_transaction() as conn:
+        conn.executemany(
+            "DELETE FROM chat_history WHERE user_id = ? AND id <= ("
+            "SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            [(user_id, user_id, HISTORY_MAX_MESSAGES) for user_id in user_ids]
+        )
+        conn.executemany(
+            "DELETE FROM business_history WHERE connection_id = ? AND chat_id = ? AND id <= ("
+            "SELECT id FROM business_history WHERE connection_id = ? AND chat_id = ? "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            [
+                (connection_id, chat_id, connection_id, chat_id, HISTORY_MAX_MESSAGES)
+                for connection_id, chat_id in business_chats
+            ]
+        )
 
 
-def get_subscription_end(user_id: int) -> Optional[datetime]:
-    """Получить дату окончания подписки"""
-    user_data = load_user_data(user_id)
+async def history_compaction_loop():
+    """Фоновое уплотнение журналов истории."""
+    while True:
+        await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+        try:
+            await run_io(compact_chat_histories)
+        except Exception as e:
+            logging.error(f"Ошибка уплотнения истории: {e}")
+
+# ==================== ПОДПИСКА ====================
+def _subscription_end_of(user_data: dict) -> Optional[datetime]:
     sub_end = user_data.get("subscription_end")
 
     if not sub_end:
@@ -1379,6 +3159,72 @@ def get_subscription_end(user_id: int) -> Optional[datetime]:
         return None
 
 
+# Материализованный индекс подписок: отсортированный список (окончание, user_id)
+# и словарь user_id -> окончание. Истекшие записи вычищаются с головы списка,
+# поэтому число активных подписок считается без обхода пользователей.
+_subscription_expiry_index = []
+_subscription_expiry_by_user: Dict[int, float] = {}
+_subscription_index_loaded = False
+_subscription_index_lock = threading.Lock()
+
+
+def init_subscription_index():
+    """Построить индекс подписок по всем пользователям (один раз при старте)"""
+    global _subscription_expiry_index, _subscription_expiry_by_user, _subscription_index_loaded
+    by_user = {}
+    for user in get_all_users():
+        end = _subscription_end_of(user)
+        if end is not None:
+            by_user[user["user_id"]] = end.timestamp()
+    with _subscription_index_lock:
+        _subscription_expiry_by_user = by_user
+        _subscription_expiry_index = sorted((end, user_id) for user_id, end in by_user.items())
+        _subscription_index_loaded = True
+
+
+def _index_subscription(user_id: int, end: Optional[datetime]):
+    if not _subscription_index_loaded:
+        init_subscription_index()
+        return
+    with _subscription_index_lock:
+        old_end = _subscription_expiry_by_user.pop(user_id, None)
+        if old_end is not None:
+            pos = bisect.bisect_left(_subscription_expiry_index, (old_end, user_id))
+            if pos < len(_subscription_expiry_index) and _subscription_expiry_index[pos] == (old_end, user_id):
+                del _subscription_expiry_index[pos]
+        if end is not None:
+            _subscription_expiry_by_user[user_id] = end.timestamp()
+            bisect.insort(_subscription_expiry_index, (end.timestamp(), user_id))
+
+
+def count_active_subscriptions() -> int:
+    """Число оплаченных подписок, которые еще не истекли"""
+    if not _subscription_index_loaded:
+        init_subscription_index()
+    now = time.time()
+    with _subscription_index_lock:
+        expired = bisect.bisect_right(_subscription_expiry_index, (now, float("inf")))
+        for end, user_id in _subscription_expiry_index[:expired]:
+            _subscription_expiry_by_user.pop(user_id, None)
+        del _subscription_expiry_index[:expired]
+        return len(_subscription_expiry_index)
+
+
+def has_active_subscription(user_id: int) -> bool:
+    """Проверить активность подписки"""
+    # Админы имеют бесплатный доступ
+    if user_id in ADMIN_IDS:
+        return True
+
+    end_date = get_subscription_end(user_id)
+    return end_date is not None and datetime.now() < end_date
+
+
+def get_subscription_end(user_id: int) -> Optional[datetime]:
+    """Получить дату окончания подписки"""
+    return _subscription_end_of(load_user_data(user_id))
+
+
 def get_free_trial_used(user_id: int) -> int:
     """Сколько бесплатных запросов уже использовано"""
     user_data = load_user_data(user_id)
@@ -1410,7 +3256,7 @@ def get_free_trial_paywall_text(user_id: int = None) -> str:
     """Текст пейвола при исчерпании бесплатного триала."""
     price_stars = get_subscription_price()
     price_usd = get_subscription_price_usd()
-    active_subs = len(get_users_with_active_subscription())
+    active_subs = count_active_subscriptions()
     proof = get_message("paywall_proof", active_subs=active_subs) if active_subs > 0 else ""
     return get_message(
         "paywall",
@@ -1475,6 +3321,7 @@ def grant_subscription(user_id: int, days: int = 30):
 
     user_data["subscription_end"] = new_end.isoformat()
     save_user_data(user_id, user_data)
+    _index_subscription(user_id, new_end)
 
     # Обновляем статистику
     increment_stat("active_subscriptions")
@@ -1485,65 +3332,98 @@ def revoke_subscription(user_id: int):
     user_data = load_user_data(user_id)
     user_data["subscription_end"] = None
     save_user_data(user_id, user_data)
+    _index_subscription(user_id, None)
 
 
 def get_all_users() -> list:
     """Получить список всех пользователей"""
+    flush_user_cache()
+    return _read_all_users()
+
+
+def _read_all_users() -> list:
+    return _parse_user_rows(db_query("SELECT user_id, data FROM users ORDER BY rowid"))
+
+
+def _parse_user_rows(rows: list) -> list:
     users = []
-    if os.path.exists(USERS_DIR):
-        for user_dir in os.listdir(USERS_DIR):
-            try:
-                user_id = int(user_dir)
-                user_data = load_user_data(user_id)
-                user_data["user_id"] = user_id  # ensure present for iteration
-                users.append(user_data)
-            except:
-                continue
+    for user_id, raw in rows:
+        try:
+            user_data = json.loads(raw)
+        except ValueError:
+            continue
+        user_data["user_id"] = user_id  # ensure present for iteration
+        users.append(user_data)
     return users
 
 
-def get_users_with_active_subscription() -> list:
-    """Получить пользователей с активной подпиской"""
-    users = get_all_users()
-    return [u for u in users if has_active_subscription(u["user_id"])]
+async def fetch_all_users() -> list:
+    """get_all_users для хендлеров: сброс кэша и чтение базы идут в пуле ввода-вывода"""
+    await flush_user_cache_async()
+    return await run_io(_read_all_users)
 
 
 def get_user_by_username(username: str) -> Optional[dict]:
     """Найти пользователя по username"""
     username = username.lstrip('@').lower()
-    users = get_all_users()
-    for user in users:
-        if user.get("username") and user["username"].lower() == username:
-            return user
-    return None
+    # Чистые записи кэша совпадают с базой, поэтому до индексного запроса смотрим
+    # только несохраненные (их немного — изменения за последние USER_FLUSH_INTERVAL секунд).
+    with _user_cache_lock:
+        dirty = {user_id: _user_cache[user_id] for user_id in _dirty_user_ids if user_id in _user_cache}
+    for user_id, user_data in dirty.items():
+        if str(user_data.get("username") or "").lower() == username:
+            return {**user_data, "user_id": user_id}
+    users = _parse_user_rows(db_query(
+        "SELECT user_id, data FROM users WHERE username_lc = ? ORDER BY rowid",
+        (username,)
+    ))
+    # У несохраненной записи username уже другой: совпадение в базе устарело.
+    return next((user for user in users if user["user_id"] not in dirty), None)
+
+
+def get_users_by_subscription_end(start: datetime, end: datetime) -> list:
+    """Пользователи, у которых подписка заканчивается в интервале [start, end)"""
+    return _parse_user_rows(db_query(
+        "SELECT user_id, data FROM users WHERE subscription_end_ts >= ? AND subscription_end_ts < ? "
+        "ORDER BY subscription_end_ts",
+        (start.timestamp(), end.timestamp())
+    ))
+
+
+def get_users_by_first_use(start: datetime, end: datetime) -> list:
+    """Пользователи, впервые воспользовавшиеся ботом в интервале [start, end)"""
+    return _parse_user_rows(db_query(
+        "SELECT user_id, data FROM users WHERE first_use_ts >= ? AND first_use_ts < ? "
+        "ORDER BY first_use_ts",
+        (start.timestamp(), end.timestamp())
+    ))
 
 async def create_crypto_invoice(user_id: int, amount: float) -> Optional[dict]:
     """Создать инвойс в CryptoBot"""
     try:
-        connector = aiohttp.TCPConnector()
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(
-                f"{CRYPTO_BOT_API}/createInvoice",
-                headers={"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN},
-                json={
-                    "amount": amount,
-                    "currency_type": "fiat",
-                    "fiat": "USD",
-                    "description": f"Подписка AI Chat Bot (30 дней)",
-                    "payload": f"subscription_{user_id}",
-                    "expires_in": 3600
-                }
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get("ok"):
-                        result = data["result"]
-                        return {
-                            "invoice_id": result["invoice_id"],
-                            "bot_invoice_url": result["bot_invoice_url"]
-                        }
-                logging.error(f"CryptoBot error status={response.status}")
-                return None
+        session = get_http_session("cryptobot")
+        async with session.post(
+            f"{CRYPTO_BOT_API}/createInvoice",
+            headers={"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN},
+            json={
+                "amount": amount,
+                "currency_type": "fiat",
+                "fiat": "USD",
+                "description": f"Подписка AI Chat Bot (30 дней)",
+                "payload": f"subscription_{user_id}",
+                "expires_in": 3600
+            }
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get("ok"):
+                    result = data["result"]
+                    return {
+                        "invoice_id": result["invoice_id"],
+                        "bot_invoice_url": result["bot_invoice_url"]
+                    }
+            logging.error(f"CryptoBot error status={response.status}")
+            return None
     except Exception as e:
         logging.error(f"Ошибка создания CryptoBot инвойса: {e}")
         return None
@@ -1552,22 +3432,21 @@ async def create_crypto_invoice(user_id: int, amount: float) -> Optional[dict]:
 async def check_crypto_invoice(invoice_id: str) -> Optional[dict]:
     """Проверить статус инвойса CryptoBot"""
     try:
-        connector = aiohttp.TCPConnector()
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(
-                f"{CRYPTO_BOT_API}/getInvoices",
-                headers={"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN},
-                params={"invoice_ids": invoice_id}
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get("ok") and data.get("result", {}).get("items"):
-                        invoice = data["result"]["items"][0]
-                        return {
-                            "status": invoice.get("status"),
-                            "payload": invoice.get("payload")
-                        }
-                return None
+        session = get_http_session("cryptobot")
+        async with session.get(
+            f"{CRYPTO_BOT_API}/getInvoices",
+            headers={"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN},
+            params={"invoice_ids": invoice_id}
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get("ok") and data.get("result", {}).get("items"):
+                    invoice = data["result"]["items"][0]
+                    return {
+                        "status": invoice.get("status"),
+                        "payload": invoice.get("payload")
+                    }
+            return None
     except Exception as e:
         logging.error(f"Ошибка проверки CryptoBot инвойса: {e}")
         return None
@@ -1579,12 +3458,116 @@ def get_thinking_preference(user_id: int) -> Optional[str]:
 
 
 def set_thinking_preference(user_id: int, preference: Optional[str]):
-    """Установить настройки мышления пользователю"""
+    """Установить настройки мышления пользователю (вместе со скомпилированным системным промптом)"""
     user_data = load_user_data(user_id)
     user_data["thinking_preference"] = preference
+    _store_persona_prompt(user_data, preference)
     save_user_data(user_id, user_data)
 
 
+def _store_persona_prompt(user_data: dict, preference: Optional[str]):
+    """Скомпилировать промпт персоны в запись пользователя; сжатая версия сбрасывается"""
+    if preference:
+        digest = persona_prompt_hash(preference)
+        prompt = _cache_persona_prompt(digest, compile_persona_prompt(preference))
+        user_data["thinking_prompt"] = prompt
+        user_data["thinking_prompt_hash"] = digest
+    else:
+        user_data.pop("thinking_prompt", None)
+        user_data.pop("thinking_prompt_hash", None)
+    user_data.pop("thinking_prompt_condensed", None)
+    user_data.pop("thinking_prompt_condensed_hash", None)
+
+
+# Системный промпт персоны компилируется один раз при сохранении предпочтений и хранится
+# рядом с исходником; горячие промпты дополнительно держатся в LRU по хэшу исходника.
+# PERSONA_PROMPT_VERSION входит в хэш: при смене шаблона сохраненные компиляции пересобираются
+# один раз при запуске (refresh_persona_prompts), а не в get_persona_prompt.
+PERSONA_PROMPT_VERSION = 1
+PERSONA_PROMPT_CACHE_SIZE = 512
+_persona_prompt_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+def persona_prompt_hash(preference: str) -> str:
+    return hashlib.sha256(f"{PERSONA_PROMPT_VERSION}\x00{preference}".encode("utf-8")).hexdigest()
+
+
+def _render_persona_profile(obj, indent: int, out: list):
+    prefix = "  " * indent
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, (dict, list)):
+                out.append(f"{prefix}{key}:\n")
+                _render_persona_profile(value, indent + 1, out)
+            else:
+                out.append(f"{prefix}{key}: {value}\n")
+    elif isinstance(obj, list):
+        for item in obj:
+            if isinstance(item, (dict, list)):
+                _render_persona_profile(item, indent, out)
+            else:
+                out.append(f"{prefix}• {item}\n")
+
+
+def compile_persona_prompt(preference: str) -> str:
+    """Собрать системный промпт из предпочтений: JSON-профиль -> ролевая игра, текст -> указания"""
+    try:
+        profile = json.loads(preference)
+    except ValueError:
+        profile = None
+    if not isinstance(profile, (dict, list)):
+        return f"Следуй этим указаниям при общении: {preference}"
+
+    # Формируем промпт для ролевой игры - ИИ становится персонажем из JSON
+    parts = [
+        "Ты - это персонаж, описанный в следующем профиле. "
+        "Общайся от первого лица, будто это твоя настоящая личность.\n\n",
+        "=== ТВОЙ ПРОФИЛЬ ===\n\n",
+    ]
+    _render_persona_profile(profile, 0, parts)
+    parts.append(
+        "\n=== ИНСТРУКЦИИ ===\n"
+        "• Общайся от первого лица ('я', 'мне', 'мой')\n"
+        "• Используй стиль речи и сленг из профиля\n"
+        "• Веди себя естественно, как реальный человек\n"
+        "• Если в профиле указано использование мата - используй его естественно\n"
+        "• Отвечай на основе фактов из профиля\n"
+        "• Не упоминай, что ты ИИ или бот"
+    )
+    return "".join(parts)
+
+
+def _cache_persona_prompt(digest: str, prompt: str) -> str:
+    _persona_prompt_cache[digest] = prompt
+    _persona_prompt_cache.move_to_end(digest)
+    while len(_persona_prompt_cache) > PERSONA_PROMPT_CACHE_SIZE:
+        _persona_prompt_cache.popitem(last=False)
+    return prompt
+
+
+def get_persona_prompt(user_id: int) -> Optional[str]:
+    """Системный промпт персоны пользователя (None — предпочтения не заданы)"""
+    user_data = load_user_data(user_id)
+    preference = user_data.get("thinking_preference")
+    if not preference:
+        return None
+    # Хэш пересчитывается на каждый запрос (sha256 от нескольких КБ — микросекунды): запись,
+    # еще не пересобранная refresh_persona_prompts, не должна отдавать промпт старого шаблона.
+    digest = persona_prompt_hash(preference)
+    # Сжатая версия (см. schedule_persona_condense) — по умолчанию, пока соответствует исходнику
+    condensed = user_data.get("thinking_prompt_condensed")
+    if PERSONA_CONDENSE_TOKENS and condensed and user_data.get("thinking_prompt_condensed_hash") == digest:
+        return condensed
+    cached = _persona_prompt_cache.get(digest)
+    if cached is not None:
+        _persona_prompt_cache.move_to_end(digest)
+        return cached
+    if user_data.get("thinking_prompt_hash") == digest and user_data.get("thinking_prompt"):
+        return _cache_persona_prompt(digest, user_data["thinking_prompt"])
+    # Устаревшая компиляция: собираем в памяти, запись пересохранит refresh_persona_prompts.
+    return _cache_persona_prompt(digest, compile_persona_prompt(preference))
+
+
 def get_response_style_preset(user_id: int) -> str:
     """Получить preset стиля ответа (serious|neutral|funny|friend)."""
     user_data = load_user_data(user_id)
@@ -1621,13 +3604,26 @@ def get_start_example(user_id: int, rotate: bool = False) -> str:
     return START_EXAMPLES[last_idx]
 
 
+_button_emoji_pack_cache: tuple = (None, {})
+
+
 def get_button_emoji_pack() -> dict:
     """
     Получить маппинг button_key -> custom emoji id.
     Источники: config.button_emoji_pack или env BUTTON_EMOJI_PACK_JSON.
+    Результат кэшируется на время жизни снимка конфига.
     """
-    config = load_config()
-    from_config = config.get("button_emoji_pack")
+    global _button_emoji_pack_cache
+    snapshot = get_config()
+    cached_for, pack = _button_emoji_pack_cache
+    if cached_for is not snapshot:
+        pack = _build_button_emoji_pack(snapshot)
+        _button_emoji_pack_cache = (snapshot, pack)
+    return pack
+
+
+def _build_button_emoji_pack(snapshot: ConfigSnapshot) -> dict:
+    from_config = _thaw(snapshot.data.get("button_emoji_pack"))
     if isinstance(from_config, dict):
         return {str(k): str(v) for k, v in from_config.items() if str(v).strip()}
 
@@ -1679,8 +3675,7 @@ def make_inline_button(
 
 def get_start_media() -> Optional[dict]:
     """Получить медиа для /start"""
-    config = load_config()
-    return config.get("start_media")
+    return _thaw(get_config().data.get("start_media"))
 
 
 def set_start_media(media_type: Optional[str], file_id: Optional[str]):
@@ -1695,8 +3690,7 @@ def set_start_media(media_type: Optional[str], file_id: Optional[str]):
 
 def get_channel_media() -> Optional[dict]:
     """Получить медиа для сообщения о подписке на канал"""
-    config = load_config()
-    return config.get("channel_media")
+    return _thaw(get_config().data.get("channel_media"))
 
 
 def set_channel_media(media_type: Optional[str], file_id: Optional[str]):
@@ -1710,76 +3704,87 @@ def set_channel_media(media_type: Optional[str], file_id: Optional[str]):
 
 
 # ==================== ЧЕРНЫЙ СПИСОК ====================
+# Проверка идет по множеству в памяти; таблица blacklist — его постоянная копия,
+# куда изменения пишутся точечно (INSERT/DELETE одной строки).
+_blacklist_ids = set()
+_blacklist_loaded = False
+
+
+def init_blacklist():
+    """Загрузить черный список в память (один раз при старте)"""
+    global _blacklist_ids, _blacklist_loaded
+    _blacklist_ids = {row[0] for row in db_query("SELECT user_id FROM blacklist")}
+    _blacklist_loaded = True
+
+
 def load_blacklist() -> list:
     """Загрузить черный список"""
-    if os.path.exists(BLACKLIST_FILE):
-        with open(BLACKLIST_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    return [row[0] for row in db_query("SELECT user_id FROM blacklist ORDER BY rowid")]
 
 
 def save_blacklist(blacklist: list):
     """Сохранить черный список"""
-    with open(BLACKLIST_FILE, 'w', encoding='utf-8') as f:
-        json.dump(blacklist, f, ensure_ascii=False, indent=2)
+    global _blacklist_ids, _blacklist_loaded
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM blacklist")
+        conn.executemany("INSERT OR IGNORE INTO blacklist (user_id) VALUES (?)", [(uid,) for uid in blacklist])
+    _blacklist_ids = set(blacklist)
+    _blacklist_loaded = True
 
 
 def is_blacklisted(user_id: int) -> bool:
     """Проверить, в черном ли списке пользователь"""
-    return user_id in load_blacklist()
+    if not _blacklist_loaded:
+        init_blacklist()
+    return user_id in _blacklist_ids
 
 
 def add_to_blacklist(user_id: int):
     """Добавить пользователя в черный список"""
-    blacklist = load_blacklist()
-    if user_id not in blacklist:
-        blacklist.append(user_id)
-        save_blacklist(blacklist)
+    db_execute("INSERT OR IGNORE INTO blacklist (user_id) VALUES (?)", (user_id,))
+    _blacklist_ids.add(user_id)
 
 
 def remove_from_blacklist(user_id: int):
     """Удалить пользователя из черного списка"""
-    blacklist = load_blacklist()
-    if user_id in blacklist:
-        blacklist.remove(user_id)
-        save_blacklist(blacklist)
+    db_execute("DELETE FROM blacklist WHERE user_id = ?", (user_id,))
+    _blacklist_ids.discard(user_id)
 
 def load_pending_invoices() -> dict:
     """Загрузить ожидающие инвойсы"""
-    if os.path.exists(PENDING_INVOICES_FILE):
-        with open(PENDING_INVOICES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    rows = db_query("SELECT invoice_id, user_id, created_at FROM pending_invoices ORDER BY rowid")
+    return {
+        invoice_id: {"user_id": user_id, "created_at": created_at}
+        for invoice_id, user_id, created_at in rows
+    }
 
 
 def save_pending_invoices(invoices: dict):
     """Сохранить ожидающие инвойсы"""
-    with open(PENDING_INVOICES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(invoices, f, ensure_ascii=False, indent=2)
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM pending_invoices")
+        conn.executemany(
+            "INSERT INTO pending_invoices (invoice_id, user_id, created_at) VALUES (?, ?, ?)",
+            [(str(inv_id), inv["user_id"], inv.get("created_at")) for inv_id, inv in invoices.items()]
+        )
 
 
 def add_pending_invoice(invoice_id: str, user_id: int):
     """Добавить ожидающий инвойс"""
-    invoices = load_pending_invoices()
-    invoices[invoice_id] = {
-        "user_id": user_id,
-        "created_at": datetime.now().isoformat()
-    }
-    save_pending_invoices(invoices)
+    db_execute(
+        "INSERT OR REPLACE INTO pending_invoices (invoice_id, user_id, created_at) VALUES (?, ?, ?)",
+        (str(invoice_id), user_id, datetime.now().isoformat())
+    )
 
 
 def remove_pending_invoice(invoice_id: str):
     """Удалить ожидающий инвойс"""
-    invoices = load_pending_invoices()
-    if invoice_id in invoices:
-        del invoices[invoice_id]
-        save_pending_invoices(invoices)
+    db_execute("DELETE FROM pending_invoices WHERE invoice_id = ?", (str(invoice_id),))
 
 # ==================== ОБЯЗАТЕЛЬНЫЕ КАНАЛЫ ====================
 def get_required_channels() -> list:
     """Получить список обязательных каналов"""
-    config = load_config()
-    return config.get("required_channels", [])
+    return _thaw(get_config().data.get("required_channels", ()))
 
 
 def add_required_channel(channel_id: str, channel_name: str, channel_link: str):
@@ -2162,19 +4167,17 @@ async def handle_business_text_message(message: Message):
                 "upload_photo",
                 business_connection_id=business_connection_id
             )
-            success, result = await generate_image_with_guard(bot_owner_id, message.text, image_model)
+            success, result, cache_key = await generate_image_cached(bot_owner_id, message.text, image_model)
 
             if success:
-                photo = (
-                    BufferedInputFile(result, filename="generated_image.jpg")
-                    if isinstance(result, (bytes, bytearray))
-                    else result
-                )
-                await bot.send_photo(
-                    chat_id=message.chat.id,
-                    photo=photo,
-                    caption=f"🖼 {image_model}",
-                    business_connection_id=business_connection_id
+                await send_generated_image(
+                    lambda photo: bot.send_photo(
+                        chat_id=message.chat.id,
+                        photo=photo,
+                        caption=f"🖼 {image_model}",
+                        business_connection_id=business_connection_id
+                    ),
+                    result, cache_key, bot_owner_id, message.text, image_model
                 )
                 if not has_active_subscription(bot_owner_id):
                     consume_free_trial(bot_owner_id, is_image=True)
@@ -2385,10 +4388,9 @@ async def handle_business_voice(message: Message):
 
         voice = message.voice
         file = await bot.get_file(voice.file_id)
-        voice_path = f"/tmp/business_voice_{voice.file_id}.ogg"
-        await bot.download_file(file.file_path, voice_path)
+        voice_data = await bot.download_file(file.file_path)
 
-        transcribed_text = await transcribe_voice(voice_path)
+        transcribed_text = await transcribe_voice(voice_data.read())
 
         if not transcribed_text:
             await bot.send_message(
@@ -2450,6 +4452,7 @@ async def cmd_start(message: Message):
     if is_blacklisted(user_id):
         return
 
+    is_new_user = not user_exists(user_id)
     user_data = load_user_data(user_id)
 
     # Обновляем данные пользователя
@@ -2460,7 +4463,7 @@ async def cmd_start(message: Message):
     # Статистика: каждый /start
     increment_stat("total_starts")
     # Новый пользователь (первый раз)
-    if not os.path.exists(get_user_history_path(user_id)):
+    if is_new_user:
         increment_stat("total_users")
 
     # Проверяем подписку на каналы (админы не проверяются)
@@ -2480,7 +4483,7 @@ async def send_channel_subscription_message(chat_id: int, user_id: int):
     if not channels:
         return
 
-    stats = load_stats()
+    stats = await run_io(load_stats)
     subs_count = stats.get("total_users", 0)
     proof = get_message("channel_proof", subs_count=subs_count) if subs_count > 10 else ""
     text = get_message("channel_subscribe", proof=proof)
@@ -2850,7 +4853,7 @@ async def callback_subscription(callback: CallbackQuery):
     else:
         price_stars = get_subscription_price()
         price_usd = get_subscription_price_usd()
-        active_subs = len(get_users_with_active_subscription())
+        active_subs = count_active_subscriptions()
         proof = get_message("subscription_proof", active_subs=active_subs) if active_subs > 0 else ""
         user_data = load_user_data(user_id)
         needsub = user_data.get("needsub_clicked")
@@ -3052,10 +5055,11 @@ async def callback_admin_stats(callback: CallbackQuery):
         await callback.answer("✖️ Доступ запрещен", show_alert=True)
         return
 
-    stats = load_stats()
-    users = get_all_users()
-    active_subs = len(get_users_with_active_subscription())
-    trial_users = len([u for u in users if get_free_trial_used(u["user_id"]) > 0])
+    stats = await run_io(load_stats)
+    users = await fetch_all_users()
+    # Считаем по уже прочитанным записям и индексу подписок: без load_user_data на каждого
+    active_subs = await run_io(count_active_subscriptions)
+    trial_users = sum(1 for u in users if int(u.get("free_trial_used") or 0) > 0)
     price = get_subscription_price()
     revenue_usd = stats.get("total_revenue_usd", 0) or 0
     paywall_shown = stats.get("paywall_shown", 0)
@@ -3064,6 +5068,16 @@ async def callback_admin_stats(callback: CallbackQuery):
     total_users = stats.get("total_users", 0)
     conv_rate = (total_payments / total_users * 100) if total_users > 0 else 0
 
+    messages_15m = get_stat_window("total_messages", minutes=15)
+    messages_1h = get_stat_window("total_messages", minutes=60)
+    messages_24h = get_stat_window("total_messages", hours=24)
+    starts_1h = get_stat_window("total_starts", minutes=60)
+    starts_24h = get_stat_window("total_starts", hours=24)
+    paywall_24h = get_stat_window("paywall_shown", hours=24)
+    clicked_24h = get_stat_window("subscription_clicked", hours=24)
+    payments_24h = get_stat_window("total_payments", hours=24)
+    funnel_24h = (payments_24h / paywall_24h * 100) if paywall_24h > 0 else 0
+
     text = (
         "📊 <b>Статистика</b>\n\n"
         f"🟢 <b>Нажатий /start:</b> {stats.get('total_starts', 0)}\n"
@@ -3079,8 +5093,42 @@ async def callback_admin_stats(callback: CallbackQuery):
         f"  CR (users→paid): {conv_rate:.1f}%\n\n"
         f"💰 <b>Доход (звёзды):</b> {stats.get('total_revenue', 0)} ⭐\n"
         f"💎 <b>Доход (CryptoBot):</b> {revenue_usd:.2f} USD\n\n"
-        f"🏷️ <b>Текущая цена:</b> {price} ⭐ / {get_subscription_price_usd()} USD"
+        f"🏷️ <b>Текущая цена:</b> {price} ⭐ / {get_subscription_price_usd()} USD\n\n"
+        "<b>⏱ Динамика (с момента запуска):</b>\n"
+        f"  сообщений: {messages_15m / 15:.1f}/мин за 15 мин, {messages_1h:.0f} за час, {messages_24h:.0f} за 24ч\n"
+        f"  /start: {starts_1h:.0f} за час, {starts_24h:.0f} за 24ч\n"
+        f"  воронка 24ч: paywall {paywall_24h:.0f} → клик {clicked_24h:.0f} → оплата {payments_24h:.0f}"
+        f" ({funnel_24h:.1f}%)\n\n"
+        f"🐢 <b>Задержка event loop:</b> {loop_lag_stats['avg_ms']:.0f} мс (макс. {loop_lag_stats['max_ms']:.0f} мс, "
+        f"блокировок ≥{LOOP_LAG_WARN_MS} мс: {loop_lag_stats['slow_ticks']})"
+    )
+    image_health = format_image_health()
+    if image_health:
+        text += f"\n\n<b>🖼 Image-модели:</b>\n{image_health}"
+    text += (
+        f"\n⏳ Генераций, не уложившихся в {IMAGE_DEADLINE_SECONDS} с: "
+        f"{stats.get('image_deadline_exceeded', 0)} (за 24ч: "
+        f"{get_stat_window('image_deadline_exceeded', hours=24):.0f})"
     )
+    if image_cache_enabled():
+        text += (
+            f"\n🗂 Кэш изображений: попаданий {stats.get('image_cache_hits', 0)}, "
+            f"промахов {stats.get('image_cache_misses', 0)}, "
+            f"склеено одновременных {stats.get('image_cache_coalesced', 0)}, "
+            f"повторов мимо кэша {stats.get('image_cache_retries', 0)}"
+        )
+    p50_stt = stt_latency_p50()
+    text += (
+        f"\n\n🎙 <b>Распознавание голоса</b> ({_stt_backend.name if _stt_backend else 'выкл.'}): "
+        f"очередь {stt_queue_depth()} (макс. {stt_stats['max_queued']}), "
+        f"в работе {min(stt_stats['pending'], STT_WORKERS)}/{STT_WORKERS}, "
+        f"p50 {'—' if p50_stt is None else f'{p50_stt:.1f}с'}, "
+        f"успешно {stt_stats['done']}, неудач {stt_stats['failed']} "
+        f"(таймаутов {stt_stats['timeouts']}, отказов по очереди {stt_stats['rejected']})"
+    )
+    prompt_cache = format_prompt_cache_stats(stats)
+    if prompt_cache:
+        text += f"\n\n<b>🧩 Кэш промптов DeepSeek:</b>\n{prompt_cache}"
 
     await safe_edit_or_send(
         callback, text,
@@ -3496,7 +5544,7 @@ async def callback_admin_broadcast(callback: CallbackQuery, state: FSMContext):
         await callback.answer("✖️ Доступ запрещен", show_alert=True)
         return
 
-    users = get_all_users()
+    users = await fetch_all_users()
 
     await safe_edit_or_send(
         callback,
@@ -3518,7 +5566,7 @@ async def process_broadcast_message(message: Message, state: FSMContext):
 
     await state.update_data(broadcast_text=message.text, broadcast_msg_id=message.message_id)
 
-    users = get_all_users()
+    users = await fetch_all_users()
 
     await message.answer(
         f"📢 <b>Подтверждение рассылки</b>\n\n"
@@ -3542,7 +5590,7 @@ async def callback_broadcast_confirm(callback: CallbackQuery, state: FSMContext)
     data = await state.get_data()
     broadcast_text = data.get("broadcast_text", "")
 
-    users = get_all_users()
+    users = await fetch_all_users()
     success = 0
     failed = 0
 
@@ -3578,7 +5626,7 @@ async def callback_admin_users(callback: CallbackQuery):
         return
 
     page = int(callback.data.split("_")[-1])
-    all_users = get_all_users()
+    all_users = await fetch_all_users()
 
     if not all_users:
         await safe_edit_or_send(
@@ -4519,6 +6567,7 @@ async def process_thinking_preference(message: Message, state: FSMContext):
             return
 
     set_thinking_preference(user_id, preference)
+    schedule_persona_condense(user_id)
 
     if is_json:
         # Подсчитываем ключи верхнего уровня
@@ -4591,6 +6640,7 @@ async def process_thinking_document(message: Message, state: FSMContext):
 
         # Сохраняем
         set_thinking_preference(user_id, json_text)
+        schedule_persona_condense(user_id)
 
         # Подсчитываем ключи верхнего уровня
         top_keys = list(json_config.keys())
@@ -4639,31 +6689,268 @@ async def callback_thinking_delete(callback: CallbackQuery):
     await callback.answer()
 
 
-# ==================== AI FUNCTIONS ====================
-def _messages_to_deepseek_format(messages: list) -> list:
-    """Преобразовать сообщения в формат DeepSeek: content только строка."""
-    result = []
-    for m in messages:
-        role = m.get("role")
-        content = m.get("content")
-        if isinstance(content, list):
-            parts = []
-            for part in content:
-                if isinstance(part, dict):
-                    if part.get("type") == "text":
-                        parts.append(part.get("text", ""))
-                    elif part.get("type") == "image_url":
-                        parts.append("[Пользователь приложил изображение]")
-            content = " ".join(parts) if parts else "[Медиа]"
-        result.append({"role": role, "content": content or ""})
-    return result
+# ==================== HTTP-КЛИЕНТЫ ====================
+# Один долгоживущий aiohttp-сеанс на внешний сервис: keep-alive соединения, кэш DNS
+# и прогрев при старте избавляют каждый запрос от DNS/TCP/TLS рукопожатий.
+HTTP_PROVIDERS = {
+    "deepseek": {"limit": 32, "warmup": ["https://api.deepseek.com"]},
+    "onlysq": {"limit": 32, "warmup": ["http://api.onlysq.ru", "https://api.onlysq.ru"]},
+    "pollinations": {"limit": 16, "warmup": ["https://image.pollinations.ai", "https://pollinations.ai"]},
+    "cryptobot": {"limit": 8, "warmup": ["https://pay.crypt.bot"]},
+}
+
+_http_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+
+def get_http_session(provider: str) -> aiohttp.ClientSession:
+    """Общий сеанс для сервиса (создается при первом обращении, если не был создан в main)."""
+    session = _http_sessions.get(provider)
+    if session is None or session.closed:
+        settings = HTTP_PROVIDERS[provider]
+        connector = aiohttp.TCPConnector(
+            limit=settings["limit"],
+            limit_per_host=settings["limit"],
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _http_sessions[provider] = session
+    return session
+
+
+async def start_http_clients():
+    """Создать сеансы для всех сервисов и прогреть соединения (ошибки прогрева не критичны)."""
+    async def _warm(provider: str, url: str):
+        try:
+            async with get_http_session(provider).head(url, timeout=10, allow_redirects=False):
+                pass
+        except Exception as e:
+            logging.info(f"Прогрев {provider} ({url}) не удался: {e}")
+
+    await asyncio.gather(*[
+        _warm(provider, url)
+        for provider, settings in HTTP_PROVIDERS.items()
+        for url in settings["warmup"]
+    ])
+
+
+async def close_http_clients():
+    """Закрыть все сеансы (при остановке бота)."""
+    sessions = list(_http_sessions.values())
+    _http_sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
+
+
+# ==================== AI FUNCTIONS ====================
+def _messages_to_deepseek_format(messages: list) -> list:
+    """Преобразовать сообщения в формат DeepSeek: content только строка."""
+    result = []
+    for m in messages:
+        role = m.get("role")
+        content = m.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if isinstance(part, dict):
+                    if part.get("type") == "text":
+                        parts.append(part.get("text", ""))
+                    elif part.get("type") == "image_url":
+                        parts.append("[Пользователь приложил изображение]")
+            content = " ".join(parts) if parts else "[Медиа]"
+        result.append({"role": role, "content": content or ""})
+    return result
+
+
+def _deepseek_model(user_model: str) -> str:
+    """Маппинг модели бота на модель DeepSeek API."""
+    if user_model == "deepseek-r1":
+        return "deepseek-reasoner"
+    return "deepseek-chat"
+
+
+HISTORY_SUMMARY_MODEL = "deepseek-chat"
+HISTORY_SUMMARY_MAX_CHARS = 2000
+HISTORY_SUMMARY_PROMPT = (
+    "Ты сжимаешь переписку пользователя с ассистентом в краткое резюме для долгой памяти. "
+    "Объедини прежнее резюме и новые реплики в одно резюме до 1500 символов на русском языке. "
+    "Сохрани факты о пользователе, его цели, договоренности, имена, числа и незакрытые вопросы. "
+    "Не добавляй ничего от себя, не пиши вступлений — только резюме."
+)
+_summary_running: Dict[str, asyncio.Task] = {}
+
+
+def history_summary_message(summary: str) -> Optional[dict]:
+    if not summary:
+        return None
+    return {"role": "system", "content": f"Краткое содержание более ранней части диалога:\n{summary}"}
+
+
+def schedule_history_summary(scope: tuple):
+    """Запустить фоновое сжатие истории диалога (не более одного на диалог одновременно)"""
+    key = _summary_scope_key(scope)
+    if key in _summary_running or not _get_deepseek_key():
+        return
+    task = asyncio.create_task(_summarize_history(scope))
+    _summary_running[key] = task
+    task.add_done_callback(
+        lambda done: _summary_running.pop(key, None) if _summary_running.get(key) is done else None
+    )
+
+
+def cancel_history_summary(scope: tuple):
+    """Отменить фоновое сжатие диалога (при очистке истории)"""
+    task = _summary_running.pop(_summary_scope_key(scope), None)
+    if task is not None:
+        task.cancel()
+
+
+async def _summarize_history(scope: tuple):
+    try:
+        summary, covered_id = await run_io(get_history_summary, scope)
+        rows = await run_io(get_unsummarized_history, scope, covered_id)
+        if len(rows) < HISTORY_SUMMARY_TRIGGER:
+            return
+        older = rows[:-HISTORY_SUMMARY_KEEP]
+        transcript = "\n".join(
+            f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content[:1500]}"
+            for _, role, content in older
+        )
+        send = {
+            "model": HISTORY_SUMMARY_MODEL,
+            "messages": [
+                {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+                {"role": "user", "content": f"Прежнее резюме:\n{summary or '—'}\n\nНовые реплики:\n{transcript}"},
+            ],
+        }
+        headers = {"Authorization": f"Bearer {_get_deepseek_key()}", "Content-Type": "application/json"}
+        session = get_http_session("deepseek")
+        async with session.post(DEEPSEEK_API_URL, json=send, headers=headers, timeout=90) as response:
+            if response.status != 200:
+                logging.warning(f"Сжатие истории {_summary_scope_key(scope)}: DeepSeek status={response.status}")
+                return
+            data = await response.json()
+        new_summary = (data["choices"][0]["message"]["content"] or "").strip()
+        if not new_summary:
+            return
+        await run_io(save_history_summary, scope, new_summary[:HISTORY_SUMMARY_MAX_CHARS], older[-1][0])
+        increment_stat("history_summaries")
+    except Exception as e:
+        logging.warning(f"Не удалось сжать историю {_summary_scope_key(scope)}: {e}")
+
+
+PERSONA_CONDENSE_MODEL = "deepseek-chat"
+PERSONA_CONDENSE_PROMPT = (
+    "Ты редактор системных промптов. Перепиши системный промпт персонажа компактно, "
+    "сохранив смысл без потерь: личность, факты биографии, манеру речи, сленг, запреты и правила поведения. "
+    "Убери повторы и воду, пиши плотно, от второго лица ('ты ...'), на языке оригинала. "
+    "Выведи только готовый системный промпт, без пояснений. Длина — не более {max_chars} символов."
+)
+_persona_condense_running: Dict[int, asyncio.Task] = {}
+
+
+def schedule_persona_condense(user_id: int):
+    """
+    Один раз после загрузки персоны сжать ее системный промпт в PERSONA_CONDENSE_TOKENS
+    (в фоне; до готовности и при неудаче используется полная версия).
+    """
+    if not PERSONA_CONDENSE_TOKENS or not _get_deepseek_key():
+        return
+    user_data = load_user_data(user_id)
+    digest = user_data.get("thinking_prompt_hash")
+    full_prompt = user_data.get("thinking_prompt")
+    if not digest or not full_prompt or estimate_tokens(full_prompt) <= PERSONA_CONDENSE_TOKENS:
+        return
+    previous = _persona_condense_running.pop(user_id, None)
+    if previous is not None:
+        previous.cancel()
+    task = asyncio.create_task(_condense_persona(user_id, digest, full_prompt))
+    _persona_condense_running[user_id] = task
+
+    def _done(finished: asyncio.Task):
+        if _persona_condense_running.get(user_id) is finished:
+            del _persona_condense_running[user_id]
+
+    task.add_done_callback(_done)
+
+
+async def _condense_persona(user_id: int, digest: str, full_prompt: str):
+    try:
+        send = {
+            "model": PERSONA_CONDENSE_MODEL,
+            "messages": [
+                {"role": "system", "content": PERSONA_CONDENSE_PROMPT.format(max_chars=PERSONA_CONDENSE_TOKENS * 2)},
+                {"role": "user", "content": full_prompt},
+            ],
+        }
+        headers = {"Authorization": f"Bearer {_get_deepseek_key()}", "Content-Type": "application/json"}
+        session = get_http_session("deepseek")
+        async with session.post(DEEPSEEK_API_URL, json=send, headers=headers, timeout=120) as response:
+            if response.status != 200:
+                logging.warning(f"Сжатие персоны {user_id}: DeepSeek status={response.status}")
+                return
+            data = await response.json()
+        condensed = (data["choices"][0]["message"]["content"] or "").strip()
+        condensed_tokens = estimate_tokens(condensed)
+        # Модель могла не уложиться в бюджет или вернуть мусор — тогда остаемся на полной версии
+        if not condensed or condensed_tokens > PERSONA_CONDENSE_TOKENS * 5 // 4:
+            logging.info(f"Сжатие персоны {user_id}: результат {condensed_tokens} ток. не подошел")
+            return
+        user_data = load_user_data(user_id)
+        if user_data.get("thinking_prompt_hash") != digest:
+            return  # Персону успели заменить
+        user_data["thinking_prompt_condensed"] = condensed
+        user_data["thinking_prompt_condensed_hash"] = digest
+        save_user_data(user_id, user_data)
+        increment_stat("persona_condensed")
+        logging.info(
+            f"🗜 Персона {user_id} сжата: {estimate_tokens(full_prompt)} -> {condensed_tokens} ток."
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.warning(f"Не удалось сжать персону {user_id}: {e}")
+
+
+def _recompile_stale_persona_prompts() -> list:
+    """
+    Пересобрать промпты персон, скомпилированные прежним PERSONA_PROMPT_VERSION (или до появления
+    компиляции); вернуть id обновленных пользователей. Полный проход — один раз на версию шаблона.
+    """
+    version = str(PERSONA_PROMPT_VERSION)
+    if get_meta("persona_prompt_version") == version:
+        return []
+    updated = []
+    for user in get_all_users():
+        preference = user.get("thinking_preference")
+        if not preference:
+            continue
+        if user.get("thinking_prompt_hash") == persona_prompt_hash(preference) and user.get("thinking_prompt"):
+            continue
+        user_data = load_user_data(user["user_id"])
+        _store_persona_prompt(user_data, preference)
+        save_user_data(user["user_id"], user_data)
+        updated.append(user["user_id"])
+    set_meta("persona_prompt_version", version)
+    return updated
 
 
-def _deepseek_model(user_model: str) -> str:
-    """Маппинг модели бота на модель DeepSeek API."""
-    if user_model == "deepseek-r1":
-        return "deepseek-reasoner"
-    return "deepseek-chat"
+async def refresh_persona_prompts():
+    """Проверка версии шаблона персон при запуске: пересборка и повторное сжатие по одной персоне"""
+    try:
+        user_ids = await run_io(_recompile_stale_persona_prompts)
+    except Exception as e:
+        logging.error(f"Ошибка пересборки промптов персон: {e}")
+        return
+    if user_ids:
+        logging.info(f"🧩 Пересобрано промптов персон: {len(user_ids)}")
+    for user_id in user_ids:
+        # Сжимаем по очереди, чтобы смена шаблона не превращалась в залп запросов к DeepSeek.
+        schedule_persona_condense(user_id)
+        task = _persona_condense_running.get(user_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
 
 
 AI_MODEL_ANSWER = "Российская нейросеть АЛИСА"
@@ -4697,88 +6984,110 @@ def _is_ai_model_question(text: str) -> bool:
     return any(re.search(p, t) for p in _AI_MODEL_QUESTION_PATTERNS)
 
 
-async def get_ai_response(user_id: int, user_message: str, photo_base64: str = None) -> str:
-    """Получить ответ от AI"""
-    user_message = sanitize_user_input(user_message)
-
-    # Вопрос о нейросети — фиксированный ответ
-    if _is_ai_model_question(user_message):
-        return AI_MODEL_ANSWER
-
-    # Получаем предпочтения мышления
-    thinking_pref = get_thinking_preference(user_id)
+async def _stream_deepseek(session: aiohttp.ClientSession, url: str, send: dict, headers: dict,
+                           on_delta: Callable[[str], Awaitable[Any]],
+                           on_usage: Optional[Callable[[dict], Any]] = None,
+                           on_reasoning: Optional[Callable[[str], Awaitable[Any]]] = None) -> Optional[str]:
+    """
+    Запрос к DeepSeek со stream=True: разбираем SSE-чанки по мере прихода и
+    передаем в on_delta весь накопленный текст. Возвращает полный ответ или None.
+    on_usage получает блок usage из последнего чанка, on_reasoning — накопленные
+    рассуждения deepseek-reasoner (delta.reasoning_content) до начала ответа.
+    """
+    payload = dict(send, stream=True, stream_options={"include_usage": True})
+    timeout = aiohttp.ClientTimeout(total=300, sock_read=60)
+    parts = []
+    reasoning = []
+    async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
+        if response.status != 200:
+            logging.warning(f"DeepSeek stream status={response.status}")
+            return None
+        async for raw_line in response.content:
+            line = raw_line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if on_usage is not None and chunk.get("usage"):
+                on_usage(chunk["usage"])
+            choices = chunk.get("choices") or [{}]
+            delta_block = choices[0].get("delta") or {}
+            thought = delta_block.get("reasoning_content")
+            if thought and on_reasoning is not None:
+                reasoning.append(thought)
+                await on_reasoning("".join(reasoning))
+            delta = delta_block.get("content")
+            if delta:
+                parts.append(delta)
+                await on_delta("".join(parts))
+    return "".join(parts) or None
+
+
+# Порядок сообщений подобран под кэш префиксов DeepSeek (совпавший с прошлыми запросами префикс
+# тарифицируется дешевле и обрабатывается быстрее): сначала то, что побайтно одинаково у всех
+# пользователей (базовый стиль), затем пресет (общий для группы), персона (стабильна для
+# пользователя), жесткие правила формата, резюме (меняется редко), история и новый вопрос.
+# Правила формата идут после персоны, а не в общем префиксе: иначе персона их перекрывает;
+# они короткие и одинаковы у всех, так что кэш теряет на этом лишь несколько десятков токенов.
+def build_system_messages(owner_id: int) -> tuple:
+    """Системные сообщения запроса и пресет стиля: (messages, style_preset)"""
+    style_preset = get_response_style_preset(owner_id)
+    messages = [
+        {"role": "system", "content": RESPONSE_STYLE_SYSTEM_PROMPT},
+        {"role": "system", "content": STYLE_PRESET_PROMPTS[style_preset]},
+    ]
+    persona_prompt = get_persona_prompt(owner_id)
+    if persona_prompt:
+        messages.append({"role": "system", "content": persona_prompt})
+    # Жестко фиксируем формат ответа, даже при пользовательских пресетах/ролях.
+    messages.append({"role": "system", "content": RESPONSE_STYLE_HARD_GUARD_PROMPT})
+    return messages, style_preset
 
-    # Формируем историю с системным сообщением если есть предпочтения
-    messages = []
-    messages.append({
-        "role": "system",
-        "content": RESPONSE_STYLE_SYSTEM_PROMPT
-    })
 
-    style_preset = get_response_style_preset(user_id)
-    messages.append({
-        "role": "system",
-        "content": STYLE_PRESET_PROMPTS.get(style_preset, STYLE_PRESET_PROMPTS["neutral"])
-    })
+def record_prompt_cache_usage(style_preset: str, usage: Optional[dict]):
+    """Учесть попадания в кэш префиксов DeepSeek (usage.prompt_cache_hit/miss_tokens) по пресетам"""
+    if not usage or "prompt_cache_hit_tokens" not in usage:
+        return
+    increment_stat(f"prompt_cache_hit_tokens_{style_preset}", usage.get("prompt_cache_hit_tokens") or 0)
+    increment_stat(f"prompt_cache_miss_tokens_{style_preset}", usage.get("prompt_cache_miss_tokens") or 0)
 
-    if thinking_pref:
-        # Проверяем, это JSON или текст
-        try:
-            pref_json = json.loads(thinking_pref)
 
-            # Формируем промпт для ролевой игры - ИИ становится персонажем из JSON
-            system_msg = "Ты - это персонаж, описанный в следующем профиле. Общайся от первого лица, будто это твоя настоящая личность.\n\n"
-            system_msg += "=== ТВОЙ ПРОФИЛЬ ===\n\n"
+def format_prompt_cache_stats(stats: dict) -> str:
+    """Доля токенов промпта из кэша DeepSeek по пресетам для админки"""
+    lines = []
+    for preset in STYLE_PRESET_PROMPTS:
+        hit = stats.get(f"prompt_cache_hit_tokens_{preset}", 0)
+        miss = stats.get(f"prompt_cache_miss_tokens_{preset}", 0)
+        if not hit and not miss:
+            continue
+        hit_24h = get_stat_window(f"prompt_cache_hit_tokens_{preset}", hours=24)
+        miss_24h = get_stat_window(f"prompt_cache_miss_tokens_{preset}", hours=24)
+        ratio_24h = f"{hit_24h * 100 / (hit_24h + miss_24h):.0f}%" if hit_24h + miss_24h else "—"
+        lines.append(f"  {preset}: {hit * 100 / (hit + miss):.0f}% из кэша (за 24ч: {ratio_24h})")
+    return "\n".join(lines)
 
-            # Рекурсивно формируем описание из JSON
-            def format_json_to_text(obj, indent=0):
-                result = ""
-                prefix = "  " * indent
 
-                if isinstance(obj, dict):
-                    for key, value in obj.items():
-                        if isinstance(value, (dict, list)):
-                            result += f"{prefix}{key}:\n"
-                            result += format_json_to_text(value, indent + 1)
-                        else:
-                            result += f"{prefix}{key}: {value}\n"
-                elif isinstance(obj, list):
-                    for item in obj:
-                        if isinstance(item, (dict, list)):
-                            result += format_json_to_text(item, indent)
-                        else:
-                            result += f"{prefix}• {item}\n"
-                return result
-
-            system_msg += format_json_to_text(pref_json)
-            system_msg += "\n=== ИНСТРУКЦИИ ===\n"
-            system_msg += "• Общайся от первого лица ('я', 'мне', 'мой')\n"
-            system_msg += "• Используй стиль речи и сленг из профиля\n"
-            system_msg += "• Веди себя естественно, как реальный человек\n"
-            system_msg += "• Если в профиле указано использование мата - используй его естественно\n"
-            system_msg += "• Отвечай на основе фактов из профиля\n"
-            system_msg += "• Не упоминай, что ты ИИ или бот"
-
-            messages.append({
-                "role": "system",
-                "content": system_msg
-            })
-        except:
-            # Обычный текст - старая логика
-            messages.append({
-                "role": "system",
-                "content": f"Следуй этим указаниям при общении: {thinking_pref}"
-            })
+async def get_ai_response(user_id: int, user_message: str, photo_base64: str = None,
+                          on_delta: Optional[Callable[[str], Awaitable[Any]]] = None,
+                          on_reasoning: Optional[Callable[[str], Awaitable[Any]]] = None) -> str:
+    """
+    Получить ответ от AI.
+    on_delta — колбэк для потокового режима DeepSeek: получает накопленный текст ответа.
+    on_reasoning — то же для рассуждений deepseek-reasoner (до начала ответа).
+    """
+    user_message = sanitize_user_input(user_message)
 
-    # Жестко фиксируем формат ответа, даже при пользовательских пресетах/ролях.
-    messages.append({
-        "role": "system",
-        "content": RESPONSE_STYLE_HARD_GUARD_PROMPT
-    })
+    # Вопрос о нейросети — фиксированный ответ
+    if _is_ai_model_question(user_message):
+        return AI_MODEL_ANSWER
 
-    # Добавляем историю
-    history = get_history_for_api(user_id, limit=20)
-    messages.extend(history)
+    # Системная часть промпта: от общей для всех пользователей к персональной
+    messages, style_preset = build_system_messages(user_id)
 
     # Формируем сообщение пользователя
     if photo_base64:
@@ -4788,8 +7097,7 @@ async def get_ai_response(user_id: int, user_message: str, photo_base64: str = N
         ]
     else:
         user_content = user_message
-
-    messages.append({"role": "user", "content": user_content})
+    user_entry = {"role": "user", "content": user_content}
 
     user_data = load_user_data(user_id)
     user_model = user_data.get("model", DEFAULT_MODEL)
@@ -4797,11 +7105,22 @@ async def get_ai_response(user_id: int, user_message: str, photo_base64: str = N
     if user_model in IMAGE_MODELS:
         user_model = DEFAULT_MODEL
 
-    def _save_and_return(ai_reply: str) -> str:
+    # Резюме старой части диалога идет перед историей; сама история — без уже свернутых сообщений
+    summary_scope = ("chat", user_id)
+    summary, covered_id = await run_io(get_history_summary, summary_scope)
+    # Добавляем историю: сколько влезет в бюджет модели после системных сообщений и вопроса
+    token_budget = add_summary_within_budget(
+        _deepseek_model(user_model), messages, user_entry, history_summary_message(summary)
+    )
+    history = await run_io(get_history_for_api, user_id, token_budget, after_id=covered_id)
+    messages.extend(history)
+    messages.append(user_entry)
+
+    async def _save_and_return(ai_reply: str) -> str:
         text_msg = user_message if not photo_base64 else f"[Фото] {user_message}"
-        add_message_to_history(user_id, "user", text_msg)
-        add_message_to_history(user_id, "assistant", ai_reply)
+        await run_io(add_messages_to_history, user_id, [("user", text_msg), ("assistant", ai_reply)])
         increment_stat("total_messages")
+        schedule_history_summary(summary_scope)
         return ai_reply
 
     try:
@@ -4809,14 +7128,14 @@ async def get_ai_response(user_id: int, user_message: str, photo_base64: str = N
         if photo_base64 and API_BEARER_TOKEN:
             payload = {"model": "gemini-3-flash", "request": {"messages": messages}}
             headers = {"Authorization": f"Bearer {API_BEARER_TOKEN}", "Content-Type": "application/json"}
-            async with aiohttp.ClientSession() as session:
-                async with session.post(API_URL, json=payload, headers=headers, timeout=60) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        ai_reply = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                        if ai_reply:
-                            return _save_and_return(ai_reply)
-                    logging.warning(f"onlysq vision API status={response.status}, fallback to DeepSeek")
+            session = get_http_session("onlysq")
+            async with session.post(API_URL, json=payload, headers=headers, timeout=60) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    ai_reply = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+                    if ai_reply:
+                        return await _save_and_return(ai_reply)
+                logging.warning(f"onlysq vision API status={response.status}, fallback to DeepSeek")
 
         if not _get_deepseek_key():
             return "✖️ Не настроен DEEPSEEK_API_KEY. Текстовые ответы работают только через DeepSeek."
@@ -4828,14 +7147,25 @@ async def get_ai_response(user_id: int, user_message: str, photo_base64: str = N
         headers = {"Authorization": f"Bearer {_get_deepseek_key()}", "Content-Type": "application/json"}
         url = DEEPSEEK_API_URL
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=send, headers=headers, timeout=60) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    ai_reply = data['choices'][0]['message']['content']
-                    return _save_and_return(ai_reply)
-                else:
-                    return "✖️ Ошибка API"
+        session = get_http_session("deepseek")
+        if on_delta is not None:
+            ai_reply = await _stream_deepseek(
+                session, url, send, headers, on_delta,
+                on_usage=functools.partial(record_prompt_cache_usage, style_preset),
+                on_reasoning=on_reasoning
+            )
+            if ai_reply:
+                return await _save_and_return(ai_reply)
+            return "✖️ Ошибка API"
+
+        async with session.post(url, json=send, headers=headers, timeout=60) as response:
+            if response.status == 200:
+                data = await response.json()
+                record_prompt_cache_usage(style_preset, data.get("usage"))
+                ai_reply = data['choices'][0]['message']['content']
+                return await _save_and_return(ai_reply)
+            else:
+                return "✖️ Ошибка API"
     except asyncio.TimeoutError:
         return "✖️ Превышено время ожидания ответа"
     except Exception as e:
@@ -4851,80 +7181,8 @@ async def get_business_ai_response(bot_owner_id: int, business_connection_id: st
     if _is_ai_model_question(user_message):
         return AI_MODEL_ANSWER
 
-    # Получаем предпочтения мышления владельца
-    thinking_pref = get_thinking_preference(bot_owner_id)
-
-    # Формируем историю
-    messages = []
-    messages.append({
-        "role": "system",
-        "content": RESPONSE_STYLE_SYSTEM_PROMPT
-    })
-
-    style_preset = get_response_style_preset(bot_owner_id)
-    messages.append({
-        "role": "system",
-        "content": STYLE_PRESET_PROMPTS.get(style_preset, STYLE_PRESET_PROMPTS["neutral"])
-    })
-
-    if thinking_pref:
-        # Проверяем, это JSON или текст
-        try:
-            pref_json = json.loads(thinking_pref)
-
-            # Формируем промпт для ролевой игры - ИИ становится персонажем из JSON
-            system_msg = "Ты - это персонаж, описанный в следующем профиле. Общайся от первого лица, будто это твоя настоящая личность.\n\n"
-            system_msg += "=== ТВОЙ ПРОФИЛЬ ===\n\n"
-
-            # Рекурсивно формируем описание из JSON
-            def format_json_to_text(obj, indent=0):
-                result = ""
-                prefix = "  " * indent
-
-                if isinstance(obj, dict):
-                    for key, value in obj.items():
-                        if isinstance(value, (dict, list)):
-                            result += f"{prefix}{key}:\n"
-                            result += format_json_to_text(value, indent + 1)
-                        else:
-                            result += f"{prefix}{key}: {value}\n"
-                elif isinstance(obj, list):
-                    for item in obj:
-                        if isinstance(item, (dict, list)):
-                            result += format_json_to_text(item, indent)
-                        else:
-                            result += f"{prefix}• {item}\n"
-                return result
-
-            system_msg += format_json_to_text(pref_json)
-            system_msg += "\n=== ИНСТРУКЦИИ ===\n"
-            system_msg += "• Общайся от первого лица ('я', 'мне', 'мой')\n"
-            system_msg += "• Используй стиль речи и сленг из профиля\n"
-            system_msg += "• Веди себя естественно, как реальный человек\n"
-            system_msg += "• Если в профиле указано использование мата - используй его естественно\n"
-            system_msg += "• Отвечай на основе фактов из профиля\n"
-            system_msg += "• Не упоминай, что ты ИИ или бот"
-
-            messages.append({
-                "role": "system",
-                "content": system_msg
-            })
-        except:
-            # Обычный текст - старая логика
-            messages.append({
-                "role": "system",
-                "content": f"Следуй этим указаниям при общении: {thinking_pref}"
-            })
-
-    # Жестко фиксируем формат ответа, даже при пользовательских пресетах/ролях.
-    messages.append({
-        "role": "system",
-        "content": RESPONSE_STYLE_HARD_GUARD_PROMPT
-    })
-
-    # Добавляем историю ЭТОГО КОНКРЕТНОГО клиента
-    history = get_business_history_for_api(business_connection_id, client_chat_id, limit=20)
-    messages.extend(history)
+    # Системная часть промпта: от общей для всех пользователей к персональной
+    messages, style_preset = build_system_messages(bot_owner_id)
 
     # Формируем сообщение пользователя
     if photo_base64:
@@ -4934,29 +7192,44 @@ async def get_business_ai_response(bot_owner_id: int, business_connection_id: st
         ]
     else:
         user_content = user_message
-
-    messages.append({"role": "user", "content": user_content})
+    user_entry = {"role": "user", "content": user_content}
 
     user_data = load_user_data(bot_owner_id)
     user_model = user_data.get("model", DEFAULT_MODEL)
     if user_model in IMAGE_MODELS:
         user_model = DEFAULT_MODEL
 
+    summary_scope = ("business", business_connection_id, client_chat_id)
+    summary, covered_id = await run_io(get_history_summary, summary_scope)
+    # Добавляем историю ЭТОГО КОНКРЕТНОГО клиента в пределах бюджета токенов
+    token_budget = add_summary_within_budget(
+        _deepseek_model(user_model), messages, user_entry, history_summary_message(summary)
+    )
+    history = await run_io(
+        get_business_history_for_api, business_connection_id, client_chat_id, token_budget,
+        after_id=covered_id
+    )
+    messages.extend(history)
+    messages.append(user_entry)
+
     if photo_base64 and API_BEARER_TOKEN:
         payload = {"model": "gemini-3-flash", "request": {"messages": messages}}
         headers = {"Authorization": f"Bearer {API_BEARER_TOKEN}", "Content-Type": "application/json"}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(API_URL, json=payload, headers=headers, timeout=60) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        ai_reply = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                        if ai_reply:
-                            text_msg = user_message if not photo_base64 else f"[Фото] {user_message}"
-                            add_message_to_business_history(business_connection_id, client_chat_id, "user", text_msg)
-                            add_message_to_business_history(business_connection_id, client_chat_id, "assistant", ai_reply)
-                            increment_stat("total_messages")
-                            return ai_reply
+            session = get_http_session("onlysq")
+            async with session.post(API_URL, json=payload, headers=headers, timeout=60) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    ai_reply = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+                    if ai_reply:
+                        text_msg = user_message if not photo_base64 else f"[Фото] {user_message}"
+                        await run_io(
+                            add_messages_to_business_history, business_connection_id, client_chat_id,
+                            [("user", text_msg), ("assistant", ai_reply)]
+                        )
+                        increment_stat("total_messages")
+                        schedule_history_summary(summary_scope)
+                        return ai_reply
         except Exception as e:
             logging.warning(f"onlysq vision API error: {e}")
 
@@ -4970,36 +7243,50 @@ async def get_business_ai_response(bot_owner_id: int, business_connection_id: st
     url = DEEPSEEK_API_URL
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=send, headers=headers, timeout=60) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    ai_reply = data['choices'][0]['message']['content']
-
-                    # Сохраняем в историю ЭТОГО клиента
-                    text_msg = user_message if not photo_base64 else f"[Фото] {user_message}"
-                    add_message_to_business_history(business_connection_id, client_chat_id, "user", text_msg)
-                    add_message_to_business_history(business_connection_id, client_chat_id, "assistant", ai_reply)
+        session = get_http_session("deepseek")
+        async with session.post(url, json=send, headers=headers, timeout=60) as response:
+            if response.status == 200:
+                data = await response.json()
+                record_prompt_cache_usage(style_preset, data.get("usage"))
+                ai_reply = data['choices'][0]['message']['content']
+
+                # Сохраняем в историю ЭТОГО клиента
+                text_msg = user_message if not photo_base64 else f"[Фото] {user_message}"
+                await run_io(
+                    add_messages_to_business_history, business_connection_id, client_chat_id,
+                    [("user", text_msg), ("assistant", ai_reply)]
+                )
 
-                    # Обновляем статистику
-                    increment_stat("total_messages")
+                # Обновляем статистику
+                increment_stat("total_messages")
+                schedule_history_summary(summary_scope)
 
-                    return ai_reply
-                else:
-                    return "✖️ Ошибка API"
+                return ai_reply
+            else:
+                return "✖️ Ошибка API"
     except asyncio.TimeoutError:
         return "✖️ Превышено время ожидания ответа"
     except Exception as e:
         logging.error(f"Ошибка AI: {e}")
         return "✖️ Ошибка соединения"
 
-async def generate_image(user_id: int, prompt: str, model: str) -> tuple:
-    """Сгенерировать изображение"""
+async def generate_image(user_id: int, prompt: str, model: str, deadline: Optional[Deadline] = None,
+                         on_produced: Optional[Callable[[str], Any]] = None) -> tuple:
+    """
+    Сгенерировать изображение (в пределах бюджета deadline).
+    on_produced получает модель, которая на самом деле вернула картинку (с учетом запасных).
+    """
+    if deadline is None:
+        deadline = new_image_deadline()
     if model == "pollinations-flux-free":
         clean_prompt = build_image_prompt(prompt)
         clean_prompt = sanitize_user_input(clean_prompt, max_length=800)
         if not clean_prompt:
             return False, "✖️ Пустой промпт для генерации."
+        health = get_model_health(model)
+        if not health.allow(time.monotonic()):
+            return False, "✖️ Бесплатный API временно недоступен (много ошибок подряд). Попробуйте позже."
+        probing = health.state == "half_open"
         try:
             encoded_prompt = quote(clean_prompt, safe="")
             urls = [
@@ -5014,47 +7301,97 @@ async def generate_image(user_id: int, prompt: str, model: str) -> tuple:
                 {"model": "turbo", "nologo": "true", "width": "1024", "height": "1024"},
             ]
             last_status = None
-            async with aiohttp.ClientSession() as session:
-                for base_url in urls:
-                    for i, params in enumerate(attempts):
-                        params = dict(params)
-                        params["seed"] = str(random.randint(1, 10_000_000))
-                        try:
-                            async with session.get(base_url, params=params, timeout=90) as response:
-                                if response.status == 200:
-                                    image_bytes = await response.read()
-                                    if image_bytes:
-                                        increment_stat("total_messages")
-                                        return True, image_bytes
-                                    last_status = 200
-                                else:
-                                    body = (await response.text())[:500]
-                                    last_status = response.status
-                                    logging.warning(
-                                        f"Free image API error {response.status} on attempt {i + 1} ({base_url}): {body}"
-                                    )
-                        except Exception as req_e:
-                            # Ошибка конкретного хоста/запроса: логируем и пробуем дальше.
-                            last_status = 0
+            session = get_http_session("pollinations")
+
+            async def _fetch(base_url: str, params: dict, attempt_no: int, race_errors: list) -> tuple:
+                """
+                Один запрос к хосту pollinations: (успех, статус, байты, время старта запроса).
+                Неудачи с вердиктом о модели складываются в race_errors как (ошибка, статус).
+                """
+                started = time.monotonic()
+                if base_url != urls[0] and image_provider_busy("pollinations"):
+                    # Запасной хост не встает в очередь за слотом: под нагрузкой он отнимал бы
+                    # слоты у основных запросов других пользователей. Вердикта о модели нет.
+                    return False, 0, None, started
+                try:
+                    async with image_provider_slot("pollinations", deadline):
+                        async with session.get(base_url, params=params, timeout=deadline.timeout(90)) as response:
+                            if response.status == 200:
+                                image_bytes = await response.read()
+                                if image_bytes:
+                                    return True, 200, image_bytes, started
+                                race_errors.append(("empty body", 200))
+                                return False, 200, None, started
+                            body = (await response.text())[:500]
+                            race_errors.append((f"{response.status} {body}", response.status))
                             logging.warning(
-                                f"Free image API request failed on attempt {i + 1} ({base_url}): {req_e}"
+                                f"Free image API error {response.status} on attempt {attempt_no} ({base_url}): {body}"
                             )
+                            return False, response.status, None, started
+                except Exception as req_e:
+                    # Ошибка конкретного хоста/запроса: логируем и пробуем дальше.
+                    if deadline.expired:
+                        # Таймаут из-за исчерпанного бюджета — не вина модели.
+                        deadline.mark_exceeded()
+                    else:
+                        race_errors.append((str(req_e), None))
+                        logging.warning(
+                            f"Free image API request failed on attempt {attempt_no} ({base_url}): {req_e}"
+                        )
+                    return False, 0, None, started
+
+            for i, params in enumerate(attempts):
+                if not deadline.can_attempt():
+                    break
+                params = dict(params)
+                params["seed"] = str(random.randint(1, 10_000_000))
+                # Оба хоста отдают одну и ту же модель: запускаем их наперегонки со сдвигом,
+                # берем первую картинку, второй запрос отменяется.
+                race_errors = []
+                ok, last_status, image_bytes, fetch_started = await race_first_success(
+                    [functools.partial(_fetch, base_url, params, i + 1, race_errors) for base_url in urls],
+                    stagger=race_stagger(model),
+                    max_parallel=len(urls),
+                )
+                # В здоровье модели — один исход на гонку: хосты отдают одну модель, так что
+                # сбой одного при успехе другого — не сбой модели, а две неудачи — одна.
+                # Задержка успеха — у победившего запроса (от его старта): по ней race_stagger.
+                if race_errors and not ok:
+                    error, status = race_errors[-1]
+                    record_image_result(model, fetch_started, False, error, status=status)
+                if ok:
+                    record_image_result(model, fetch_started, True)
+                    increment_stat("total_messages")
+                    if on_produced is not None:
+                        on_produced(model)
+                    return True, image_bytes
+                if deadline.exceeded:
+                    break
 
-                        if i < len(attempts) - 1 and (last_status in retry_statuses or last_status in {0, 200}):
-                            await asyncio.sleep(1.2 + i * 0.8)
-                            continue
+                if i < len(attempts) - 1 and (last_status in retry_statuses or last_status in {0, 200}):
+                    pause = 1.2 + i * 0.8
+                    if not deadline.can_attempt(pause + Deadline.MIN_ATTEMPT_SECONDS):
                         break
+                    await asyncio.sleep(pause)
+                    continue
+                break
 
+            if deadline.exceeded:
+                return False, IMAGE_DEADLINE_MESSAGE
             if last_status:
                 if last_status in retry_statuses or last_status == 0:
                     return False, "✖️ Бесплатный API временно перегружен. Попробуйте через 10-30 секунд."
                 return False, f"✖️ Ошибка бесплатного API ({last_status})"
             return False, "✖️ Бесплатный API не вернул изображение."
         except asyncio.TimeoutError:
-            return False, "✖️ Бесплатный API: превышено время ожидания (90 сек)"
+            return False, f"✖️ Бесплатный API: превышено время ожидания ({deadline.describe_timeout()})"
         except Exception as e:
             logging.error(f"Ошибка бесплатной генерации: {e}")
             return False, "✖️ Ошибка бесплатной генерации изображения"
+        finally:
+            # Проба могла закончиться без исхода (бюджет, отмена) — не держим цепь в half_open.
+            if probing:
+                health.release_probe()
 
     if not API_BEARER_TOKEN:
         return False, "✖️ Не настроен API_BEARER_TOKEN для генерации изображений."
@@ -5068,98 +7405,478 @@ async def generate_image(user_id: int, prompt: str, model: str) -> tuple:
 
     enabled_models = set(get_enabled_models())
     ordered_candidates = ["flux", "flux-2-dev", "grok-2-image", "phoenix-1.0", "lucid-origin"]
-    model_attempts = [model]
-    for candidate in ordered_candidates:
-        if candidate in AVAILABLE_MODELS and candidate in IMAGE_MODELS and candidate != "pollinations-flux-free" and candidate not in model_attempts:
-            model_attempts.append(candidate)
+    model_attempts = plan_image_models(model, [
+        candidate for candidate in ordered_candidates
+        if candidate in AVAILABLE_MODELS and candidate in IMAGE_MODELS and candidate != "pollinations-flux-free"
+    ])
 
     last_status = None
     last_body = ""
     try:
-        connector = aiohttp.TCPConnector()
-        async with aiohttp.ClientSession(connector=connector) as session:
-            for idx, model_name in enumerate(model_attempts):
-                send = {"model": model_name, "prompt": prompt_clean, "n": 1}
-                async with session.post(IMAGE_API_URL, json=send, headers=headers, timeout=90) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if "files" in data and isinstance(data["files"], list) and len(data["files"]) > 0:
-                            try:
-                                image_bytes = base64.b64decode(data["files"][0])
-                                increment_stat("total_messages")
-                                return True, image_bytes
-                            except Exception:
-                                return False, "✖️ Ошибка декодирования изображения"
-                        last_status = 200
-                        continue
-
-                    body = (await response.text())[:500]
-                    last_status = response.status
-                    last_body = body
-                    logging.warning(f"Image API error {response.status} (model={model_name}): {body}")
-
-                    # На rate limit пробуем следующую onlysq image-модель.
-                    if response.status == 429 and idx < len(model_attempts) - 1:
-                        continue
-                    if response.status == 401:
-                        return False, "✖️ Ошибка API (401): проверьте API_BEARER_TOKEN в Railway Variables."
-
-        # Если onlysq не справился (например, 429 на всех моделях) — пробуем бесплатный fallback.
-        if last_status in {429, 500, 502, 503, 504, 520, 522, 524, 530}:
-            return await generate_image(user_id, prompt_clean, "pollinations-flux-free")
+        session = get_http_session("onlysq")
+        for idx, model_name in enumerate(model_attempts):
+            if not deadline.can_attempt():
+                return False, IMAGE_DEADLINE_MESSAGE
+            health = get_model_health(model_name)
+            if not health.allow(time.monotonic()):
+                continue
+            probing = health.state == "half_open"
+            try:
+                async with image_provider_slot("onlysq", deadline):
+                    send = {"model": model_name, "prompt": prompt_clean, "n": 1}
+                    started = time.monotonic()
+                    try:
+                        response = await session.post(
+                            IMAGE_API_URL, json=send, headers=headers, timeout=deadline.timeout(90)
+                        )
+                    except Exception as req_e:
+                        if deadline.expired:
+                            deadline.mark_exceeded()
+                            return False, IMAGE_DEADLINE_MESSAGE
+                        record_image_result(model_name, started, False, str(req_e) or type(req_e).__name__)
+                        raise
+                    async with response:
+                        if response.status == 200:
+                            data = await response.json()
+                            if "files" in data and isinstance(data["files"], list) and len(data["files"]) > 0:
+                                try:
+                                    image_bytes = base64.b64decode(data["files"][0])
+                                    record_image_result(model_name, started, True)
+                                    increment_stat("total_messages")
+                                    if on_produced is not None:
+                                        on_produced(model_name)
+                                    return True, image_bytes
+                                except Exception:
+                                    return False, "✖️ Ошибка декодирования изображения"
+                            last_status = 200
+                            record_image_result(model_name, started, False, "no files")
+                            continue
+
+                        body = (await response.text())[:500]
+                        last_status = response.status
+                        last_body = body
+                        record_image_result(
+                            model_name, started, False, f"{response.status} {body}", status=response.status
+                        )
+                        logging.warning(f"Image API error {response.status} (model={model_name}): {body}")
+
+                        # На rate limit пробуем следующую onlysq image-модель.
+                        if response.status == 429 and idx < len(model_attempts) - 1:
+                            continue
+                        if response.status == 401:
+                            return False, "✖️ Ошибка API (401): проверьте API_BEARER_TOKEN в Railway Variables."
+            finally:
+                if probing:
+                    health.release_probe()
+
+        # Если onlysq не справился (например, 429 на всех моделях или все цепи открыты) — пробуем бесплатный fallback.
+        if last_status is None or last_status in {429, 500, 502, 503, 504, 520, 522, 524, 530}:
+            return await generate_image(
+                user_id, prompt_clean, "pollinations-flux-free", deadline=deadline, on_produced=on_produced
+            )
         if last_status:
             return False, f"✖️ Ошибка API ({last_status})"
         return False, f"✖️ API не вернул изображение"
     except asyncio.TimeoutError:
-        return False, "✖️ Превышено время ожидания (90 сек)"
+        if deadline.expired:
+            deadline.mark_exceeded()
+            return False, IMAGE_DEADLINE_MESSAGE
+        return False, f"✖️ Превышено время ожидания ({deadline.describe_timeout()})"
     except Exception as e:
         logging.error(f"Ошибка генерации: {e} | last_status={last_status} body={last_body}")
         return False, f"✖️ Ошибка: {str(e)}"
 
 
-async def transcribe_voice(voice_file_path: str) -> str:
-    """Распознать голосовое сообщение через Google Speech Recognition"""
-    if sr is None:
-        logging.warning("Распознавание голоса недоступно: SpeechRecognition не установлен")
-        return None
+# ==================== РАСПОЗНАВАНИЕ ГОЛОСА ====================
+# OGG декодируется ffmpeg через stdin/stdout прямо в память (PCM 16 кГц, моно, 16 бит),
+# а распознает его подключаемый движок (SpeechBackend) в своем ограниченном пуле:
+# google — сетевой вызов в пуле потоков, vosk — локальная модель в пуле процессов,
+# загруженная один раз при старте бота.
+STT_SAMPLE_RATE = 16000
+STT_SAMPLE_WIDTH = 2
+_stt_latencies: deque = deque(maxlen=200)
+stt_stats = {"pending": 0, "max_queued": 0, "done": 0, "failed": 0, "timeouts": 0, "rejected": 0}
 
-    wav_path = voice_file_path.replace('.ogg', '.wav')
-    try:
-        # Конвертируем OGG в WAV через ffmpeg
-        process = await asyncio.create_subprocess_exec(
-            'ffmpeg', '-i', voice_file_path, '-acodec', 'pcm_s16le',
-            '-ar', '16000', '-ac', '1', wav_path, '-y',
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        await process.communicate()
 
-        # Используем speech_recognition
-        recognizer = sr.Recognizer()
+class SpeechBackend(abc.ABC):
+    """
+    Движок распознавания: start() поднимает пул (и грузит модель), recognize(pcm) -> текст
+    выполняется в self.executor. Для пула процессов recognize должна быть функцией уровня модуля.
+    """
+    name = "base"
 
-        with sr.AudioFile(wav_path) as source:
-            audio_data = recognizer.record(source)
-            # Google Speech API - бесплатный и точный
-            text = recognizer.recognize_google(audio_data, language='ru-RU')
+    def __init__(self):
+        self.executor = None
+        self.recognize: Optional[Callable[[bytes], Optional[str]]] = None
 
-        return text
+    @abc.abstractmethod
+    def start(self):
+        """Поднять пул и загрузить модель (блокирующе)"""
 
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def _recognize_google(pcm: bytes) -> Optional[str]:
+    """Распознать PCM через Google Speech Recognition (блокирующий сетевой вызов — только в пуле)"""
+    recognizer = sr.Recognizer()
+    recognizer.operation_timeout = STT_TIMEOUT
+    audio = sr.AudioData(pcm, STT_SAMPLE_RATE, STT_SAMPLE_WIDTH)
+    try:
+        # Google Speech API - бесплатный и точный
+        return recognizer.recognize_google(audio, language='ru-RU')
     except sr.UnknownValueError:
         logging.error("Google Speech Recognition не смог распознать речь")
         return None
     except sr.RequestError as e:
         logging.error(f"Ошибка Google Speech Recognition: {e}")
         return None
+
+
+class GoogleSpeechBackend(SpeechBackend):
+    name = "google"
+
+    def start(self):
+        if sr is None:
+            raise RuntimeError("SpeechRecognition не установлен")
+        self.executor = ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix="bot-stt")
+        self.recognize = _recognize_google
+
+
+class VoskSpeechBackend(SpeechBackend):
+    name = "vosk"
+
+    def __init__(self, model_path: str):
+        super().__init__()
+        self.model_path = model_path
+
+    def start(self):
+        if not self.model_path or not os.path.isdir(self.model_path):
+            raise RuntimeError(f"не найдена модель Vosk (VOSK_MODEL_PATH={self.model_path!r})")
+        import stt_worker
+
+        # spawn: дочерние процессы не наследуют потоки и event loop бота
+        self.executor = ProcessPoolExecutor(
+            max_workers=STT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=stt_worker.init_vosk,
+            initargs=(self.model_path, STT_SAMPLE_RATE),
+        )
+        # Прогрев: поднимаем все процессы сразу, чтобы модель грузилась при старте, а не на первом голосовом
+        futures = [self.executor.submit(stt_worker.ping) for _ in range(STT_WORKERS)]
+        wait_futures(futures)
+        for future in futures:
+            future.result()
+        self.recognize = stt_worker.transcribe_vosk
+
+
+STT_BACKENDS = {
+    "google": GoogleSpeechBackend,
+    "vosk": lambda: VoskSpeechBackend(VOSK_MODEL_PATH),
+}
+_stt_backend: Optional[SpeechBackend] = None
+
+
+def create_stt_backend(name: str) -> SpeechBackend:
+    """Создать и запустить движок (блокирующе: загрузка модели может занять секунды)"""
+    factory = STT_BACKENDS.get(name)
+    if factory is None:
+        raise ValueError(f"неизвестный STT_BACKEND: {name}")
+    backend = factory()
+    try:
+        backend.start()
+    except Exception:
+        backend.shutdown()
+        raise
+    return backend
+
+
+async def start_stt_backend(name: str = STT_BACKEND) -> Optional[SpeechBackend]:
+    """Поднять движок распознавания при старте; при ошибке откатываемся на google"""
+    global _stt_backend
+    started = time.monotonic()
+    try:
+        _stt_backend = await run_io(create_stt_backend, name)
     except Exception as e:
-        logging.error(f"Ошибка распознавания: {e}")
+        logging.error(f"❌ STT-движок {name} не запустился: {e}")
+        if name == "google":
+            return None
+        try:
+            _stt_backend = await run_io(create_stt_backend, "google")
+        except Exception as fallback_error:
+            logging.error(f"❌ Резервный STT-движок google не запустился: {fallback_error}")
+            return None
+    logging.info(f"🎙 STT-движок: {_stt_backend.name} ({time.monotonic() - started:.1f} с)")
+    return _stt_backend
+
+
+def get_stt_backend() -> Optional[SpeechBackend]:
+    """Текущий движок; если не запущен при старте — google по требованию"""
+    global _stt_backend
+    if _stt_backend is None and sr is not None:
+        _stt_backend = create_stt_backend("google")
+    return _stt_backend
+
+
+def shutdown_stt_backend():
+    global _stt_backend
+    if _stt_backend is not None:
+        _stt_backend.shutdown()
+        _stt_backend = None
+
+
+_stt_restart_lock = asyncio.Lock()
+
+
+async def restart_stt_backend(broken: SpeechBackend) -> Optional[SpeechBackend]:
+    """
+    Перезапустить движок, чей пул сломался (умер процесс Vosk — BrokenProcessPool).
+    Параллельные куски, упавшие на том же пуле, ждут один перезапуск.
+    """
+    global _stt_backend
+    async with _stt_restart_lock:
+        if _stt_backend is not broken:
+            return _stt_backend  # уже перезапущен другим запросом
+        logging.error(f"❌ Пул STT-движка {broken.name} сломан, перезапускаем")
+        increment_stat("stt_backend_restarts")
+        broken.shutdown()
+        _stt_backend = None
+        return await start_stt_backend(broken.name)
+
+
+def stt_queue_depth() -> int:
+    return max(0, stt_stats["pending"] - STT_WORKERS)
+
+
+def stt_latency_p50() -> Optional[float]:
+    return statistics.median(_stt_latencies) if _stt_latencies else None
+
+
+async def decode_voice_to_pcm(voice: bytes) -> Optional[bytes]:
+    """OGG/Opus -> сырой PCM через пайпы ffmpeg, без временных файлов"""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(STT_SAMPLE_RATE), "-ac", "1",
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        pcm, stderr = await asyncio.wait_for(process.communicate(voice), timeout=STT_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0 or not pcm:
+        logging.error(f"ffmpeg не смог декодировать голосовое: {stderr.decode(errors='ignore')[:300]}")
         return None
-    finally:
-        for temp_path in (wav_path, voice_file_path):
-            try:
-                if temp_path and os.path.exists(temp_path):
-                    os.remove(temp_path)
-            except Exception:
-                pass
+    return pcm
+
+
+# Энергетический VAD: кадры по 30 мс, порог — от уровня шума записи (10-й перцентиль энергии
+# кадров) и уровня речи (90-й перцентиль).
+# Резать можно в середине паузы не короче STT_VAD_MIN_SILENCE_MS; кусок короче
+# STT_SEGMENT_MIN_SECONDS не отделяется (распознавателю нужен контекст).
+STT_VAD_FRAME_MS = 30
+STT_VAD_MIN_SILENCE_MS = 300
+STT_VAD_MIN_LEVEL = 120
+STT_SEGMENT_MIN_SECONDS = 3
+# Пометка на месте куска, который не удалось распознать (таймаут, ошибка движка)
+STT_GAP_MARK = "[…]"
+# VAD — чистый CPU на Python: свой поток, чтобы не занимать пул дисковых операций run_io
+# (больше одного потока из-за GIL не ускорит)
+_vad_executor: Optional[ThreadPoolExecutor] = None
+
+
+async def run_vad(pcm: bytes) -> list:
+    """split_pcm_on_silence в отдельном потоке VAD"""
+    global _vad_executor
+    if _vad_executor is None:
+        _vad_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot-vad")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_vad_executor, split_pcm_on_silence, pcm)
+
+
+def shutdown_vad_executor():
+    """Остановить поток VAD (при остановке бота; не зависит от перезапусков движка STT)"""
+    global _vad_executor
+    if _vad_executor is not None:
+        _vad_executor.shutdown(wait=False, cancel_futures=True)
+        _vad_executor = None
+
+
+def split_pcm_on_silence(pcm: bytes) -> list:
+    """Разрезать PCM по паузам на куски для параллельного распознавания (по порядку, без тишины)"""
+    frame_bytes = STT_SAMPLE_RATE * STT_VAD_FRAME_MS // 1000 * STT_SAMPLE_WIDTH
+    frames_per_second = 1000 // STT_VAD_FRAME_MS
+    target_frames = STT_SEGMENT_SECONDS * frames_per_second
+    max_frames = STT_SEGMENT_MAX_SECONDS * frames_per_second
+    min_frames = STT_SEGMENT_MIN_SECONDS * frames_per_second
+    total = -(-len(pcm) // frame_bytes)
+    if total <= target_frames + min_frames:
+        return [pcm]
+
+    samples = array("h")
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % STT_SAMPLE_WIDTH])
+    frame_samples = frame_bytes // STT_SAMPLE_WIDTH
+    # Средняя амплитуда кадра по каждому 4-му отсчету — точности для поиска пауз хватает
+    energies = []
+    for offset in range(0, len(samples), frame_samples):
+        frame = samples[offset:offset + frame_samples:4]
+        energies.append(sum(map(abs, frame)) / max(1, len(frame)))
+    ordered = sorted(energies)
+    noise_floor = ordered[len(ordered) // 10]
+    speech_level = ordered[len(ordered) * 9 // 10]
+    # Без пауз в записи "шум" совпадает с речью — порог не выше трети уровня речи
+    threshold = max(STT_VAD_MIN_LEVEL, min(noise_floor * 3, speech_level * 0.3))
+
+    # Кандидаты на разрез — середины достаточно длинных пауз
+    candidates = []
+    min_run = STT_VAD_MIN_SILENCE_MS // STT_VAD_FRAME_MS
+    run_start = None
+    for index, energy in enumerate(energies + [threshold]):
+        if energy < threshold:
+            if run_start is None:
+                run_start = index
+        elif run_start is not None:
+            if index - run_start >= min_run:
+                candidates.append((run_start + index) // 2)
+            run_start = None
+
+    cuts = [0]
+    start = 0
+    while total - start > target_frames + min_frames:
+        upper = min(start + max_frames, total - min_frames)
+        window = [c for c in candidates if start + target_frames <= c <= upper]
+        if window:
+            cut = window[0]
+        else:
+            earlier = [c for c in candidates if start + min_frames <= c < start + target_frames]
+            if earlier:
+                cut = earlier[-1]
+            elif total - start <= max_frames:
+                break
+            else:
+                # Паузы нет — режем в самом тихом кадре допустимого окна
+                cut = min(range(start + target_frames, upper + 1), key=energies.__getitem__)
+        cuts.append(cut)
+        start = cut
+    cuts.append(total)
+
+    segments = []
+    for begin, end in zip(cuts, cuts[1:]):
+        if max(energies[begin:end]) < threshold:
+            continue  # Сплошная тишина
+        segments.append(pcm[begin * frame_bytes:end * frame_bytes])
+    return segments
+
+
+def _stt_job_finished(_future):
+    stt_stats["pending"] -= 1
+
+
+async def _recognize_segment(backend: SpeechBackend, pcm: bytes) -> Optional[str]:
+    loop = asyncio.get_running_loop()
+    # Сколько задач уже в пуле: кусок начнет работу после ahead // STT_WORKERS «волн» перед ним,
+    # поэтому таймаут растет с позицией в очереди — STT_TIMEOUT отводится на саму работу.
+    ahead = stt_stats["pending"]
+    # Сломанный пул отказывает уже при постановке задачи — счетчик очереди трогаем после нее.
+    future = loop.run_in_executor(backend.executor, backend.recognize, pcm)
+    stt_stats["pending"] += 1
+    stt_stats["max_queued"] = max(stt_stats["max_queued"], stt_queue_depth())
+    future.add_done_callback(_stt_job_finished)
+    timeout = STT_TIMEOUT * (ahead // STT_WORKERS + 1)
+    # shield: по таймауту перестаем ждать, но задача в пуле доработает и поправит счетчик очереди
+    return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+
+
+async def _recognize_segment_with_restart(backend: SpeechBackend, pcm: bytes) -> Optional[str]:
+    try:
+        return await _recognize_segment(backend, pcm)
+    except BrokenProcessPool:
+        # Умерший процесс ломает весь пул: поднимаем движок заново и повторяем кусок один раз.
+        backend = await restart_stt_backend(backend)
+        if backend is None:
+            raise
+        return await _recognize_segment(backend, pcm)
+
+
+def stt_admits(segment_count: int) -> bool:
+    """
+    Хватит ли места в очереди (STT_MAX_QUEUE кусков) для голосового из segment_count кусков.
+    В пустую очередь запись принимается всегда, иначе очень длинное голосовое не прошло бы никогда.
+    """
+    depth = stt_queue_depth()
+    free_workers = max(0, STT_WORKERS - stt_stats["pending"])
+    return depth == 0 or depth + max(0, segment_count - free_workers) <= STT_MAX_QUEUE
+
+
+async def recognize_pcm(pcm: bytes) -> Optional[str]:
+    """
+    Распознать PCM текущим движком: длинная запись режется по паузам, куски распознаются
+    параллельно в пуле движка (каждый — STT_TIMEOUT на работу сверх ожидания в очереди)
+    и склеиваются по порядку; на месте нераспознанного куска ставится STT_GAP_MARK.
+    """
+    backend = get_stt_backend()
+    if backend is None:
+        logging.warning("Распознавание голоса недоступно: нет рабочего STT-движка")
+        return None
+
+    segments = await run_vad(pcm)
+    # Очередь считается в кусках: одно длинное голосовое занимает пул так же, как несколько коротких.
+    if not stt_admits(len(segments)):
+        stt_stats["rejected"] += 1
+        logging.warning(
+            f"Очередь распознавания переполнена ({stt_queue_depth()} + {len(segments)} кусков), голосовое отклонено"
+        )
+        return None
+    if len(segments) > 1:
+        increment_stat("voice_segments", len(segments))
+    results = await asyncio.gather(
+        *(_recognize_segment_with_restart(backend, segment) for segment in segments),
+        return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if not any(isinstance(result, str) and result.strip() for result in results):
+        if errors:
+            raise errors[0]
+        return None
+    if errors:
+        increment_stat("voice_segment_gaps", len(errors))
+        logging.warning(f"Распознавание: {len(errors)} из {len(segments)} кусков не распознаны ({errors[0]!r})")
+    parts = []
+    for result in results:
+        if isinstance(result, BaseException):
+            # Пропуск помечаем, чтобы склеенный текст не выдавал обрывки за цельную фразу
+            if not parts or parts[-1] != STT_GAP_MARK:
+                parts.append(STT_GAP_MARK)
+        elif result and result.strip():
+            parts.append(result.strip())
+    return " ".join(parts)
+
+
+async def transcribe_voice(voice: bytes) -> Optional[str]:
+    """Распознать голосовое сообщение (байты OGG) текущим STT-движком"""
+    started = time.monotonic()
+    try:
+        pcm = await decode_voice_to_pcm(voice)
+        text = await recognize_pcm(pcm) if pcm else None
+    except asyncio.TimeoutError:
+        logging.error(f"Распознавание голоса не уложилось в {STT_TIMEOUT} с")
+        text = None
+        stt_stats["timeouts"] += 1
+    except Exception as e:
+        logging.error(f"Ошибка распознавания: {e}")
+        text = None
+
+    _stt_latencies.append(time.monotonic() - started)
+    stt_stats["done" if text else "failed"] += 1
+    increment_stat("voice_transcribed" if text else "voice_failed")
+    return text
 
 
 # ==================== MESSAGE HANDLERS ====================
@@ -5249,6 +7966,114 @@ async def send_long_message(message: Message, text: str):
             await message.answer(part)
 
 
+class StreamingReply:
+    """
+    Потоковый ответ в чат: start() сразу отправляет заглушку, которая затем
+    редактируется не чаще раза в STREAM_EDIT_INTERVAL секунд — сначала ходом
+    рассуждений (deepseek-reasoner), потом растущим ответом. При переполнении
+    MAX_MESSAGE_LENGTH текст продолжается в новом сообщении. finish() применяет
+    итоговое HTML-оформление (markdown_to_html) ко всем частям.
+    """
+
+    PLACEHOLDER = "⏳ Думаю…"
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.sent = []  # отправленные сообщения с частями ответа
+        self.offset = 0  # начало текста текущего (последнего) сообщения
+        self.shown = ""  # что сейчас видно в последнем сообщении
+        self.text = ""  # накопленный текст ответа
+        self.started = time.monotonic()
+        self.last_edit = 0.0  # время последней попытки правки (удачной или нет)
+
+    async def start(self):
+        """Отправить заглушку, не дожидаясь первых токенов"""
+        self.last_edit = time.monotonic()
+        await self._show(self.PLACEHOLDER)
+
+    def _throttled(self) -> bool:
+        # Считаем от последней попытки: неудачная отправка тоже выжидает интервал.
+        now = time.monotonic()
+        if now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return True
+        self.last_edit = now
+        return False
+
+    async def reasoning(self, thoughts: str):
+        """Показать ход рассуждений, пока ответ еще не начался"""
+        if self.text or self._throttled():
+            return
+        elapsed = int(time.monotonic() - self.started)
+        await self._show(f"💭 Размышляю… {elapsed} сек, {len(thoughts)} символов рассуждений")
+
+    async def update(self, text: str):
+        """Показать накопленный текст (вызывается на каждый чанк, сам ограничивает частоту правок)"""
+        self.text = text
+        if self._throttled():
+            return
+
+        # Переполнили текущее сообщение: фиксируем его и начинаем следующее.
+        while len(text) - self.offset > MAX_MESSAGE_LENGTH:
+            chunk = text[self.offset:self.offset + MAX_MESSAGE_LENGTH]
+            cut = chunk.rfind("\n")
+            if cut < MAX_MESSAGE_LENGTH // 2:
+                cut = MAX_MESSAGE_LENGTH
+            await self._show(chunk[:cut])
+            self.offset += cut
+            self.sent.append(None)  # место под следующее сообщение
+            self.shown = ""
+
+        await self._show(text[self.offset:] + " ▍")
+
+    async def _show(self, text: str):
+        if not text.strip() or text == self.shown:
+            return
+        try:
+            if not self.sent or self.sent[-1] is None:
+                msg = await self.message.answer(text)
+                if self.sent:
+                    self.sent[-1] = msg
+                else:
+                    self.sent.append(msg)
+            else:
+                await self.sent[-1].edit_text(text)
+            self.shown = text
+        except Exception as e:
+            # Flood-limit или «message is not modified»: просто пропускаем этот кадр.
+            logging.debug(f"Потоковая правка пропущена: {e}")
+
+    async def finish(self, text: str):
+        """Показать итоговый ответ с HTML-оформлением"""
+        if self.text and text.startswith("✖️"):
+            # Поток оборвался: ошибку дописываем, а уже показанный ответ оставляем.
+            text = f"{self.text}\n\n{text}"
+        sent = [msg for msg in self.sent if msg is not None]
+        if not sent:
+            await send_long_message(self.message, text)
+            return
+
+        parts = split_message(markdown_to_html(text))
+        for i, part in enumerate(parts):
+            try:
+                if i < len(sent):
+                    await sent[i].edit_text(normalize_html_outgoing_text(part), parse_mode="HTML")
+                else:
+                    await self.message.answer(part, parse_mode="HTML")
+            except Exception:
+                try:
+                    if i < len(sent):
+                        await sent[i].edit_text(part)
+                    else:
+                        await self.message.answer(part)
+                except Exception as e:
+                    logging.warning(f"Не удалось показать итоговый ответ: {e}")
+        for extra in sent[len(parts):]:
+            try:
+                await extra.delete()
+            except Exception:
+                pass
+
+
 @dp.message(F.photo)
 async def handle_photo(message: Message, state: FSMContext):
     """Обработка фото"""
@@ -5376,12 +8201,10 @@ async def handle_voice(message: Message, state: FSMContext):
         voice = message.voice
         file = await bot.get_file(voice.file_id)
 
-        # Создаем временный файл
-        voice_path = f"/tmp/voice_{user_id}_{voice.file_id}.ogg"
-        await bot.download_file(file.file_path, voice_path)
+        voice_data = await bot.download_file(file.file_path)
 
         # Распознаем голос
-        transcribed_text = await transcribe_voice(voice_path)
+        transcribed_text = await transcribe_voice(voice_data.read())
 
         if not transcribed_text:
             await message.answer("✖️ Не удалось распознать голосовое сообщение. Попробуйте еще раз.")
@@ -5397,17 +8220,15 @@ async def handle_voice(message: Message, state: FSMContext):
                 await message.answer(limit_msg)
                 return
             await bot.send_chat_action(message.chat.id, "upload_photo")
-            success, result = await generate_image_with_guard(user_id, transcribed_text, image_model)
+            success, result, cache_key = await generate_image_cached(user_id, transcribed_text, image_model)
             if success:
-                photo = (
-                    BufferedInputFile(result, filename="generated_image.jpg")
-                    if isinstance(result, (bytes, bytearray))
-                    else result
-                )
-                await message.answer_photo(
-                    photo=photo,
-                    caption=f"{text_emoji('image')} Модель: {image_model}\n{text_emoji('note')} Промпт: {transcribed_text[:100]}{'...' if len(transcribed_text) > 100 else ''}",
-                    parse_mode="HTML"
+                await send_generated_image(
+                    lambda photo: message.answer_photo(
+                        photo=photo,
+                        caption=f"{text_emoji('image')} Модель: {image_model}\n{text_emoji('note')} Промпт: {transcribed_text[:100]}{'...' if len(transcribed_text) > 100 else ''}",
+                        parse_mode="HTML"
+                    ),
+                    result, cache_key, user_id, transcribed_text, image_model
                 )
                 if not has_active_subscription(user_id):
                     consume_free_trial(user_id, is_image=True)
@@ -5416,8 +8237,12 @@ async def handle_voice(message: Message, state: FSMContext):
                 await message.answer(result)
             return
 
-        ai_response = await get_ai_response(user_id, transcribed_text)
-        await send_long_message(message, ai_response)
+        reply = StreamingReply(message)
+        await reply.start()
+        ai_response = await get_ai_response(
+            user_id, transcribed_text, on_delta=reply.update, on_reasoning=reply.reasoning
+        )
+        await reply.finish(ai_response)
         if not has_active_subscription(user_id):
             consume_free_trial(user_id)
             await maybe_send_trial_reminder_1_left(message.chat.id, user_id)
@@ -5475,19 +8300,17 @@ async def handle_message(message: Message, state: FSMContext):
 
         await bot.send_chat_action(message.chat.id, "upload_photo")
 
-        success, result = await generate_image_with_guard(user_id, message.text, image_model)
+        success, result, cache_key = await generate_image_cached(user_id, message.text, image_model)
 
         if success:
             try:
-                photo = (
-                    BufferedInputFile(result, filename="generated_image.jpg")
-                    if isinstance(result, (bytes, bytearray))
-                    else result
-                )
-                await message.answer_photo(
-                    photo=photo,
-                    caption=f"{text_emoji('image')} Модель: {image_model}\n{text_emoji('note')} Промпт: {message.text[:100]}{'...' if len(message.text) > 100 else ''}",
-                    parse_mode="HTML"
+                await send_generated_image(
+                    lambda photo: message.answer_photo(
+                        photo=photo,
+                        caption=f"{text_emoji('image')} Модель: {image_model}\n{text_emoji('note')} Промпт: {message.text[:100]}{'...' if len(message.text) > 100 else ''}",
+                        parse_mode="HTML"
+                    ),
+                    result, cache_key, user_id, message.text, image_model
                 )
                 if not has_active_subscription(user_id):
                     consume_free_trial(user_id, is_image=True)
@@ -5499,8 +8322,12 @@ async def handle_message(message: Message, state: FSMContext):
         return
 
     await bot.send_chat_action(message.chat.id, "typing")
-    ai_response = await get_ai_response(user_id, message.text)
-    await send_long_message(message, ai_response)
+    reply = StreamingReply(message)
+    await reply.start()
+    ai_response = await get_ai_response(
+        user_id, message.text, on_delta=reply.update, on_reasoning=reply.reasoning
+    )
+    await reply.finish(ai_response)
     if not has_active_subscription(user_id):
         consume_free_trial(user_id)
         await maybe_send_trial_reminder_1_left(message.chat.id, user_id)
@@ -5532,8 +8359,9 @@ async def check_trial_reminders():
     """Напоминания для trial-пользователей: 24ч после первого использования."""
     while True:
         try:
-            users = get_all_users()
             now = datetime.now()
+            await flush_user_cache_async()
+            users = await run_io(get_users_by_first_use, now - timedelta(hours=25), now - timedelta(hours=23))
 
             for user in users:
                 user_id = user["user_id"]
@@ -5577,8 +8405,9 @@ async def check_subscription_reminders():
     """Проверка и отправка напоминаний о подписке"""
     while True:
         try:
-            users = get_all_users()
             now = datetime.now()
+            await flush_user_cache_async()
+            users = await run_io(get_users_by_subscription_end, now + timedelta(hours=1.5), now + timedelta(hours=25))
 
             for user in users:
                 user_id = user["user_id"]
@@ -5641,7 +8470,7 @@ async def check_pending_invoices():
     """Проверка ожидающих инвойсов CryptoBot"""
     while True:
         try:
-            invoices = load_pending_invoices()
+            invoices = await run_io(load_pending_invoices)
 
             for invoice_id, data in list(invoices.items()):
                 user_id = data["user_id"]
@@ -5652,7 +8481,7 @@ async def check_pending_invoices():
                 if invoice_status:
                     if invoice_status["status"] == "paid":
                         # Активируем подписку
-                        grant_subscription(user_id, days=30)
+                        await run_io(grant_subscription, user_id, days=30)
 
                         # Обновляем статистику
                         price_usd = get_subscription_price_usd()
@@ -5661,7 +8490,7 @@ async def check_pending_invoices():
 
                         # Уведомляем пользователя
                         try:
-                            sub_end = get_subscription_end(user_id)
+                            sub_end = await run_io(get_subscription_end, user_id)
                             await send_system_message(
                                 chat_id=user_id,
                                 text=(
@@ -5677,12 +8506,12 @@ async def check_pending_invoices():
                             logging.warning(f"Не удалось уведомить пользователя {user_id}: {e}")
 
                         # Удаляем инвойс из ожидающих
-                        remove_pending_invoice(invoice_id)
+                        await run_io(remove_pending_invoice, invoice_id)
                         logging.info(f"✅ Подписка активирована для {user_id} через CryptoBot")
 
                     elif invoice_status["status"] in ["expired", "cancelled"]:
                         # Удаляем просроченный инвойс
-                        remove_pending_invoice(invoice_id)
+                        await run_io(remove_pending_invoice, invoice_id)
                         logging.info(f"⏰ Инвойс {invoice_id} истек или отменен")
 
                 await asyncio.sleep(1)  # Задержка между проверками инвойсов
@@ -5696,6 +8525,10 @@ async def check_pending_invoices():
 # ==================== MAIN ====================
 async def main():
     global business_connections
+    ensure_storage_migrated()
+    init_blacklist()
+    init_subscription_index()
+    init_media_registry()
     business_connections = load_business_connections()
 
     logging.info("🚀 AI Chat Bot запущен!")
@@ -5703,6 +8536,12 @@ async def main():
     # Устанавливаем команды
     await set_bot_commands()
 
+    # Общие HTTP-сеансы к внешним API: создаем и прогреваем, не задерживая старт polling
+    asyncio.create_task(start_http_clients())
+
+    # Движок распознавания голоса (локальная модель грузится здесь один раз)
+    await start_stt_backend()
+
     # Запускаем проверку напоминаний
     asyncio.create_task(check_subscription_reminders())
     asyncio.create_task(check_trial_reminders())
@@ -5710,7 +8549,29 @@ async def main():
     # Запускаем проверку CryptoBot инвойсов
     asyncio.create_task(check_pending_invoices())  # НОВОЕ
 
-    await dp.start_polling(bot)
+    # Фоновый сброс write-back кэша пользователей и уплотнение истории
+    asyncio.create_task(user_cache_flush_loop())
+    asyncio.create_task(history_compaction_loop())
+    asyncio.create_task(loop_lag_monitor())
+    asyncio.create_task(stats_flush_loop())
+    asyncio.create_task(refresh_persona_prompts())
+
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Каждый шаг остановки независим: ошибка одного не должна оставить несброшенными
+        # остальные (в write-back кэше лежат несохраненные записи пользователей).
+        try:
+            await close_http_clients()
+        except Exception:
+            logging.exception("Ошибка закрытия HTTP-сеансов при остановке")
+        for step in (shutdown_io_executor, shutdown_stt_backend, shutdown_vad_executor,
+                     flush_stats_on_shutdown, flush_user_cache, compact_chat_histories):
+            try:
+                step()
+            except Exception:
+                logging.exception(f"Ошибка при остановке ({step.__name__})")
+        close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Сравнивает размер запроса к DeepSeek на реальных историях из bot.db:
+старое окно (последние 20 сообщений) против окна по бюджету токенов.
+Использование:
+  DATA_DIR=/path/to/data python scripts/bench_context_window.py
+  DATA_DIR=/path/to/data python scripts/bench_context_window.py --model deepseek-reasoner --limit 500
+Вывод: сводка по байтам JSON и оценке токенов (среднее, p50, p95, максимум) для личных и бизнес-чатов.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# Бот при импорте создает клиента Telegram; для замеров сеть не нужна, хватит токена-заглушки.
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+
+import aibot  # noqa: E402
+
+LEGACY_LIMIT = 20
+SAMPLE_QUESTION = "Расскажи подробнее, что ты имел в виду в прошлом ответе?"
+
+
+def system_messages() -> list:
+    return [
+        {"role": "system", "content": aibot.RESPONSE_STYLE_SYSTEM_PROMPT},
+        {"role": "system", "content": aibot.STYLE_PRESET_PROMPTS["neutral"]},
+        {"role": "system", "content": aibot.RESPONSE_STYLE_HARD_GUARD_PROMPT},
+    ]
+
+
+def measure(messages: list) -> tuple:
+    payload = json.dumps({"messages": messages}, ensure_ascii=False).encode("utf-8")
+    return len(payload), sum(aibot.estimate_message_tokens(m) for m in messages)
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(title: str, before: list, after: list, elapsed: float):
+    if not before:
+        print(f"{title}: нет данных")
+        return
+    print(f"{title}: {len(before)} чатов, сборка окна {elapsed * 1000 / len(before):.2f} мс/чат")
+    for label, index, unit in (("байты JSON", 0, "B"), ("токены (оценка)", 1, "tok")):
+        old = [b[index] for b in before]
+        new = [a[index] for a in after]
+        saved = 100.0 * (1 - sum(new) / sum(old)) if sum(old) else 0.0
+        print(
+            f"  {label:<16} было: ср {statistics.mean(old):8.0f} p50 {percentile(old, 0.5):8.0f} "
+            f"p95 {percentile(old, 0.95):8.0f} макс {max(old):8.0f} {unit}"
+        )
+        print(
+            f"  {'':<16} стало: ср {statistics.mean(new):8.0f} p50 {percentile(new, 0.5):8.0f} "
+            f"p95 {percentile(new, 0.95):8.0f} макс {max(new):8.0f} {unit}  (−{saved:.1f}%)"
+        )
+
+
+def bench(chats: list, load_legacy, load_budgeted, model: str) -> tuple:
+    fixed = system_messages()
+    question = {"role": "user", "content": SAMPLE_QUESTION}
+    budget = aibot.history_token_budget(model, fixed + [question])
+    before, after = [], []
+    started = time.perf_counter()
+    for chat in chats:
+        before.append(measure(fixed + load_legacy(*chat) + [question]))
+        after.append(measure(fixed + load_budgeted(*chat, budget) + [question]))
+    return before, after, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="deepseek-chat", choices=sorted(aibot.CONTEXT_TOKEN_BUDGETS))
+    parser.add_argument("--limit", type=int, default=1000, help="сколько чатов каждого типа взять")
+    args = parser.parse_args()
+
+    print(f"База: {aibot.DB_FILE}")
+    print(f"Модель: {args.model}, бюджет промпта {aibot.context_token_budget(args.model)} токенов\n")
+
+    users = [
+        (row[0],) for row in aibot.db_query(
+            "SELECT DISTINCT user_id FROM chat_history LIMIT ?", (args.limit,)
+        )
+    ]
+    report(
+        "Личные чаты",
+        *bench(
+            users,
+            lambda user_id: aibot.get_history_for_api(user_id, limit=LEGACY_LIMIT),
+            lambda user_id, budget: aibot.get_history_for_api(user_id, budget),
+            args.model,
+        )
+    )
+
+    business_chats = aibot.db_query(
+        "SELECT DISTINCT connection_id, chat_id FROM business_history LIMIT ?", (args.limit,)
+    )
+    report(
+        "Бизнес-чаты",
+        *bench(
+            business_chats,
+            lambda connection_id, chat_id: aibot.get_business_history_for_api(
+                connection_id, chat_id, limit=LEGACY_LIMIT
+            ),
+            lambda connection_id, chat_id, budget: aibot.get_business_history_for_api(
+                connection_id, chat_id, budget
+            ),
+            args.model,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
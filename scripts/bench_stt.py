@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Замер задержки распознавания голоса на наборе OGG-файлов для разных STT-движков.
+Рядом с file.ogg можно положить file.txt с эталонным текстом — тогда считается WER.
+Использование:
+  python scripts/bench_stt.py fixtures/voice
+  VOSK_MODEL_PATH=/models/vosk-model-small-ru python scripts/bench_stt.py fixtures/voice --backends vosk google
+  python scripts/bench_stt.py fixtures/voice --backends vosk --concurrency 4
+Нужен ffmpeg; для vosk — пакет vosk и модель в VOSK_MODEL_PATH.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# Бот при импорте создает клиента Telegram; для замеров сеть не нужна, хватит токена-заглушки.
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+
+import aibot  # noqa: E402
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    """WER = расстояние Левенштейна по словам / число слов эталона"""
+    ref = reference.lower().split()
+    hyp = hypothesis.lower().split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_word != hyp_word),
+            )
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def decode_fixtures(files: list) -> list:
+    fixtures = []
+    for path in files:
+        started = time.perf_counter()
+        pcm = await aibot.decode_voice_to_pcm(path.read_bytes())
+        decode_s = time.perf_counter() - started
+        if not pcm:
+            print(f"  пропуск {path.name}: ffmpeg не декодировал файл")
+            continue
+        reference_path = path.with_suffix(".txt")
+        reference = reference_path.read_text(encoding="utf-8").strip() if reference_path.exists() else None
+        seconds = len(pcm) / (aibot.STT_SAMPLE_RATE * aibot.STT_SAMPLE_WIDTH)
+        fixtures.append((path.name, pcm, seconds, decode_s, reference))
+    return fixtures
+
+
+async def bench_backend(name: str, fixtures: list, concurrency: int):
+    started = time.perf_counter()
+    backend = await aibot.start_stt_backend(name)
+    if backend is None or backend.name != name:
+        print(f"[{name}] не запустился, пропускаем")
+        aibot.shutdown_stt_backend()
+        return
+    print(f"[{name}] запуск движка: {time.perf_counter() - started:.2f} с")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def run_one(fixture):
+        file_name, pcm, seconds, _, reference = fixture
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                text = await aibot.recognize_pcm(pcm)
+            except asyncio.TimeoutError:
+                text = None
+            elapsed = time.perf_counter() - t0
+        latencies.append(elapsed)
+        wer = word_error_rate(reference, text or "") if reference is not None else None
+        if wer is not None:
+            errors.append(wer)
+        print(
+            f"  {file_name:<32} {seconds:6.1f} с аудио -> {elapsed:6.2f} с"
+            f"{'' if wer is None else f'  WER {wer * 100:5.1f}%'}  {(text or '—')[:60]}"
+        )
+
+    wall = time.perf_counter()
+    await asyncio.gather(*(run_one(fixture) for fixture in fixtures))
+    wall = time.perf_counter() - wall
+    audio_total = sum(fixture[2] for fixture in fixtures)
+    print(
+        f"[{name}] файлов {len(latencies)}: p50 {statistics.median(latencies):.2f} с, "
+        f"p95 {percentile(latencies, 0.95):.2f} с, макс {max(latencies):.2f} с, "
+        f"всего {wall:.2f} с (RTF {wall / audio_total:.2f})"
+        + (f", средний WER {statistics.mean(errors) * 100:.1f}%" if errors else "")
+    )
+    aibot.shutdown_stt_backend()
+
+
+async def run(args):
+    files = sorted(Path(args.fixtures).glob("*.ogg"))
+    if not files:
+        print(f"В {args.fixtures} нет .ogg файлов", file=sys.stderr)
+        sys.exit(1)
+    fixtures = await decode_fixtures(files)
+    if not fixtures:
+        sys.exit(1)
+    decode_times = [fixture[3] for fixture in fixtures]
+    print(f"Декодирование ffmpeg: p50 {statistics.median(decode_times) * 1000:.0f} мс на файл\n")
+    for name in args.backends:
+        await bench_backend(name, fixtures, args.concurrency)
+        print()
+    aibot.shutdown_vad_executor()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("fixtures", help="папка с .ogg (и необязательными .txt с эталоном)")
+    parser.add_argument("--backends", nargs="+", default=[aibot.STT_BACKEND], choices=sorted(aibot.STT_BACKENDS))
+    parser.add_argument("--concurrency", type=int, default=1, help="сколько файлов распознавать одновременно")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Воркер локального распознавания речи (Vosk) для пула процессов бота.
+Модель загружается один раз при старте процесса (init_vosk), дальше каждый вызов
+transcribe_vosk работает с уже загруженной моделью.
+Вынесено из aibot, чтобы функции пула процессов сериализовались по имени модуля
+независимо от того, как запущен бот (python bot.py или python aibot.py).
+"""
+
+import json
+from typing import Optional
+
+# Сколько байт PCM подавать распознавателю за раз (1 секунда при 16 кГц, 16 бит)
+CHUNK_BYTES = 32000
+
+_model = None
+_sample_rate = 16000
+
+
+def init_vosk(model_path: str, sample_rate: int):
+    """Инициализатор процесса пула: загрузить модель Vosk"""
+    global _model, _sample_rate
+    from vosk import Model, SetLogLevel
+
+    SetLogLevel(-1)
+    _model = Model(model_path)
+    _sample_rate = sample_rate
+
+
+def ping() -> bool:
+    """Проверка, что процесс поднят и модель загружена"""
+    return _model is not None
+
+
+def transcribe_vosk(pcm: bytes) -> Optional[str]:
+    """Распознать PCM (моно, 16 бит) загруженной моделью; None — речь не найдена"""
+    from vosk import KaldiRecognizer
+
+    recognizer = KaldiRecognizer(_model, _sample_rate)
+    parts = []
+    for offset in range(0, len(pcm), CHUNK_BYTES):
+        if recognizer.AcceptWaveform(pcm[offset:offset + CHUNK_BYTES]):
+            parts.append(json.loads(recognizer.Result()).get("text", ""))
+    parts.append(json.loads(recognizer.FinalResult()).get("text", ""))
+    text = " ".join(part for part in parts if part).strip()
+    return text or None
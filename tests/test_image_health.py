@@ -0,0 +1,94 @@
+"""Учет здоровья pollinations при гонке двух хостов."""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="aibot-test-"))
+os.environ.setdefault("TELEGRAM_TOKEN", "123:abc")
+
+import pytest  # noqa: E402
+
+import aibot  # noqa: E402
+
+MODEL = "pollinations-flux-free"
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self) -> bytes:
+        return b"image"
+
+    async def text(self) -> str:
+        return "service unavailable"
+
+
+class FakeSession:
+    """Отвечает фиксированным статусом для каждого хоста и запоминает состояние автомата"""
+
+    def __init__(self, status_by_host: dict):
+        self.status_by_host = status_by_host
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        host = url.split("/")[2]
+        health = aibot.get_model_health(MODEL)
+        self.requests.append((host, health.state, health.consecutive_failures))
+        return FakeResponse(self.status_by_host[host])
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(status_by_host: dict) -> FakeSession:
+        fake = FakeSession(status_by_host)
+        monkeypatch.setattr(aibot, "get_http_session", lambda name: fake)
+        return fake
+
+    monkeypatch.setattr(aibot, "IMAGE_CIRCUIT_FAILURES", 3)
+    aibot._image_model_health.clear()
+    aibot._image_provider_semaphores.clear()
+    yield install
+    aibot._image_model_health.clear()
+    aibot._image_provider_semaphores.clear()
+
+
+def test_breaker_opens_after_threshold_failed_requests(session):
+    fake = session({"image.pollinations.ai": 503, "pollinations.ai": 503})
+
+    ok, _ = asyncio.run(aibot.generate_image(1, "a cat", MODEL))
+
+    assert not ok
+    health = aibot.get_model_health(MODEL)
+    # Три попытки по два хоста; каждая гонка — одна неудача, а не две.
+    assert len(fake.requests) == 2 * aibot.IMAGE_CIRCUIT_FAILURES
+    primaries = [(state, failures) for host, state, failures in fake.requests if host == "image.pollinations.ai"]
+    assert primaries == [("closed", n) for n in range(aibot.IMAGE_CIRCUIT_FAILURES)]
+    assert list(health.results) == [False] * aibot.IMAGE_CIRCUIT_FAILURES
+    assert health.state == "open"
+
+    ok, message = asyncio.run(aibot.generate_image(1, "a cat", MODEL))
+
+    assert not ok and "временно недоступен" in message
+    assert len(fake.requests) == 2 * aibot.IMAGE_CIRCUIT_FAILURES
+
+
+def test_failed_host_does_not_count_when_other_host_succeeds(session):
+    fake = session({"image.pollinations.ai": 503, "pollinations.ai": 200})
+
+    ok, image_bytes = asyncio.run(aibot.generate_image(1, "a cat", MODEL))
+
+    assert ok and image_bytes == b"image"
+    assert len(fake.requests) == 2
+    health = aibot.get_model_health(MODEL)
+    assert list(health.results) == [True]
+    assert health.consecutive_failures == 0
+    assert health.state == "closed"